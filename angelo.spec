@@ -17,7 +17,8 @@ a = Analysis(['bin/angelo'],
              pathex=['.'],
              binaries=[],
              datas=datas,
-             hiddenimports=[],
+             # Run by the binary itself, see angelo.launcher
+             hiddenimports=['supervisor.supervisord'],
              hookspath=[],
              runtime_hooks=[],
              excludes=['pycrypto', 'PyInstaller'],
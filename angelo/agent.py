@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+The resident angelo agent.
+
+`angelo up` and `angelo start` spawn an agent for the project directory,
+which keeps the parsed config, the connection to supervisord and the MQTT
+connection. The CLI sends it commands over the unix socket angelo.sock: a
+request is a line of JSON naming a method of the System and its keyword
+arguments, and is answered by a line of JSON holding the result or the
+error, along with what the command logged. Commands served by the agent
+neither parse the config nor fork daemons, and whether the agent runs is
+known from its socket answering rather than from a pidfile.
+
+The agent also watches the config files, and applies them to the running
+services as soon as they change (see :mod:`angelo.watcher`), and owns the
+pipeline capturing the camera for live video, broadcasts, recordings and
+modules (see :mod:`angelo.capture`).
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import schedule
+from six.moves import socketserver
+
+from .errors import OperationFailedError
+from .launcher import module_command
+from .parallel import capture_progress
+
+log = logging.getLogger(__name__)
+
+AGENT_SOCKET = "angelo.sock"
+AGENT_LOG = "agent.log"
+#  Seconds to wait for a new agent to answer
+START_TIMEOUT = 30
+CONNECT_TIMEOUT = 1
+
+#  The System methods and properties the CLI may call through the agent.
+#  Read-only ones don't wait for a command changing the services to end.
+READ_COMMANDS = ('ps', 'service_names')
+COMMANDS = READ_COMMANDS + ('start_system', 'stop', 'reload', 'restart', 'kill',
+                             'live', 'offline', 'broadcast', 'stop_broadcast', 'record',
+                             'stop_recording', 'share_frames', 'stop_sharing_frames')
+
+
+class RequestLogHandler(logging.Handler):
+    """Collect the records logged while a request is handled, for the CLI to show."""
+
+    def __init__(self):
+        super(RequestLogHandler, self).__init__(logging.INFO)
+        self.local = threading.local()
+
+    def start_capture(self):
+        self.local.records = []
+        return self.local.records
+
+    def stop_capture(self):
+        self.local.records = None
+
+    def emit(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is not None:
+            records.append((record.levelno, self.format(record)))
+
+
+class Agent(object):
+    """
+    Serve the CLI commands of a project directory.
+
+    :param load_system: returns a new :class:`angelo.system.System` from the config
+    :param config_files: the config is loaded again when one of these changes
+    :param files: the --file options the agent was started with
+    """
+
+    def __init__(self, load_system, config_files, files=None, socket_file=AGENT_SOCKET):
+        self.load_system = load_system
+        self.config_files = config_files
+        self.files = files or None
+        self.socket_file = os.path.abspath(socket_file)
+        self.system = None
+        self.mtimes = None
+        #  The MQTT client the agent serves, shared with the Systems loaded
+        #  after it started
+        self.mqtt_client = None
+        #  The --scale options given to up and start, applied to every
+        #  System loaded until the agent stops
+        self.scale_override = {}
+        self.load_lock = threading.Lock()
+        #  Commands changing the services run one at a time
+        self.command_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.server = None
+        self.server_lock = threading.Lock()
+        self.log_handler = RequestLogHandler()
+
+    def get_system(self, keep_last=False):
+        """
+        The System of the current config, loaded again if the config changed.
+        With `keep_last`, a config failing to load gives the System last
+        loaded instead, and the error is logged.
+        """
+        with self.load_lock:
+            mtimes = config_mtimes(self.config_files)
+            if self.system is None or mtimes != self.mtimes:
+                if self.system is not None:
+                    log.info('Config changed, loading it again')
+                try:
+                    system = self.load_system()
+                    for name, scale in self.scale_override.items():
+                        if name in system.service_names:
+                            system.get_service(name).options['scale'] = scale
+                    if self.mqtt_client is not None:
+                        system.mqtt_client = self.mqtt_client
+                except Exception as e:
+                    if not keep_last or self.system is None:
+                        raise
+                    log.error('Using the config last loaded: {}'.format(getattr(e, 'msg', e)))
+                    return self.system
+                self.system = system
+                self.mtimes = mtimes
+            return self.system
+
+    def handle(self, request):
+        """Run a request and return the response."""
+        if not isinstance(request, dict):
+            return {'error': 'Malformed request'}
+        method = request.get('method')
+        if method == 'shutdown':
+            self.shutdown()
+            return {'result': None}
+        if method not in COMMANDS:
+            return {'error': 'The angelo agent has no command {}'.format(method)}
+        if (request.get('files') or None) != self.files:
+            return {'error': 'The angelo agent of this directory runs with --file {}, '
+                             'stop it before using other files'.format(self.files)}
+
+        records = self.log_handler.start_capture()
+        try:
+            with capture_progress() as progress:
+                if method in READ_COMMANDS:
+                    result = self.call(method, request.get('kwargs') or {})
+                else:
+                    with self.command_lock:
+                        result = self.call(method, request.get('kwargs') or {})
+        except Exception as e:
+            if hasattr(e, 'msg'):
+                return {'error': e.msg, 'log': records, 'progress': progress}
+            #  Kept in the agent's log rather than sent to the CLI
+            self.log_handler.stop_capture()
+            log.exception('{} failed'.format(method))
+            return {'error': str(e), 'log': records, 'progress': progress}
+        finally:
+            self.log_handler.stop_capture()
+        return {'result': result, 'log': records, 'progress': progress}
+
+    def apply_config(self):
+        """Apply the config files, changed on disk, to the running services."""
+        with self.command_lock:
+            try:
+                system = self.get_system()
+            except Exception as e:
+                #  The services keep running with the config last applied
+                log.error('Not applying the changed config: {}'.format(getattr(e, 'msg', e)))
+                return
+            if not system.supervisor.is_running():
+                return
+            log.info('Applying the changed config')
+            try:
+                with capture_progress() as progress:
+                    system.reload()
+            finally:
+                for line in progress:
+                    log.info(line)
+
+    def call(self, method, kwargs):
+        #  The services can still be listed while the config is being fixed
+        system = self.get_system(keep_last=method in READ_COMMANDS)
+        if method == 'start_system':
+            for name, scale in (kwargs.get('scale_override') or {}).items():
+                if name in system.service_names:
+                    self.scale_override[name] = scale
+        attribute = getattr(system, method)
+        return attribute(**kwargs) if callable(attribute) else attribute
+
+    def bind(self):
+        client = AgentClient(self.socket_file)
+        if client.is_running():
+            raise OperationFailedError("An angelo agent is already running")
+        try:
+            #  Left over by an agent that didn't exit cleanly
+            os.remove(self.socket_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.server = AgentServer(self.socket_file, self)
+        return self.server
+
+    def close_server(self):
+        with self.server_lock:
+            if self.server is None:
+                return
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            #  Only now that no request is served, so that a new agent can
+            #  bind the socket once the CLI no longer reaches this one
+            try:
+                os.remove(self.socket_file)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self.close_server()
+        self.stopping.set()
+
+    def run(self):
+        """Serve requests until asked to shut down or terminated."""
+        system = self.get_system()
+        server = self.bind()
+        logging.getLogger().addHandler(self.log_handler)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.stopping.set())
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info('Agent listening on {}'.format(self.socket_file))
+
+        from .watcher import ConfigWatcher
+        from .watcher import get_watch_options
+        watch_options = get_watch_options()
+        watcher = None
+        if watch_options.enabled:
+            watcher = ConfigWatcher(self.config_files, self.apply_config, watch_options.debounce)
+            watcher.start()
+        #  Metrics are recorded and crash loops backed off whether or not
+        #  the device is registered and online, only publishing needs MQTT
+        mqtt_client = self.mqtt_client = system.mqtt_client
+        metrics_reporter = mqtt_client.schedule_metrics()
+        mqtt_client.schedule_crashloop_watcher()
+        try:
+            if mqtt_client.is_configured():
+                try:
+                    mqtt_client.connect()
+                except Exception as e:
+                    log.error('MQTT client failed: {}'.format(e))
+            else:
+                log.info('Device not registered, not connecting to the PSYGIG platform')
+            while not self.stopping.wait(1):
+                try:
+                    schedule.run_pending()
+                except Exception:
+                    log.exception('Scheduled job failed')
+        finally:
+            schedule.clear()
+            mqtt_client.close_metrics(metrics_reporter)
+            if mqtt_client.is_connected():
+                mqtt_client.disconnect()
+            if watcher is not None:
+                watcher.stop()
+            self.close_server()
+            from .capture import stop_capture_pipeline
+            stop_capture_pipeline()
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+        except ValueError:
+            response = {'error': 'Malformed request'}
+        else:
+            response = self.server.agent.handle(request)
+        try:
+            data = json.dumps(response)
+        except TypeError as e:
+            data = json.dumps({'error': 'Unexpected result: {}'.format(e)})
+        self.wfile.write(data.encode('utf-8') + b'\n')
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, agent):
+        self.agent = agent
+        socketserver.UnixStreamServer.__init__(self, socket_file, AgentRequestHandler)
+
+
+def config_mtimes(paths):
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+class AgentClient(object):
+    """Send commands to the agent of the current directory."""
+
+    def __init__(self, socket_file=AGENT_SOCKET, files=None):
+        self.socket_file = os.path.abspath(socket_file)
+        self.files = files or None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.socket_file)
+        except socket.error:
+            sock.close()
+            raise
+        #  Commands starting services take as long as the services do
+        sock.settimeout(None)
+        return sock
+
+    def is_running(self):
+        try:
+            self.connect().close()
+        except socket.error:
+            return False
+        return True
+
+    def call(self, method, **kwargs):
+        request = {'method': method, 'kwargs': kwargs, 'files': self.files}
+        try:
+            sock = self.connect()
+        except socket.error as e:
+            raise OperationFailedError("Can't reach the angelo agent: {}".format(e))
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            line = sock.makefile('rb').readline()
+        except socket.error as e:
+            raise OperationFailedError("Lost the angelo agent: {}".format(e))
+        finally:
+            sock.close()
+        if not line:
+            raise OperationFailedError("The angelo agent closed the connection")
+
+        response = json.loads(line.decode('utf-8'))
+        for progress in response.get('progress') or ():
+            sys.stderr.write(progress + '\n')
+        for level, message in response.get('log') or ():
+            log.log(level, message)
+        if 'error' in response:
+            raise OperationFailedError(response['error'])
+        return response['result']
+
+
+def spawn_agent(files=None, socket_file=AGENT_SOCKET, timeout=START_TIMEOUT):
+    """Start an agent in the background and return a client once it answers."""
+    args = module_command('angelo.agent') + ['--socket', socket_file]
+    for filename in files or ():
+        args += ['--file', filename]
+    with open(os.devnull, 'rb') as devnull, open(AGENT_LOG, 'ab') as agent_log:
+        process = subprocess.Popen(args, stdin=devnull, stdout=agent_log, stderr=agent_log,
+                                   start_new_session=True)
+
+    client = AgentClient(socket_file, files)
+    deadline = time.time() + timeout
+    while not client.is_running():
+        if process.poll() is not None:
+            raise OperationFailedError(
+                "The angelo agent exited with status {}, see {}".format(
+                    process.returncode, os.path.abspath(AGENT_LOG)))
+        if time.time() > deadline:
+            raise OperationFailedError(
+                "The angelo agent didn't answer within {}s".format(timeout))
+        time.sleep(0.05)
+    return client
+
+
+class RemoteSystem(object):
+    """Stands for the System in the CLI, running its commands in the agent."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @property
+    def service_names(self):
+        return self.client.call('service_names')
+
+    def ps(self, service_names=None):
+        return self.client.call('ps', service_names=service_names)
+
+    def up(self, service_names=None, start_deps=True, timeout=None, detached=False,
+           scale_override=None):
+        self.client.call('start_system', service_names=service_names,
+                         scale_override=scale_override)
+
+    def start(self, scale_override=None, **kwargs):
+        self.client.call('start_system', scale_override=scale_override)
+
+    def stop(self, timeout=None):
+        try:
+            self.client.call('stop', timeout=timeout)
+        finally:
+            self.client.call('shutdown')
+
+    def down(self):
+        self.client.call('shutdown')
+
+    def reload(self):
+        self.client.call('reload')
+
+    def restart(self, service_names=None, timeout=None):
+        self.client.call('restart', service_names=service_names, timeout=timeout)
+
+    def kill(self, service_names=None, signal="SIGKILL"):
+        self.client.call('kill', service_names=service_names, signal=signal)
+
+    def live(self, experimental=False):
+        self.client.call('live', experimental=experimental, background=True)
+
+    def offline(self):
+        self.client.call('offline')
+
+    def broadcast(self, location):
+        self.client.call('broadcast', location=location)
+
+    def stop_broadcast(self):
+        self.client.call('stop_broadcast')
+
+    def record(self, path):
+        self.client.call('record', path=path)
+
+    def stop_recording(self):
+        self.client.call('stop_recording')
+
+    def share_frames(self):
+        return self.client.call('share_frames')
+
+    def stop_sharing_frames(self):
+        self.client.call('stop_sharing_frames')
+
+
+def main(argv=None):
+    from .cli.command import system_from_options
+    from .config.config import get_default_config_files
+
+    logging.basicConfig(format='%(asctime)s angelo.agent: %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='python -m angelo.agent')
+    parser.add_argument('--socket', default=AGENT_SOCKET)
+    parser.add_argument('--file', action='append')
+    args = parser.parse_args(argv)
+
+    project_dir = os.environ.get('ANGELO_PATH') or '.'
+    if args.file:
+        config_files = [os.path.join(project_dir, filename) for filename in args.file]
+    else:
+        config_files = get_default_config_files(project_dir)
+    options = {'--file': args.file}
+
+    agent = Agent(lambda: system_from_options(project_dir, options), config_files,
+                  args.file, args.socket)
+    try:
+        agent.run()
+    except OperationFailedError as e:
+        log.error(e.msg)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
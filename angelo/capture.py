@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+The camera capture pipeline shared by live video, broadcasts, recordings
+and modules.
+
+The camera is opened once, by one GStreamer pipeline per process: the agent
+when it runs, the command itself otherwise. Its raw frames go to a tee, and
+are encoded to H.264 once, into a second tee, while a branch needs them.
+Branches are attached to and detached from the tees while the pipeline
+plays:
+
+- webrtc: a webrtcbin, for `angelo live`
+- rtmp: an RTMP stream, for `angelo broadcast`
+- record: MP4 files, for `angelo record`
+- frames: BGR frames on a shared memory socket, for modules in other
+  processes
+- appsink: BGR frames for a module in the process owning the pipeline
+
+Modules read frames with CaptureVideoStream. A branch that fails is
+detached and the others keep running.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import namedtuple
+
+from .configuration import UserConfig
+from .errors import OperationFailedError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEVICE = '/dev/video0'
+DEFAULT_WIDTH = 640
+DEFAULT_HEIGHT = 480
+DEFAULT_FRAMERATE = 30
+# kbit/s
+DEFAULT_BITRATE = 2000
+# Seconds of video in each file of a recording
+RECORD_SEGMENT = 600
+# Where the frames branch shares frames with modules
+FRAMES_SOCKET = 'capture.sock'
+# Seconds a detached branch gets to finish, a recording its file
+DETACH_TIMEOUT = 5
+# Seconds between two checks for stopping by the thread reading the bus
+BUS_TIMEOUT = 0.5
+
+RAW = 'raw'
+H264 = 'h264'
+
+# kind: (tee it is attached to, description of its elements)
+BRANCHES = {
+    'webrtc': (H264, (
+        'queue leaky=downstream max-size-buffers=30 ! rtph264pay config-interval=-1 pt=97 ! '
+        'application/x-rtp,media=video,encoding-name=H264,payload=97 ! '
+        'webrtcbin name=sendrecv bundle-policy=max-bundle')),
+    'rtmp': (H264, 'queue ! flvmux streamable=true ! rtmpsink location="{location} live=1"'),
+    'record': (H264, 'queue ! splitmuxsink location="{location}" max-size-time={segment}'),
+    'frames': (RAW, (
+        'queue leaky=downstream max-size-buffers=1 ! videoconvert ! video/x-raw,format=BGR ! '
+        'shmsink socket-path="{location}" shm-size={shm_size} wait-for-connection=false sync=false')),
+    'appsink': (RAW, (
+        'queue leaky=downstream max-size-buffers=1 ! videoconvert ! video/x-raw,format=BGR ! '
+        'appsink name=frames max-buffers=1 drop=true sync=false')),
+}
+
+# The GStreamer plugins each kind of branch needs, besides those of the capture
+# and, for the branches of encoded frames, those of the encoding
+PLUGINS = {
+    'capture': ['coreelements', 'videoconvert', 'videoscale', 'videorate'],
+    'encoder': ['videoparsersbad'],
+    'webrtc': ['webrtc', 'nice', 'dtls', 'srtp', 'rtp', 'rtpmanager'],
+    'rtmp': ['flv', 'rtmp'],
+    'record': ['isomp4', 'multifile'],
+    'frames': ['shm'],
+    'appsink': ['app'],
+}
+# The plugin of x264enc, the encoder used unless the `encoder` option is set
+X264_PLUGIN = 'x264'
+
+
+class CaptureOptions(namedtuple('_CaptureOptions', 'device width height framerate bitrate encoder')):
+    """
+    :param device: the V4L2 device of the camera, Jetson and Raspberry Pi
+                   boards use their camera module
+    :param bitrate: of the H.264 encoding, in kbit/s
+    :param encoder: a GStreamer description of an H.264 encoder replacing
+                    x264enc, for hardware encoders
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            options.get('device', DEFAULT_DEVICE),
+            int(options.get('width', DEFAULT_WIDTH)),
+            int(options.get('height', DEFAULT_HEIGHT)),
+            int(options.get('framerate', DEFAULT_FRAMERATE)),
+            int(options.get('bitrate', DEFAULT_BITRATE)),
+            options.get('encoder'),
+        )
+
+
+def get_capture_options():
+    """Read the `capture` section of angelo.yml."""
+    try:
+        user_config = UserConfig().config or {}
+    except IOError:
+        user_config = {}
+    return CaptureOptions.from_dict(user_config.get('capture'))
+
+
+def device_model():
+    try:
+        with open('/proc/device-tree/model', 'rb') as f:
+            model = f.read().rstrip(b'\0').decode('utf-8', 'replace')
+    except IOError:
+        return None
+    if model.startswith('NVIDIA Jetson'):
+        return 'jetson'
+    if model.startswith('Raspberry Pi'):
+        return 'raspberrypi'
+    return None
+
+
+def source_description(options, model=None):
+    """The camera, ending with the tee of raw I420 frames."""
+    caps = 'width={},height={},framerate={}/1'.format(
+        options.width, options.height, options.framerate)
+    if model == 'jetson':
+        source = (
+            'nvarguscamerasrc ! video/x-raw(memory:NVMM),{},format=NV12 ! nvvidconv ! '
+            'video/x-raw,format=BGRx ! videoconvert ! video/x-raw,format=I420'.format(caps))
+    elif model == 'raspberrypi':
+        source = (
+            'rpicamsrc preview=false do-timestamp=true ! video/x-raw,{} ! videoconvert ! '
+            'video/x-raw,format=I420'.format(caps))
+    else:
+        source = (
+            'v4l2src device="{}" do-timestamp=true ! videoconvert ! videoscale ! videorate ! '
+            'video/x-raw,format=I420,{}'.format(options.device, caps))
+    return '{} ! tee name={} allow-not-linked=true'.format(source, RAW)
+
+
+def encoder_description(options):
+    """The H.264 encoding of the raw frames, ending with the tee of encoded frames."""
+    encoder = options.encoder or (
+        'x264enc tune=zerolatency speed-preset=ultrafast bitrate={} key-int-max={}'.format(
+            options.bitrate, options.framerate * 2))
+    return (
+        'queue leaky=downstream max-size-buffers=2 ! {} ! '
+        'video/x-h264,profile=constrained-baseline ! h264parse config-interval=-1 ! '
+        'tee name={} allow-not-linked=true'.format(encoder, H264))
+
+
+def branch_description(kind, options, location=None):
+    if kind not in BRANCHES:
+        raise OperationFailedError('No such kind of capture branch: {}'.format(kind))
+    _, description = BRANCHES[kind]
+    return description.format(
+        location=(location or '').replace('"', '\\"'),
+        segment=RECORD_SEGMENT * 10 ** 9,
+        # A few frames
+        shm_size=options.width * options.height * 3 * 4,
+    )
+
+
+def frames_description(options, socket_path=FRAMES_SOCKET):
+    """What reads the frames shared by a frames branch, into an appsink."""
+    return (
+        'shmsrc socket-path="{}" is-live=true do-timestamp=true ! '
+        'video/x-raw,format=BGR,width={},height={},framerate={}/1 ! '
+        'appsink name=frames max-buffers=1 drop=true sync=false'.format(
+            socket_path, options.width, options.height, options.framerate))
+
+
+def load_gstreamer():
+    # GObject introspection is slow to import, only the capture needs it
+    import gi
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstVideo', '1.0')
+    from gi.repository import Gst
+    Gst.init(None)
+    return Gst
+
+
+def required_plugins(kinds, options):
+    needed = list(PLUGINS['capture'])
+    if any(BRANCHES[kind][0] == H264 for kind in kinds):
+        needed.extend(PLUGINS['encoder'])
+        if not options.encoder:
+            needed.append(X264_PLUGIN)
+    for kind in kinds:
+        needed.extend(PLUGINS[kind])
+    return needed
+
+
+def check_plugins(Gst, *kinds):
+    needed = required_plugins(kinds, get_capture_options())
+    missing = [p for p in needed if Gst.Registry.get().find_plugin(p) is None]
+    if missing:
+        print('Missing gstreamer plugins:', missing)
+        return False
+    return True
+
+
+class Branch(namedtuple('_Branch', 'name kind source bin pad done on_detach')):
+    """
+    A bin attached to a tee of the pipeline through `pad`. `done` is set
+    once the bin handled the EOS sent when it is detached.
+    """
+
+
+class CapturePipeline(object):
+    """
+    The camera and the branches attached to it.
+
+    :param options: a CaptureOptions, the `capture` section of angelo.yml
+                    by default
+    """
+
+    def __init__(self, options=None):
+        self.options = options or get_capture_options()
+        self.Gst = None
+        self.pipe = None
+        self.raw = None
+        self.encoder = None
+        self.branches = {}
+        self.detaching = {}
+        # The number of users of the branches attached with acquire()
+        self.users = {}
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.bus_thread = None
+
+    def is_running(self):
+        return self.pipe is not None and not self.stopping.is_set()
+
+    def start(self):
+        Gst = self.Gst = load_gstreamer()
+        self.pipe = Gst.parse_launch(source_description(self.options, device_model()))
+        self.raw = self.pipe.get_by_name(RAW)
+        if self.pipe.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            self.pipe.set_state(Gst.State.NULL)
+            self.pipe = None
+            raise OperationFailedError("Can't open the camera {}".format(self.options.device))
+        self.bus_thread = threading.Thread(target=self.watch_bus, name='capture-bus')
+        self.bus_thread.daemon = True
+        self.bus_thread.start()
+        log.info('Capturing {}x{} at {} fps'.format(
+            self.options.width, self.options.height, self.options.framerate))
+
+    def attach(self, name, kind, location=None, setup=None, on_detach=None):
+        """
+        Attach a branch of `kind` named `name`, unless one is attached
+        already, and return it. `setup` is called with the bin of the branch
+        before it plays, `on_detach` with the branch once it is detached.
+        """
+        Gst = self.Gst
+        with self.lock:
+            if not self.is_running():
+                raise OperationFailedError('The capture pipeline is stopped')
+            if name in self.branches:
+                return self.branches[name]
+            description = branch_description(kind, self.options, location)
+            source = BRANCHES[kind][0]
+            bin = Gst.parse_bin_from_description(description, True)
+            bin.set_name(name)
+            # So that the EOS of the branch is seen while the pipeline plays
+            bin.set_property('message-forward', True)
+            if setup is not None:
+                setup(bin)
+            self.pipe.add(bin)
+            pad = self.request_pad(source)
+            if pad.link(bin.get_static_pad('sink')) != Gst.PadLinkReturn.OK:
+                self.pipe.remove(bin)
+                self.release_pad(pad)
+                raise OperationFailedError("Can't attach {} to the capture pipeline".format(name))
+            bin.sync_state_with_parent()
+            if source == H264:
+                # New consumers need a key frame to start decoding
+                from gi.repository import GstVideo
+                bin.get_static_pad('sink').push_event(
+                    GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0))
+            branch = Branch(name, kind, source, bin, pad, threading.Event(), on_detach)
+            self.branches[name] = branch
+        log.info('Attached {} to the capture pipeline'.format(name))
+        return branch
+
+    def acquire(self, name, kind, location=None):
+        """Attach branch `name` unless it is already, for one more user."""
+        with self.lock:
+            branch = self.attach(name, kind, location)
+            self.users[name] = self.users.get(name, 0) + 1
+        return branch
+
+    def release(self, name):
+        """Release branch `name` for one user, detaching it after the last one."""
+        with self.lock:
+            users = self.users.get(name, 0) - 1
+            if users > 0:
+                self.users[name] = users
+                return False
+        return self.detach(name)
+
+    def request_pad(self, source):
+        Gst = self.Gst
+        if source == RAW:
+            return self.raw.get_request_pad('src_%u')
+        if self.encoder is None:
+            bin = Gst.parse_bin_from_description(encoder_description(self.options), True)
+            bin.set_name('encoder')
+            self.pipe.add(bin)
+            pad = self.raw.get_request_pad('src_%u')
+            pad.link(bin.get_static_pad('sink'))
+            bin.sync_state_with_parent()
+            self.encoder = Branch('encoder', None, RAW, bin, pad, None, None)
+        tee = self.encoder.bin.get_by_name(H264)
+        # The tee is inside the encoder's bin, branches link to a ghost pad of the bin
+        pad = Gst.GhostPad.new(None, tee.get_request_pad('src_%u'))
+        pad.set_active(True)
+        self.encoder.bin.add_pad(pad)
+        return pad
+
+    def release_pad(self, pad):
+        if self.encoder is not None and pad.get_parent() == self.encoder.bin:
+            target = pad.get_target()
+            self.encoder.bin.remove_pad(pad)
+            self.encoder.bin.get_by_name(H264).release_request_pad(target)
+        else:
+            self.raw.release_request_pad(pad)
+
+    def detach(self, name, timeout=DETACH_TIMEOUT):
+        """Detach branch `name`, returning False if there is none."""
+        with self.lock:
+            self.users.pop(name, None)
+            branch = self.branches.pop(name, None)
+            if branch is None:
+                return False
+            self.detaching[name] = branch
+        try:
+            self.unlink(branch, timeout)
+        finally:
+            with self.lock:
+                self.detaching.pop(name, None)
+                encoder = self.encoder
+                if encoder is not None and not any(b.source == H264 for b in self.branches.values()):
+                    # Nothing left to encode for
+                    self.encoder = None
+                else:
+                    encoder = None
+            if encoder is not None:
+                self.unlink(encoder, timeout)
+        log.info('Detached {} from the capture pipeline'.format(name))
+        if branch.on_detach is not None:
+            branch.on_detach(branch)
+        return True
+
+    def unlink(self, branch, timeout):
+        Gst = self.Gst
+
+        def unlink_idle(pad, info):
+            sink = branch.bin.get_static_pad('sink')
+            pad.unlink(sink)
+            # Muxers finish their files on EOS
+            sink.send_event(Gst.Event.new_eos())
+            return Gst.PadProbeReturn.REMOVE
+
+        branch.pad.add_probe(Gst.PadProbeType.IDLE, unlink_idle)
+        if branch.done is not None and not branch.done.wait(timeout):
+            log.warning("{} didn't finish within {}s, stopping it".format(branch.name, timeout))
+        branch.bin.set_state(Gst.State.NULL)
+        self.pipe.remove(branch.bin)
+        self.release_pad(branch.pad)
+
+    def branch_of(self, element):
+        with self.lock:
+            branches = list(self.branches.values()) + list(self.detaching.values())
+        for branch in branches:
+            if element == branch.bin or element.has_as_ancestor(branch.bin):
+                return branch
+        return None
+
+    def watch_bus(self):
+        Gst = self.Gst
+        bus = self.pipe.get_bus()
+        types = Gst.MessageType.ERROR | Gst.MessageType.EOS | Gst.MessageType.ELEMENT
+        while not self.stopping.is_set():
+            message = bus.timed_pop_filtered(int(BUS_TIMEOUT * Gst.SECOND), types)
+            if message is None:
+                continue
+            branch = self.branch_of(message.src)
+            if message.type == Gst.MessageType.ELEMENT:
+                structure = message.get_structure()
+                if branch is not None and structure.get_name() == 'GstBinForwarded' and \
+                        structure.get_value('message').type == Gst.MessageType.EOS:
+                    branch.done.set()
+                continue
+
+            if message.type == Gst.MessageType.ERROR:
+                error, _ = message.parse_error()
+                reason = error.message
+            else:
+                reason = 'end of stream'
+            if branch is not None:
+                log.error('{} failed, detaching it from the capture pipeline: {}'.format(
+                    branch.name, reason))
+                # Not from this thread, which the detach waits on
+                thread = threading.Thread(target=self.detach, args=(branch.name,))
+                thread.daemon = True
+                thread.start()
+            else:
+                log.error('The capture pipeline stopped: {}'.format(reason))
+                thread = threading.Thread(target=self.stop)
+                thread.daemon = True
+                thread.start()
+                return
+
+    def wait(self):
+        """Block until no branch is attached or the pipeline stops."""
+        while self.is_running() and self.branches:
+            self.stopping.wait(BUS_TIMEOUT)
+
+    def stop(self):
+        for name in list(self.branches):
+            self.detach(name)
+        self.stopping.set()
+        with self.lock:
+            pipe, self.pipe = self.pipe, None
+        if pipe is not None:
+            pipe.set_state(self.Gst.State.NULL)
+        if self.bus_thread is not None and self.bus_thread is not threading.current_thread():
+            self.bus_thread.join()
+
+
+_capture = None
+_capture_lock = threading.Lock()
+
+
+def get_capture_pipeline(start=True):
+    """
+    The capture pipeline of this process, started if it isn't running
+    unless `start` is False, in which case it may be None.
+    """
+    global _capture
+    with _capture_lock:
+        if _capture is None or not _capture.is_running():
+            if not start:
+                return None
+            _capture = CapturePipeline()
+            _capture.start()
+        return _capture
+
+
+def stop_capture_pipeline():
+    global _capture
+    with _capture_lock:
+        capture, _capture = _capture, None
+    if capture is not None and capture.is_running():
+        capture.stop()
+
+
+class CaptureVideoStream(object):
+    """
+    Frames of the capture pipeline for modules, as BGR numpy arrays, with
+    the start(), read() and stop() of imutils' video streams.
+
+    When the agent runs, it shares the frames of its pipeline over a shared
+    memory socket, otherwise the frames come from the pipeline of this
+    process.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or get_capture_options()
+        self.frame = None
+        self.Gst = None
+        self.pipe = None
+        self.sink = None
+        self.thread = None
+        self.remote = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        from .agent import AgentClient
+        from .agent import RemoteSystem
+        client = AgentClient()
+        if client.is_running():
+            self.remote = RemoteSystem(client)
+            socket_path = self.remote.share_frames()
+            Gst = self.Gst = load_gstreamer()
+            self.pipe = Gst.parse_launch(frames_description(self.options, socket_path))
+            self.sink = self.pipe.get_by_name('frames')
+            self.pipe.set_state(Gst.State.PLAYING)
+        else:
+            branch = get_capture_pipeline().acquire('appsink', 'appsink')
+            self.sink = branch.bin.get_by_name('frames')
+        self.thread = threading.Thread(target=self.update, name='capture-frames')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def update(self):
+        import numpy
+        while not self.stopped.is_set():
+            sample = self.sink.emit('try-pull-sample', int(BUS_TIMEOUT * 10 ** 9))
+            if sample is None:
+                continue
+            structure = sample.get_caps().get_structure(0)
+            width = structure.get_value('width')
+            height = structure.get_value('height')
+            buffer = sample.get_buffer()
+            data = buffer.extract_dup(0, buffer.get_size())
+            # Rows may be padded to 4 bytes
+            stride = len(data) // height
+            self.frame = numpy.frombuffer(data, numpy.uint8).reshape(
+                height, stride)[:, :width * 3].reshape(height, width, 3)
+
+    def read(self):
+        return self.frame
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.pipe is not None:
+            self.pipe.set_state(self.Gst.State.NULL)
+            self.pipe = None
+            try:
+                self.remote.stop_sharing_frames()
+            except OperationFailedError as e:
+                log.debug('Could not stop sharing frames: {}'.format(e.msg))
+        else:
+            capture = get_capture_pipeline(start=False)
+            if capture is not None:
+                capture.release('appsink')
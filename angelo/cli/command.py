@@ -30,6 +30,7 @@ from . import verbose_proxy
 from .. import config
 from .. import parallel
 from ..system import System
+from ..config.cache import ConfigCache
 from ..config.environment import Environment
 from ..const import API_VERSIONS
 from .utils import get_version_info
@@ -98,11 +99,36 @@ def get_config_from_options(base_dir, options, additional_options={}):
     config_path = get_config_path_from_options(
         base_dir, options, environment
     )
-    return config.load(
-        config.find(base_dir, config_path, environment, override_dir),
+    _, config_data = load_config(
+        base_dir, config_path, environment, override_dir,
         options.get('--compatibility'),
         not additional_options.get('--no-interpolate')
     )
+    return config_data
+
+
+def load_config(base_dir, config_path, environment, override_dir=None,
+                compatibility=False, interpolate=True):
+    """
+    Return the working directory and the loaded config of a project, from
+    the config cache when neither the files nor the variables it was loaded
+    from changed.
+    """
+    if config_path == ['-']:
+        config_details = config.find(base_dir, config_path, environment, override_dir)
+        return config_details.working_dir, config.load(
+            config_details, compatibility, interpolate)
+
+    filenames = [os.path.abspath(f) for f in config.get_config_filenames(base_dir, config_path)]
+    working_dir = override_dir if override_dir else os.path.dirname(filenames[0])
+    key = [filenames, os.path.abspath(working_dir), bool(compatibility), bool(interpolate)]
+
+    def load():
+        return config.load(
+            config.find(base_dir, filenames, environment, override_dir),
+            compatibility, interpolate)
+
+    return working_dir, ConfigCache().load(key, environment, load)
 
 
 def get_config_path_from_options(base_dir, options, environment):
@@ -125,11 +151,9 @@ def get_project(project_dir, config_path=None, project_name=None, verbose=False,
                 compatibility=False, interpolate=True):
     if not environment:
         environment = Environment.from_env_file(project_dir)
-    config_details = config.find(project_dir, config_path, environment, override_dir)
-    project_name = get_project_name(
-        config_details.working_dir, project_name, environment
-    )
-    config_data = config.load(config_details, compatibility, interpolate)
+    working_dir, config_data = load_config(
+        project_dir, config_path, environment, override_dir, compatibility, interpolate)
+    project_name = get_project_name(working_dir, project_name, environment)
 
     api_version = environment.get(
         'COMPOSE_API_VERSION',
@@ -22,14 +22,9 @@ from __future__ import unicode_literals
 import contextlib
 import logging
 import socket
-from distutils.spawn import find_executable
+from shutil import which as find_executable
 from textwrap import dedent
 
-from requests.exceptions import ConnectionError as RequestsConnectionError
-from requests.exceptions import ReadTimeout
-from requests.exceptions import SSLError
-from requests.packages.urllib3.exceptions import ReadTimeoutError
-
 from ..const import API_VERSION_TO_ENGINE_VERSION
 from .utils import binarystr_to_unicode
 from .utils import is_docker_for_mac_installed
@@ -58,6 +53,12 @@ class ConnectionError(Exception):
 
 @contextlib.contextmanager
 def handle_connection_errors(client):
+    # requests takes longer to import than most commands take to run
+    from requests.exceptions import ConnectionError as RequestsConnectionError
+    from requests.exceptions import ReadTimeout
+    from requests.exceptions import SSLError
+    from requests.packages.urllib3.exceptions import ReadTimeoutError
+
     try:
         yield
     except SSLError as e:
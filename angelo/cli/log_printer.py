@@ -19,7 +19,9 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import datetime
 import sys
+import time
 from collections import namedtuple
 from itertools import cycle
 from threading import Thread
@@ -40,8 +42,10 @@ class LogPresenter(object):
         self.prefix_width = prefix_width
         self.color_func = color_func
 
-    def present(self, container, line):
-        prefix = container.name_without_project.ljust(self.prefix_width)
+    def present(self, name, line, timestamp=None):
+        prefix = name.ljust(self.prefix_width)
+        if timestamp is not None:
+            line = '{} {}'.format(datetime.datetime.fromtimestamp(timestamp).isoformat(' '), line)
         return '{prefix} {line}'.format(
             prefix=self.color_func(prefix + ' |'),
             line=line)
@@ -50,7 +54,7 @@ class LogPresenter(object):
 def build_log_presenters(service_names, monochrome):
     """Return an iterable of functions.
 
-    Each function can be used to format the logs output of a container.
+    Each function can be used to format the logs output of a service.
     """
     prefix_width = max_name_width(service_names)
 
@@ -62,7 +66,7 @@ def build_log_presenters(service_names, monochrome):
 
 
 def max_name_width(service_names, max_index_width=3):
-    """Calculate the maximum width of container names so we can make the log
+    """Calculate the maximum width of service names so we can make the log
     prefixes line up like so:
 
     db_1  | Listening
@@ -72,51 +76,49 @@ def max_name_width(service_names, max_index_width=3):
 
 
 class LogPrinter(object):
-    """Print logs from many containers to a single output stream."""
+    """Print logs from many services, or instances of services, to a single output stream.
+
+    The `history` of (service name, LogRecord) pairs is printed first, then
+    each of the `log_streams` ({service name: iterable of output}) is read in
+    its own thread until all of them end.
+    """
 
     def __init__(self,
-                 containers,
+                 names,
                  presenters,
-                 event_stream,
+                 log_streams,
                  output=sys.stdout,
-                 cascade_stop=False,
+                 history=(),
                  log_args=None):
-        self.containers = containers
+        self.names = names
         self.presenters = presenters
-        self.event_stream = event_stream
+        self.log_streams = log_streams
         self.output = utils.get_output_stream(output)
-        self.cascade_stop = cascade_stop
+        self.history = history
         self.log_args = log_args or {}
 
     def run(self):
-        if not self.containers:
+        if not self.names:
             return
 
+        presenters = dict((name, next(self.presenters)) for name in self.names)
+        timestamps = self.log_args.get('timestamps')
+        for name, record in self.history:
+            self.write(presenters[name].present(
+                name, record.line + '\n', record.timestamp if timestamps else None))
+
         queue = Queue()
-        thread_args = queue, self.log_args
-        thread_map = build_thread_map(self.containers, self.presenters, thread_args)
-        start_producer_thread((
-            thread_map,
-            self.event_stream,
-            self.presenters,
-            thread_args))
-
-        for line in consume_queue(queue, self.cascade_stop):
-            remove_stopped_threads(thread_map)
+        thread_map = build_thread_map(self.log_streams, presenters, queue, self.log_args)
 
-            if self.cascade_stop:
-                matching_container = [cont.name for cont in self.containers if cont.name == line]
-                if line in matching_container:
-                    # Returning the name of the container that started the
-                    # the cascade_stop so we can return the correct exit code
-                    return line
+        for line in consume_queue(queue):
+            remove_stopped_threads(thread_map)
 
             if not line:
                 if not thread_map:
-                    # There are no running containers left to tail, so exit
+                    # There are no services left to tail, so exit
                     return
                 # We got an empty line because of a timeout, but there are still
-                # active containers to tail, so continue
+                # active services to tail, so continue
                 continue
 
             self.write(line)
@@ -134,24 +136,24 @@ class LogPrinter(object):
 
 
 def remove_stopped_threads(thread_map):
-    for container_id, tailer_thread in list(thread_map.items()):
+    for name, tailer_thread in list(thread_map.items()):
         if not tailer_thread.is_alive():
-            thread_map.pop(container_id, None)
+            thread_map.pop(name, None)
 
 
-def build_thread(container, presenter, queue, log_args):
+def build_thread(name, stream, presenter, queue, log_args):
     tailer = Thread(
-        target=tail_container_logs,
-        args=(container, presenter, queue, log_args))
+        target=tail_service_logs,
+        args=(name, stream, presenter, queue, log_args))
     tailer.daemon = True
     tailer.start()
     return tailer
 
 
-def build_thread_map(initial_containers, presenters, thread_args):
+def build_thread_map(log_streams, presenters, queue, log_args):
     return {
-        container.id: build_thread(container, next(presenters), *thread_args)
-        for container in initial_containers
+        name: build_thread(name, stream, presenters[name], queue, log_args)
+        for name, stream in log_streams.items()
     }
 
 
@@ -170,88 +172,19 @@ class QueueItem(namedtuple('_QueueItem', 'item is_stop exc')):
         return cls(item, True, None)
 
 
-def tail_container_logs(container, presenter, queue, log_args):
-    generator = get_log_generator(container)
-
+def tail_service_logs(name, stream, presenter, queue, log_args):
+    timestamps = log_args.get('timestamps')
     try:
-        for item in generator(container, log_args):
-            queue.put(QueueItem.new(presenter.present(container, item)))
+        for line in split_buffer(stream):
+            queue.put(QueueItem.new(
+                presenter.present(name, line, time.time() if timestamps else None)))
     except Exception as e:
         queue.put(QueueItem.exception(e))
         return
-    if log_args.get('follow'):
-        queue.put(QueueItem.new(presenter.color_func(wait_on_exit(container))))
-    queue.put(QueueItem.stop(container.name))
-
-
-def get_log_generator(container):
-    if container.has_api_logs:
-        return build_log_generator
-    return build_no_log_generator
-
-
-def build_no_log_generator(container, log_args):
-    """Return a generator that prints a warning about logs and waits for
-    container to exit.
-    """
-    yield "WARNING: no logs are available with the '{}' log driver\n".format(
-        container.log_driver)
-
-
-def build_log_generator(container, log_args):
-    # if the container doesn't have a log_stream we need to attach to container
-    # before log printer starts running
-    if container.log_stream is None:
-        stream = container.logs(stdout=True, stderr=True, stream=True, **log_args)
-    else:
-        stream = container.log_stream
-
-    return split_buffer(stream)
-
-
-def wait_on_exit(container):
-    exit_code = container.wait()
-    return "%s exited with code %s\n" % (container.name, exit_code)
-
-
-def start_producer_thread(thread_args):
-    producer = Thread(target=watch_events, args=thread_args)
-    producer.daemon = True
-    producer.start()
-
-
-def watch_events(thread_map, event_stream, presenters, thread_args):
-    crashed_containers = set()
-    for event in event_stream:
-        if event['action'] == 'stop':
-            thread_map.pop(event['id'], None)
-
-        if event['action'] == 'die':
-            thread_map.pop(event['id'], None)
-            crashed_containers.add(event['id'])
-
-        if event['action'] != 'start':
-            continue
-
-        if event['id'] in thread_map:
-            if thread_map[event['id']].is_alive():
-                continue
-            # Container was stopped and started, we need a new thread
-            thread_map.pop(event['id'], None)
-
-        # Container crashed so we should reattach to it
-        if event['id'] in crashed_containers:
-            event['container'].attach_log_stream()
-            crashed_containers.remove(event['id'])
-
-        thread_map[event['id']] = build_thread(
-            event['container'],
-            next(presenters),
-            *thread_args
-        )
+    queue.put(QueueItem.stop(name))
 
 
-def consume_queue(queue, cascade_stop):
+def consume_queue(queue):
     """Consume the queue by reading lines off of it and yielding them."""
     while True:
         try:
@@ -266,7 +199,7 @@ def consume_queue(queue, cascade_stop):
         if item.exc:
             raise item.exc
 
-        if item.is_stop and not cascade_stop:
+        if item.is_stop:
             continue
 
         yield item.item
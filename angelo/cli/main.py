@@ -6,36 +6,35 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import contextlib
+import datetime
 import functools
 import json
 import logging
-import pipes
 import re
-import subprocess
 import sys
 import os
 import errno
-from distutils.spawn import find_executable
+import time
 from inspect import getdoc
-import random
-import ssl
-import websockets
-import asyncio
-import os
-import sys
-import json
-import argparse
-import re
+import six
 
 from . import errors
 from . import signals
 from .. import __version__
+from ..agent import AgentClient
+from ..agent import RemoteSystem
+from ..agent import spawn_agent
 from ..config.serialize import serialize_config
-from ..config.environment import Environment
 from ..errors import StreamParseError
 from ..errors import OperationFailedError
+from ..launcher import run_internal_command
 from ..progress_stream import StreamOutputError
+from ..metrics import get_metrics_options
 from ..system import NoSuchService
+from ..timeseries import NoSuchSeries
+from ..timeseries import RESOLUTIONS
+from ..timeseries import TimeSeriesStore
+from ..utils import parse_seconds_float
 from .command import get_config_from_options
 from .command import system_from_options
 from .docopt_command import DocoptDispatcher
@@ -43,17 +42,23 @@ from .docopt_command import get_handler
 from .docopt_command import NoSuchCommand
 from .errors import UserError
 from .formatter import ConsoleWarningFormatter
+from .formatter import Formatter
+from .log_printer import build_log_presenters
+from .log_printer import LogPrinter
 from .utils import get_version_info
-
-import gi
-gi.require_version('Gst', '1.0')
-from gi.repository import Gst
+from .utils import human_readable_file_size
 
 log = logging.getLogger(__name__)
 console_handler = logging.StreamHandler(sys.stderr)
 
+# Commands run by the agent when it is running, `up` and `start` spawn it
+AGENT_COMMANDS = ('up', 'down', 'start', 'stop', 'reload', 'restart', 'kill', 'ps',
+                  'live', 'offline', 'broadcast', 'record')
+
 
 def main():
+    #  The processes the angelo binary runs itself as
+    run_internal_command(sys.argv[1:])
     signals.ignore_sigpipe()
     try:
         conf_file = os.path.expanduser("~") + "/.angelo/angelo.conf"
@@ -107,17 +112,34 @@ def perform_command(options, handler, command_options):
         handler(command_options)
         return
 
-    if options['COMMAND'] == 'config':
+    if options['COMMAND'] in ('config', 'metrics'):
         command = TopLevelCommand(None, options=options)
         handler(command, command_options)
         return
 
-    system = system_from_options(os.environ.get('ANGELO_PATH') or '.', options)
+    system = None
+    if options['COMMAND'] in AGENT_COMMANDS:
+        system = agent_from_options(options)
+    if system is None:
+        system = system_from_options(os.environ.get('ANGELO_PATH') or '.', options)
     command = TopLevelCommand(system, options=options)
 
     handler(command, command_options)
 
 
+def agent_from_options(options):
+    """
+    The agent of this directory standing for the System, spawned first by
+    `up` and `start`. None when the command runs without it.
+    """
+    client = AgentClient(files=options.get('--file'))
+    if not client.is_running():
+        if options['COMMAND'] not in ('up', 'start'):
+            return None
+        client = spawn_agent(options.get('--file'))
+    return RemoteSystem(client)
+
+
 def setup_logging():
     root_logger = logging.getLogger()
     root_logger.addHandler(console_handler)
@@ -197,11 +219,13 @@ class TopLevelCommand(object):
       help               Get help on a command
       kill               Kill services
       logs               View output from services
+      metrics            View metrics recorded on this device
       ps                 List services
-      top                Display the running services
+      top                Display the resource usage of the running services
       live               Send live video stream from device to server
       offline            Stop the live video stream from the device to server
       broadcast          Broadcast video stream from device to all clients connected to server
+      record             Record the video stream of the device to files
       version            Show the Angelo version information
       install            Install module for custom video and data processing
       run                Run the module already installed with angelo
@@ -245,7 +269,7 @@ class TopLevelCommand(object):
         """
 
         additional_options = {'--no-interpolate': options.get('--no-interpolate')}
-        angelo_config = get_config_from_options(os.environ.get('ANGELO_PATH'), self.toplevel_options, additional_options)
+        angelo_config = get_config_from_options(os.environ.get('ANGELO_PATH') or '.', self.toplevel_options, additional_options)
         image_digests = None
 
 
@@ -297,7 +321,7 @@ class TopLevelCommand(object):
         the command exits, all services are stopped. Running `angelo up -d`
         starts the services in the background and leaves them running.
 
-        Usage: up [options] [SERVICE...]
+        Usage: up [options] [--scale SERVICE=NUM...] [SERVICE...]
 
         Options:
             -d, --detach               Detached mode: Run services in the background,
@@ -307,6 +331,8 @@ class TopLevelCommand(object):
             -t, --timeout TIMEOUT      Use this timeout in seconds for service
                                        shutdown when attached or when services are
                                        already running. (default: 10)
+            --scale SERVICE=NUM        Run NUM instances of SERVICE. Overrides the
+                                       `scale` setting in the config file if present.
         """
         start_deps = not options['--no-deps']
         exit_value_from = exitval_from_opts(options, self.directory)
@@ -322,11 +348,13 @@ class TopLevelCommand(object):
             start_deps=start_deps,
             timeout=timeout,
             detached=detached,
+            scale_override=parse_scale_args(options['--scale']),
         )
 
     def down(self, options):
         """
-        Stops services created by `up`.
+        Disconnects from the PSYGIG platform by stopping the agent started
+        by `up`. Services keep running.
 
         Usage: down [options] [SERVICE...]
 
@@ -349,7 +377,7 @@ class TopLevelCommand(object):
         """
         Starts all services defined in the config file, MQTT client, and webserver.
 
-        Usage: start [options]
+        Usage: start [options] [--scale SERVICE=NUM...]
 
         Options:
             -d, --detach               Detached mode: Run services in the background,
@@ -363,6 +391,8 @@ class TopLevelCommand(object):
             --exit-code-from SERVICE   Return the exit code of the selected service
                                        service. Implies --abort-on-container-exit.
             --env-file PATH            Specify an alternate environment file
+            --scale SERVICE=NUM        Run NUM instances of SERVICE. Overrides the
+                                       `scale` setting in the config file if present.
         """
         start_deps = not options['--no-deps']
         exit_value_from = exitval_from_opts(options, self.directory)
@@ -372,13 +402,11 @@ class TopLevelCommand(object):
         if detached and exit_value_from:
             raise UserError("--abort-on-container-exit and -d cannot be combined.")
 
-        environment_file = options.get('--env-file')
-        environment = Environment.from_env_file(self.root_dir, environment_file)
-
         self.directory.start(
             start_deps=start_deps,
             timeout=timeout,
             detached=detached,
+            scale_override=parse_scale_args(options['--scale']),
         )
 
     def stop(self, options):
@@ -392,16 +420,14 @@ class TopLevelCommand(object):
                                     (default: 10)
             --env-file PATH         Specify an alternate environment file
         """
-        environment_file = options.get('--env-file')
-        environment = Environment.from_env_file(self.root_dir, environment_file)
-
         timeout = timeout_from_opts(options)
         self.directory.stop(
             timeout=timeout)
 
     def reload(self, options):
         """
-        Reload new config file on the system and start services defined in new config file.
+        Apply the config file to the running services, restarting only the
+        services that were added or changed.
 
         Usage: reload
         """
@@ -429,21 +455,49 @@ class TopLevelCommand(object):
     
         Usage: ps [options] [SERVICE...]    
         """
-        service_names = options['SERVICE']
-
-        self.directory.top(
-            service_names=service_names)
+        rows = [
+            [info['name'], info['statename'], info['health'] or '-',
+             ','.join(str(pid) for pid in info['pids']) or '-', info['description']]
+            for info in self.directory.ps(service_names=options['SERVICE'])
+        ]
+        print(Formatter().table(['Name', 'State', 'Health', 'PID', 'Description'], rows))
 
     def top(self, options):
         """
-        Display the running services
+        Display the resource usage of the running services
 
-        Usage: top [SERVICE...]
-        """
-        service_names = options['SERVICE']
+        Usage: top [options] [SERVICE...]
 
-        self.directory.top(
-            service_names=service_names)
+        Options:
+            -d, --delay SECONDS   Measure usage over this many seconds.
+                                  (default: 1)
+        """
+        delay = options.get('--delay')
+        try:
+            delay = 1 if delay is None else float(delay)
+        except ValueError:
+            raise UserError("delay must be a number of seconds")
+
+        rows = []
+        for name, state, usage in self.directory.top(
+                service_names=options['SERVICE'], delay=delay):
+            if usage is None:
+                rows.append([name, state, '-', '-', '-', '-', '-', '-'])
+                continue
+            rows.append([
+                name,
+                state,
+                str(usage.processes),
+                format_rate(usage.cpu_percent, '{:.1f}'),
+                human_readable_file_size(usage.rss_bytes),
+                str(usage.fds),
+                format_rate(usage.read_bps, human_readable_file_size),
+                format_rate(usage.write_bps, human_readable_file_size),
+            ])
+
+        print(Formatter().table(
+            ['Name', 'State', 'Procs', 'CPU %', 'Memory', 'FDs', 'Read/s', 'Write/s'],
+            rows))
 
     def kill(self, options):
         """
@@ -467,22 +521,81 @@ class TopLevelCommand(object):
         View output from services.
 
         Usage: logs [options] [SERVICE...]
-        
+
         Options:
-        """        
+            --no-color             Produce monochrome output.
+            -f, --follow           Follow log output.
+            -t, --timestamps       Show timestamps.
+            --since SINCE          Show logs since a duration ago (e.g. 90s,
+                                   10m, 2h) or a unix timestamp.
+            --tail="all"           Number of lines to show from the end of the
+                                   logs for each service. (default: 1600, or
+                                   all when --since is given)
+        """
         tail = options['--tail']
         if tail is not None:
             if tail.isdigit():
                 tail = int(tail)
             elif tail == 'all':
-                tail = int(sys.maxsize)
+                tail = None if options['--since'] else int(sys.maxsize)
             else:
                 raise UserError("tail flag must be all or a number")
 
-        self.directory.logs(
+        names = self.directory.instance_names(options['SERVICE'])
+        # Streams start at the current end of the logs, before the history
+        # is read, so that no line is missed in between
+        log_streams = self.directory.follow_logs(options['SERVICE']) \
+            if options['--follow'] else {}
+        history = self.directory.logs(
             service_names=options['SERVICE'],
-            follow=options['--follow'],
-            tail=tail)
+            tail=tail,
+            since=since_from_opts(options) if options['--since'] else None)
+
+        LogPrinter(
+            names,
+            build_log_presenters(names, options['--no-color']),
+            log_streams,
+            history=history,
+            log_args={'timestamps': options['--timestamps']}).run()
+
+    def metrics(self, options):
+        """
+        View metrics recorded on this device. Lists the recorded series
+        when no series is given.
+
+        Usage: metrics [options] [SERIES]
+
+        Options:
+            --since SINCE          Show points recorded since a duration ago
+                                   (e.g. 90s, 10m, 2h) or a unix timestamp.
+                                   (default: 1h)
+            --resolution RES       One of raw, 1m or 1h. (default: the finest
+                                   resolution that covers --since)
+        """
+        store = TimeSeriesStore(get_metrics_options().store, readonly=True)
+
+        if not options['SERIES']:
+            print('\n'.join(store.names()))
+            return
+
+        resolution = options['--resolution']
+        if resolution is not None and resolution not in RESOLUTIONS:
+            raise UserError("resolution must be one of raw, 1m or 1h")
+        since = since_from_opts(options)
+
+        try:
+            points = store.query(options['SERIES'], since=since, resolution=resolution)
+        except NoSuchSeries as e:
+            raise UserError(e.msg)
+        finally:
+            store.close()
+
+        rows = [
+            [datetime.datetime.fromtimestamp(point.timestamp).isoformat(' '),
+             '{:g}'.format(point.value), '{:g}'.format(point.min), '{:g}'.format(point.max)]
+            for point in points
+        ]
+        print(Formatter().table(['Time', 'Value', 'Min', 'Max'], rows))
 
     def live(self, options):
         """
@@ -494,8 +607,9 @@ class TopLevelCommand(object):
             -e, --experimental         Stream immediately to a connection
                                        without a connected peer.
         """
-        Gst.init(None)
-        if not check_plugins():
+        from ..capture import check_plugins
+        from ..capture import load_gstreamer
+        if not check_plugins(load_gstreamer(), 'webrtc'):
             sys.exit(1)
 
         if options['--experimental']:
@@ -519,24 +633,58 @@ class TopLevelCommand(object):
 
         Options:
             -s, --server SERVER         Specify an rtmp ingestion endpoint.
+            --stop                      Stop the broadcast.
 
         """
+        if options['--stop']:
+            self.directory.stop_broadcast()
+            return
 
-        cmd = "gst-launch-1.0 v4l2src device=/dev/video0 ! queue ! videoconvert ! queue ! x264enc ! flvmux streamable=true ! queue ! rtmpsink location="
+        from ..capture import check_plugins
+        from ..capture import load_gstreamer
+        if not check_plugins(load_gstreamer(), 'rtmp'):
+            sys.exit(1)
+        location = options['--server'] or "rtmp://52.185.136.118/LiveApp/242243369345776013882004"
+        print("Broadcast starting now...")
+        self.directory.broadcast(location=location)
+        self.wait_for_capture()
 
-        nv_cmd = "gst-launch-1.0 -e nvarguscamerasrc ! 'video/x-raw(memory:NVMM), width=(int)1920, height=(int)1080, format=(string)NV12, \
-        framerate=(fraction)30/1' ! nvvidconv flip-method=0 ! 'video/x-raw, format=(string)BGRx' ! queue ! videoconvert ! queue ! \
-        x264enc ! flvmux streamable=true ! queue ! rtmpsink location="
+    def record(self, options):
+        """
+        Record the video stream of the device to MP4 files of 10 minutes.
 
-        location = options['--server'] or "rtmp://52.185.136.118/LiveApp/242243369345776013882004"
+        Usage: record [options] [PATH]
 
-        if is_jetson_nano():
-            cmd = nv_cmd + location
-        else:
-            cmd = cmd + location
+        Options:
+            --stop          Stop the recording.
 
-        print("Broadcast starting now...")
-        subprocess.check_output(cmd, shell=True)
+        PATH is a pattern of the names of the files (default: video%05d.mp4).
+        """
+        if options['--stop']:
+            self.directory.stop_recording()
+            return
+
+        from ..capture import check_plugins
+        from ..capture import load_gstreamer
+        if not check_plugins(load_gstreamer(), 'record'):
+            sys.exit(1)
+        self.directory.record(path=options['PATH'] or 'video%05d.mp4')
+        self.wait_for_capture()
+
+    def wait_for_capture(self):
+        # Without an agent the camera is captured by this process
+        if isinstance(self.directory, RemoteSystem):
+            return
+        from ..capture import stop_capture_pipeline
+        from ..capture import get_capture_pipeline
+        capture = get_capture_pipeline(start=False)
+        try:
+            if capture is not None:
+                capture.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_capture_pipeline()
 
     def install(self, options):
         """
@@ -622,25 +770,12 @@ class TopLevelCommand(object):
         else:
             print(get_version_info('full'))
 
-def is_jetson_nano():
-    answer = False
-    cmd = "cat /proc/device-tree/model"
-    try:
-        result = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        if result == 'jetson-nano' or result == b'NVIDIA Jetson Nano Developer Kit\x00':
-            answer = True
-    except subprocess.CalledProcessError:
-        pass
-    return answer
-
-def check_plugins():
-    needed = ["opus", "vpx", "nice", "webrtc", "dtls", "srtp", "rtp",
-              "rtpmanager", "videotestsrc", "audiotestsrc"]
-    missing = list(filter(lambda p: Gst.Registry.get().find_plugin(p) is None, needed))
-    if len(missing):
-        print('Missing gstreamer plugins:', missing)
-        return False
-    return True
+def format_rate(value, formatter):
+    if value is None:
+        return '-'
+    if isinstance(formatter, six.string_types):
+        return formatter.format(value)
+    return formatter(value)
 
 def exitval_from_opts(options, project):
     exit_value_from = options.get('--exit-code-from')
@@ -648,12 +783,40 @@ def exitval_from_opts(options, project):
         if not options.get('--abort-on-container-exit'):
             log.warning('using --exit-code-from implies --abort-on-container-exit')
             options['--abort-on-container-exit'] = True
-        if exit_value_from not in [s.name for s in project.get_services()]:
+        if exit_value_from not in project.service_names:
             log.error('No service named "%s" was found in your compose file.',
                       exit_value_from)
             sys.exit(2)
     return exit_value_from
 
+def since_from_opts(options, default='1h'):
+    since = options.get('--since') or default
+    try:
+        return float(since)
+    except ValueError:
+        pass
+    seconds = parse_seconds_float(since)
+    if seconds is None:
+        raise UserError("since must be a duration such as 10m or a unix timestamp")
+    return time.time() - seconds
+
+def parse_scale_args(options):
+    res = {}
+    for s in options:
+        if '=' not in s:
+            raise UserError('Arguments to scale should be in the form service=num')
+        service_name, num = s.split('=', 1)
+        try:
+            num = int(num)
+        except ValueError:
+            raise UserError(
+                'Number of instances for service "%s" is not a number' % service_name
+            )
+        if num < 1:
+            raise UserError('Service "%s" needs at least one instance' % service_name)
+        res[service_name] = num
+    return res
+
 def timeout_from_opts(options):
     timeout = options.get('--timeout')
     return None if timeout is None else int(timeout)
\ No newline at end of file
@@ -23,7 +23,6 @@ from __future__ import unicode_literals
 import math
 import os
 import platform
-import ssl
 import subprocess
 import sys
 
@@ -105,6 +104,7 @@ def get_version_info(scope):
     if scope == 'angelo':
         return versioninfo
     if scope == 'full':
+        import ssl
         return (
             "{}\n"
             "{} version: {}\n"
@@ -6,6 +6,7 @@ from . import environment
 from .config import ConfigurationError
 from .config import DOCKER_CONFIG_KEYS
 from .config import find
+from .config import get_config_filenames
 from .config import is_url
 from .config import load
 from .config import merge_environment
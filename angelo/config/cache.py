@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+A cache of loaded configs under ~/.angelo/cache.
+
+Loading a config reads and parses its files, interpolates it and resolves
+extends and env files. The resulting Config is stored along with what it
+was made from:
+
+- the size, mtime and hash of every file read while loading it: the config
+  files, the files they extend and the env_file of their services
+- the names of the environment variables looked up and a digest of their
+  values
+
+and is used for as long as these are unchanged. A file whose size and
+mtime changed is hashed again, so touching a file keeps the cache valid.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import errno
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".angelo", "cache")
+
+_recorder = threading.local()
+
+
+def record_read(filename):
+    """Note that the config being loaded depends on a file."""
+    reads = getattr(_recorder, 'reads', None)
+    if reads is not None and filename not in reads:
+        reads.append(filename)
+
+
+@contextlib.contextmanager
+def recording_reads():
+    """Collect the files read by the config loaded in this block."""
+    _recorder.reads = reads = []
+    try:
+        yield reads
+    finally:
+        _recorder.reads = None
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(filename):
+    """(path, size, mtime, hash) of a file, size and the rest None when missing."""
+    filename = os.path.abspath(filename)
+    try:
+        stat = os.stat(filename)
+        return (filename, stat.st_size, stat.st_mtime_ns, file_hash(filename))
+    except (IOError, OSError):
+        return (filename, None, None, None)
+
+
+def file_unchanged(fingerprint):
+    filename, size, mtime, digest = fingerprint
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return size is None
+    if size is None or stat.st_size != size:
+        return False
+    if stat.st_mtime_ns == mtime:
+        return True
+    try:
+        return file_hash(filename) == digest
+    except IOError:
+        return False
+
+
+def environment_digest(environment, names):
+    values = [(name, environment.get(name) if name in environment else None)
+              for name in sorted(names)]
+    return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+class ConfigCache(object):
+    """
+    Loaded configs, stored in a file per set of config files and load options.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+
+    def entry_path(self, key):
+        from .. import __version__
+        key = json.dumps([__version__, list(sys.version_info[:2]), key])
+        return os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key, environment):
+        """The config stored for `key`, or None when it is missing or stale."""
+        try:
+            with open(self.entry_path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            log.debug('Ignoring unreadable config cache entry: {}'.format(e))
+            return None
+
+        if not all(file_unchanged(fingerprint) for fingerprint in entry['files']):
+            return None
+        if environment_digest(environment, entry['variables']) != entry['environment']:
+            return None
+
+        # Warn about the unset variables as loading the config would have
+        for name in entry['missing']:
+            environment[name]
+        return entry['config']
+
+    def put(self, key, environment, files, config):
+        entry = {
+            'files': [file_fingerprint(filename) for filename in files],
+            'variables': sorted(environment.referenced),
+            'environment': environment_digest(environment, environment.referenced),
+            'missing': list(environment.missing_keys),
+            'config': config,
+        }
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                log.debug("Can't create the config cache {}: {}".format(self.path, e))
+                return
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.entry_path(key))
+        except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+            log.debug("Can't write the config cache: {}".format(e))
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def load(self, key, environment, load_config):
+        """The config stored for `key`, or the one `load_config` returns, stored."""
+        config = self.get(key, environment)
+        if config is not None:
+            return config
+        with recording_reads() as files:
+            config = load_config()
+        self.put(key, environment, files, config)
+        return config
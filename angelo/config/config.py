@@ -41,6 +41,7 @@ from ..utils import parse_bytes
 from ..utils import parse_nanoseconds_int
 from ..utils import splitdrive
 from ..version import AngeloVersion
+from .cache import record_read
 from .environment import env_vars_from_file
 from .environment import Environment
 from .environment import split_env
@@ -147,10 +148,13 @@ ALLOWED_KEYS = DOCKER_CONFIG_KEYS + [
     'credential_spec',
     'dockerfile',
     'init',
+    'ionice',
     'log_driver',
     'log_opt',
     'logging',
     'network_mode',
+    'nice',
+    'pin_cpus',
     'platform',
     'scale',
     'stop_grace_period',
@@ -289,11 +293,7 @@ def find(base_dir, filenames, environment, override_dir=None):
             environment
         )
 
-    if filenames:
-        filenames = [os.path.join(base_dir, f) for f in filenames]
-    else:
-        filenames = get_default_config_files(base_dir)
-
+    filenames = get_config_filenames(base_dir, filenames)
     log.debug("Using configuration files: {}".format(",".join(filenames)))
     return ConfigDetails(
         override_dir if override_dir else os.path.dirname(filenames[0]),
@@ -302,6 +302,13 @@ def find(base_dir, filenames, environment, override_dir=None):
     )
 
 
+def get_config_filenames(base_dir, filenames):
+    """The paths of the config files to load, the default ones if none is given."""
+    if filenames:
+        return [os.path.join(base_dir, f) for f in filenames]
+    return get_default_config_files(base_dir)
+
+
 def validate_config_version(config_files):
     main_file = config_files[0]
     validate_top_level_object(main_file)
@@ -712,6 +719,13 @@ def process_service(service_config):
     if 'labels' in service_dict:
         service_dict['labels'] = parse_labels(service_dict['labels'])
 
+    if 'mem_limit' in service_dict:
+        mem_limit = parse_bytes(service_dict['mem_limit'])
+        if mem_limit is None:
+            raise ConfigurationError(
+                'Invalid format for bytes value: "{}"'.format(service_dict['mem_limit']))
+        service_dict['mem_limit'] = mem_limit
+
     service_dict = process_depends_on(service_dict)
 
     for field in ['dns', 'dns_search', 'tmpfs']:
@@ -1462,6 +1476,7 @@ def has_uppercase(name):
 
 
 def load_yaml(filename, encoding=None, binary=True):
+    record_read(filename)
     try:
         with io.open(filename, 'rb' if binary else 'r', encoding=encoding) as fh:
             return yaml.safe_load(fh)
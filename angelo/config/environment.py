@@ -28,6 +28,7 @@ import re
 import six
 
 from ..const import IS_WINDOWS_PLATFORM
+from .cache import record_read
 from .errors import ConfigurationError
 from .errors import EnvFileNotFound
 
@@ -53,6 +54,7 @@ def env_vars_from_file(filename):
     """
     Read in a line delimited file of environment variables.
     """
+    record_read(filename)
     if not os.path.exists(filename):
         raise EnvFileNotFound("Couldn't find env file: {}".format(filename))
     elif not os.path.isfile(filename):
@@ -75,6 +77,8 @@ class Environment(dict):
         super(Environment, self).__init__(*args, **kwargs)
         self.missing_keys = []
         self.silent = False
+        # The variables looked up, whose values the loaded config depends on
+        self.referenced = set()
 
     @classmethod
     def from_env_file(cls, base_dir, env_file=None):
@@ -109,6 +113,7 @@ class Environment(dict):
         return result
 
     def __getitem__(self, key):
+        self.referenced.add(key)
         try:
             return super(Environment, self).__getitem__(key)
         except KeyError:
@@ -127,6 +132,7 @@ class Environment(dict):
             return ""
 
     def __contains__(self, key):
+        self.referenced.add(key)
         result = super(Environment, self).__contains__(key)
         if IS_WINDOWS_PLATFORM:
             return (
@@ -135,6 +141,7 @@ class Environment(dict):
         return result
 
     def get(self, key, *args, **kwargs):
+        self.referenced.add(key)
         if IS_WINDOWS_PLATFORM:
             return super(Environment, self).get(
                 key,
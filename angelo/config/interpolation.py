@@ -21,87 +21,138 @@ from __future__ import unicode_literals
 
 import logging
 import re
+from collections import OrderedDict
 from string import Template
 
 import six
 
 from .errors import ConfigurationError
 from angelo.const import ANGELOFILE_V1_0 as V1_0
+from angelo.utils import json_hash
 from angelo.utils import parse_bytes
 from angelo.utils import parse_nanoseconds_int
 
 
 log = logging.getLogger(__name__)
 
+# Compiled plans of the config sections interpolated last, by content
+MAX_PLANS = 32
+_plans = OrderedDict()
 
-class Interpolator(object):
 
-    def __init__(self, templater, mapping):
-        self.templater = templater
-        self.mapping = mapping
-
-    def interpolate(self, string):
-        try:
-            return self.templater(string).substitute(self.mapping)
-        except ValueError:
-            raise InvalidInterpolation(string)
+def interpolate_environment_variables(version, config, section, environment):
+    return compile_interpolation(config, section).apply(environment)
 
 
-def interpolate_environment_variables(version, config, section, environment):
-    interpolator = Interpolator(TemplateWithDefaults, environment)
+def compile_interpolation(config, section):
+    """
+    The InterpolationPlan of a config section, compiled once per content of
+    the section.
+    """
+    try:
+        key = (section, json_hash(config))
+    except (AttributeError, TypeError):
+        # Values JSON can't hash, like the dates YAML parses
+        return InterpolationPlan(config, section)
+    plan = _plans.pop(key, None)
+    if plan is None:
+        plan = InterpolationPlan(config, section)
+    _plans[key] = plan
+    while len(_plans) > MAX_PLANS:
+        _plans.popitem(last=False)
+    return plan
+
+
+class InterpolationPlan(object):
+    """
+    A config section split into what doesn't depend on the environment,
+    converted once, and the strings holding substitutions, parsed once.
+    Applying it to an environment copies the former and only renders the
+    latter.
+    """
+
+    def __init__(self, config, section):
+        self.section = section
+        # (path of the value, config path, name, config key, CompiledTemplate)
+        self.slots = []
+        self.static = dict(
+            (name, self.compile_item(name, config_dict or {}))
+            for name, config_dict in config.items()
+        )
 
-    def process_item(name, config_dict):
+    def compile_item(self, name, config_dict):
         return dict(
-            (key, interpolate_value(name, key, val, section, interpolator))
-            for key, val in (config_dict or {}).items()
+            (key, self.compile_value(name, key, val))
+            for key, val in config_dict.items()
         )
 
-    return dict(
-        (name, process_item(name, config_dict or {}))
-        for name, config_dict in config.items()
-    )
-
-
-def get_config_path(config_key, section, name):
-    return '{}/{}/{}'.format(section, name, config_key)
-
-
-def interpolate_value(name, config_key, value, section, interpolator):
-    try:
-        return recursive_interpolate(value, interpolator, get_config_path(config_key, section, name))
-    except InvalidInterpolation as e:
-        raise ConfigurationError(
-            'Invalid interpolation format for "{config_key}" option '
-            'in {section} "{name}": "{string}"'.format(
-                config_key=config_key,
-                name=name,
-                section=section,
-                string=e.string))
-    except UnsetRequiredSubstitution as e:
-        raise ConfigurationError(
-            'Missing mandatory value for "{config_key}" option in {section} "{name}": {err}'.format(
-                config_key=config_key,
-                name=name,
-                section=section,
-                err=e.err
+    def compile_value(self, name, config_key, value):
+        try:
+            return self.compile_obj(
+                value, (name, config_key), get_config_path(config_key, self.section, name),
+                name, config_key)
+        except InvalidInterpolation as e:
+            raise ConfigurationError(
+                'Invalid interpolation format for "{config_key}" option '
+                'in {section} "{name}": "{string}"'.format(
+                    config_key=config_key,
+                    name=name,
+                    section=self.section,
+                    string=e.string))
+
+    def compile_obj(self, obj, path, config_path, name, config_key):
+        if isinstance(obj, six.string_types):
+            template = CompiledTemplate(obj)
+            if template.is_static():
+                return converter.convert(config_path, template.static_value())
+            self.slots.append((path, config_path, name, config_key, template))
+            return None
+        if isinstance(obj, dict):
+            return dict(
+                (key, self.compile_obj(
+                    val, path + (key,), '{}/{}'.format(config_path, key), name, config_key))
+                for (key, val) in obj.items()
             )
-        )
-
+        if isinstance(obj, list):
+            return [
+                self.compile_obj(val, path + (i,), config_path, name, config_key)
+                for i, val in enumerate(obj)
+            ]
+        return converter.convert(config_path, obj)
+
+    def apply(self, environment):
+        """The section interpolated with `environment`."""
+        result = copy_containers(self.static)
+        for path, config_path, name, config_key, template in self.slots:
+            try:
+                value = template.substitute(environment)
+            except UnsetRequiredSubstitution as e:
+                raise ConfigurationError(
+                    'Missing mandatory value for "{config_key}" option in {section} "{name}": '
+                    '{err}'.format(
+                        config_key=config_key,
+                        name=name,
+                        section=self.section,
+                        err=e.err
+                    )
+                )
+            container = result
+            for key in path[:-1]:
+                container = container[key]
+            container[path[-1]] = converter.convert(config_path, value)
+        return result
 
-def recursive_interpolate(obj, interpolator, config_path):
-    def append(config_path, key):
-        return '{}/{}'.format(config_path, key)
 
-    if isinstance(obj, six.string_types):
-        return converter.convert(config_path, interpolator.interpolate(obj))
+def copy_containers(obj):
     if isinstance(obj, dict):
-        return dict(
-            (key, recursive_interpolate(val, interpolator, append(config_path, key)))
-            for (key, val) in obj.items()
-        )
+        return dict((key, copy_containers(val)) for key, val in obj.items())
     if isinstance(obj, list):
-        return [recursive_interpolate(val, interpolator, config_path) for val in obj]
-    return converter.convert(config_path, obj)
+        return [copy_containers(val) for val in obj]
+    return obj
+
+
+def get_config_path(config_key, section, name):
+    return '{}/{}/{}'.format(section, name, config_key)
 
 
 class TemplateWithDefaults(Template):
@@ -165,6 +216,54 @@ class TemplateWithDefaults(Template):
         return self.pattern.sub(convert, self.template)
 
 
+class CompiledTemplate(object):
+    """
+    A string parsed with the pattern of TemplateWithDefaults, substituted
+    without matching it again.
+    """
+
+    def __init__(self, string):
+        self.string = string
+        # Literal strings, and (named, braced, sep) for each substitution
+        self.parts = []
+        position = 0
+        for mo in TemplateWithDefaults.pattern.finditer(string):
+            self.parts.append(string[position:mo.start()])
+            position = mo.end()
+            if mo.group('escaped') is not None:
+                self.parts.append(TemplateWithDefaults.delimiter)
+            elif mo.group('named') is not None or mo.group('braced') is not None:
+                self.parts.append((
+                    mo.group('named') or mo.group('braced'),
+                    mo.group('braced'),
+                    mo.group('sep')))
+            else:
+                raise InvalidInterpolation(string)
+        self.parts.append(string[position:])
+
+    def is_static(self):
+        return all(isinstance(part, six.string_types) for part in self.parts)
+
+    def static_value(self):
+        return ''.join(self.parts)
+
+    def substitute(self, mapping):
+        result = []
+        for part in self.parts:
+            if isinstance(part, six.string_types):
+                result.append(part)
+                continue
+            named, braced, sep = part
+            if braced is not None and sep:
+                result.append(TemplateWithDefaults.process_braced_group(braced, sep, mapping))
+                continue
+            val = mapping[named]
+            if isinstance(val, six.binary_type):
+                val = val.decode('utf-8')
+            result.append('%s' % (val,))
+        return ''.join(result)
+
+
 class InvalidInterpolation(Exception):
     def __init__(self, string):
         self.string = string
@@ -295,18 +394,28 @@ class ConversionMap(object):
         re_path('config', PATH_JOKER, 'labels', FULL_JOKER): to_str,
     }
 
+    def __init__(self):
+        # The conversion of every path looked up, None for no conversion
+        self.conversions = {}
+
+    def get_conversion(self, path):
+        if path not in self.conversions:
+            self.conversions[path] = next(
+                (self.map[rexp] for rexp in self.map.keys() if rexp.match(path)), None)
+        return self.conversions[path]
+
     def convert(self, path, value):
-        for rexp in self.map.keys():
-            if rexp.match(path):
-                try:
-                    return self.map[rexp](value)
-                except ValueError as e:
-                    raise ConfigurationError(
-                        'Error while attempting to convert {} to appropriate type: {}'.format(
-                            path.replace('/', '.'), e
-                        )
-                    )
-        return value
+        conversion = self.get_conversion(path)
+        if conversion is None:
+            return value
+        try:
+            return conversion(value)
+        except ValueError as e:
+            raise ConfigurationError(
+                'Error while attempting to convert {} to appropriate type: {}'.format(
+                    path.replace('/', '.'), e
+                )
+            )
 
 
 converter = ConversionMap()
@@ -139,10 +139,7 @@ def denormalize_service_dict(service_dict, version, image_digest=None):
             service_dict['restart']
         )
 
-    if 'depends_on' in service_dict and (version < V2_1 or version >= V3_0):
-        service_dict['depends_on'] = sorted([
-            svc for svc in service_dict['depends_on'].keys()
-        ])
+    # depends_on keeps its conditions, angelo files support them
 
     if 'healthcheck' in service_dict:
         if 'interval' in service_dict['healthcheck']:
@@ -160,11 +157,8 @@ def denormalize_service_dict(service_dict, version, image_digest=None):
             )
 
     if 'ports' in service_dict:
-        service_dict['ports'] = [
-            p.legacy_repr() if p.external_ip or version < V3_2 else p
-            for p in service_dict['ports']
-        ]
-    if 'volumes' in service_dict and (version < V2_3 or (version > V3_0 and version < V3_2)):
+        service_dict['ports'] = [p.legacy_repr() for p in service_dict['ports']]
+    if 'volumes' in service_dict:
         service_dict['volumes'] = [
             v.legacy_repr() if isinstance(v, types.MountSpec) else v for v in service_dict['volumes']
         ]
@@ -49,41 +49,83 @@ def get_service_names_from_volumes_from(volumes_from):
     return [volume_from.source for volume_from in volumes_from]
 
 
+def get_service_dependencies(service_dict):
+    """The names of the services `service_dict` links to, shares the pid of or depends on."""
+    names = get_service_names(service_dict.get('links', []))
+    pid_service = get_service_name_from_network_mode(service_dict.get('pid'))
+    if pid_service:
+        names.append(pid_service)
+    names.extend(service_dict.get('depends_on', []))
+    return names
+
+
 def get_service_dependents(service_dict, services):
     name = service_dict['name']
     return [
         service for service in services
-        if (name in get_service_names(service.get('links', [])) or
-            name == get_service_name_from_network_mode(service.get('pid')) or
-            name in service.get('depends_on', []))
+        if name in get_service_dependencies(service)
     ]
 
 
+def get_dependents_index(services):
+    """The dependents of every service by name, in the order of `services`."""
+    dependents = {}
+    for service in services:
+        for name in set(get_service_dependencies(service)):
+            dependents.setdefault(name, []).append(service)
+    return dependents
+
+
+def check_dependency_cycle(path):
+    """Raise a DependencyError for `path`, a list of service dicts each depending on the next."""
+    n = path[0]
+    if len(path) == 2:
+        if n['name'] in get_service_names(n.get('links', [])):
+            raise DependencyError('A service can not link to itself: %s' % n['name'])
+        if n['name'] in n.get('volumes_from', []):
+            raise DependencyError('A service can not mount itself as volume: %s' % n['name'])
+        if n['name'] in n.get('depends_on', []):
+            raise DependencyError('A service can not depend on itself: %s' % n['name'])
+    raise DependencyError('Circular dependency:\n  %s' % '\n  depends on '.join(
+        service['name'] for service in path))
+
+
 def sort_service_dicts(services):
-    # Topological sort (Cormen/Tarjan algorithm).
-    unmarked = services[:]
-    temporary_marked = set()
+    """
+    Sort services so that every service comes after those it depends on.
+
+    A depth-first topological sort (Cormen/Tarjan algorithm) over an index
+    of the dependents of each service, O(services + dependencies). The
+    order is the same as visiting services from the last one.
+    """
+    dependents = get_dependents_index(services)
+    # 1: on the path being visited, 2: sorted
+    marks = {}
     sorted_services = []
 
-    def visit(n):
-        if n['name'] in temporary_marked:
-            if n['name'] in get_service_names(n.get('links', [])):
-                raise DependencyError('A service can not link to itself: %s' % n['name'])
-            if n['name'] in n.get('volumes_from', []):
-                raise DependencyError('A service can not mount itself as volume: %s' % n['name'])
-            if n['name'] in n.get('depends_on', []):
-                raise DependencyError('A service can not depend on itself: %s' % n['name'])
-            raise DependencyError('Circular dependency between %s' % ' and '.join(temporary_marked))
-
-        if n in unmarked:
-            temporary_marked.add(n['name'])
-            for m in get_service_dependents(n, services):
-                visit(m)
-            temporary_marked.remove(n['name'])
-            unmarked.remove(n)
-            sorted_services.insert(0, n)
-
-    while unmarked:
-        visit(unmarked[-1])
-
+    for root in reversed(services):
+        if root['name'] in marks:
+            continue
+        marks[root['name']] = 1
+        path = [root]
+        stack = [iter(dependents.get(root['name'], ()))]
+        while stack:
+            n = next(stack[-1], None)
+            if n is None:
+                stack.pop()
+                done = path.pop()
+                marks[done['name']] = 2
+                sorted_services.append(done)
+                continue
+            mark = marks.get(n['name'])
+            if mark == 1:
+                start = next(i for i, m in enumerate(path) if m['name'] == n['name'])
+                # Reversed, each service depends on the next one
+                check_dependency_cycle(list(reversed(path[start:] + [n])))
+            if mark is None:
+                marks[n['name']] = 1
+                path.append(n)
+                stack.append(iter(dependents.get(n['name'], ())))
+
+    sorted_services.reverse()
     return sorted_services
@@ -34,6 +34,7 @@ from jsonschema import ValidationError
 
 from ..const import ANGELOFILE_V1_0 as V1
 from ..const import NANOCPUS_SCALE
+from ..utils import json_hash
 from .errors import ConfigurationError
 from .errors import VERSION_EXPLANATION
 from .sort_services import get_service_name_from_network_mode
@@ -41,6 +42,12 @@ from .sort_services import get_service_name_from_network_mode
 
 log = logging.getLogger(__name__)
 
+# The schemas by filename and their validators, loaded once per process
+_schemas = {}
+_validators = {}
+# Hashes of the config files found valid, with the id of their schema
+_validated = set()
+
 
 DOCKER_CONFIG_HINTS = {
     'cpu_share': 'cpu_shares',
@@ -445,18 +452,16 @@ def process_config_schema_errors(error):
 
 
 def validate_against_config_schema(config_file):
-    return
-    # skipped
-    # schema = load_jsonschema(config_file)
-    # format_checker = FormatChecker(["ports", "expose", "subnet_ip_address"])
-    # validator = Draft4Validator(
-    #     schema,
-    #     resolver=RefResolver(get_resolver_path(), schema),
-    #     format_checker=format_checker)
-    # handle_errors(
-    #     validator.iter_errors(config_file.config),
-    #     process_config_schema_errors,
-    #     config_file.filename)
+    schema = load_jsonschema(config_file)
+    # Validating the same content against the same schema gives the same result
+    key = json_hash([schema['id'], config_file.config])
+    if key in _validated:
+        return
+    handle_errors(
+        get_validator(schema).iter_errors(config_file.config),
+        process_config_schema_errors,
+        config_file.filename)
+    _validated.add(key)
 
 
 def validate_service_constraints(config, service_name, config_file):
@@ -465,7 +470,7 @@ def validate_service_constraints(config, service_name, config_file):
             errors, service_name, config_file.version)
 
     schema = load_jsonschema(config_file)
-    validator = Draft4Validator(schema['definitions']['constraints']['service'])
+    validator = get_validator(schema, 'definitions', 'constraints', 'service')
     handle_errors(validator.iter_errors(config), handler, None)
 
 
@@ -488,13 +493,36 @@ def load_jsonschema(config_file):
         get_schema_path(),
         "config_schema_v{0}.json".format(config_file.version))
 
-    if not os.path.exists(filename):
-        raise ConfigurationError(
-            'Version in "{}" is unsupported. {}'
-            .format(config_file.filename, VERSION_EXPLANATION))
+    if filename not in _schemas:
+        if not os.path.exists(filename):
+            raise ConfigurationError(
+                'Version in "{}" is unsupported. {}'
+                .format(config_file.filename, VERSION_EXPLANATION))
 
-    with open(filename, "r") as fh:
-        return json.load(fh)
+        with open(filename, "r") as fh:
+            _schemas[filename] = json.load(fh)
+    return _schemas[filename]
+
+
+def get_validator(schema, *path):
+    """
+    The validator of the subschema of `schema` at `path`, created once per
+    process: jsonschema builds its resolver and caches the $refs it follows
+    in the validator.
+    """
+    key = (schema['id'],) + path
+    if key not in _validators:
+        subschema = schema
+        for name in path:
+            subschema = subschema[name]
+        # Found in the store, $refs to the schema don't read it again
+        resolver = RefResolver(get_resolver_path(), schema,
+                               store={get_resolver_path() + schema['id']: schema})
+        _validators[key] = Draft4Validator(
+            subschema,
+            resolver=resolver,
+            format_checker=FormatChecker(["ports", "expose", "subnet_ip_address"]))
+    return _validators[key]
 
 
 def get_resolver_path():
@@ -1,22 +1,155 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import os, base64, configparser, yaml
+import os, base64, configparser, hashlib, logging, threading, yaml
+from collections import namedtuple
+
+from .config.cache import file_unchanged
+from .config.interpolation import to_boolean, to_float, to_int, to_str
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot(namedtuple('_Snapshot', 'fingerprint config env')):
+    """
+    angelo.yml as parsed once, `env` being its env section. `fingerprint`
+    tells whether the file changed since, see file_unchanged().
+    """
+
+
+def read_snapshot(conf_path):
+    with open(conf_path, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    config = yaml.safe_load(data)
+    env = config.get('env') if isinstance(config, dict) else None
+    fingerprint = (conf_path, len(data), mtime, hashlib.sha256(data).hexdigest())
+    return Snapshot(fingerprint, config, env if isinstance(env, dict) else {})
+
+
+class SharedConfig(object):
+    """The snapshot of a file and the callbacks of all its UserConfigs."""
+
+    def __init__(self, conf_path):
+        self.conf_path = conf_path
+        self.snapshot = None
+        self.listeners = []
+        self.watcher = None
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        """Read the file again if it changed, and call back on changed env values."""
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is not None and file_unchanged(snapshot.fingerprint):
+                return snapshot
+            new = read_snapshot(self.conf_path)
+            self.snapshot = new
+            if snapshot is None:
+                return new
+            changed = [
+                key for key in set(snapshot.env) | set(new.env)
+                if snapshot.env.get(key) != new.env.get(key)
+            ]
+            callbacks = [(key, callback) for _, key, callback in self.listeners if key in changed]
+
+        for key, callback in callbacks:
+            try:
+                callback(key, new.env.get(key))
+            except Exception:
+                log.exception('Config callback for {} failed'.format(key))
+        return new
+
+    def apply_changes(self):
+        # Called by the watcher: a file being replaced or an invalid one
+        # leaves the values as they were
+        try:
+            self.refresh()
+        except (IOError, yaml.YAMLError) as e:
+            log.warning('Keeping the values of {}: {}'.format(self.conf_path, e))
+
+    def subscribe(self, user_config, key, callback):
+        with self.lock:
+            self.listeners.append((user_config, key, callback))
+            if self.watcher is None:
+                from .watcher import ConfigWatcher
+                self.watcher = ConfigWatcher([self.conf_path], self.apply_changes)
+                self.watcher.start()
+
+    def unsubscribe(self, user_config):
+        with self.lock:
+            self.listeners = [l for l in self.listeners if l[0] is not user_config]
+            watcher = self.watcher if not self.listeners else None
+            if watcher is not None:
+                self.watcher = None
+        if watcher is not None:
+            watcher.stop()
+
+
+_shared_configs = {}
+_shared_configs_lock = threading.Lock()
+
+
+def get_shared_config(conf_path):
+    conf_path = os.path.abspath(conf_path)
+    with _shared_configs_lock:
+        if conf_path not in _shared_configs:
+            _shared_configs[conf_path] = SharedConfig(conf_path)
+        return _shared_configs[conf_path]
+
 
 class UserConfig:
+    """
+    angelo.yml, parsed once and shared by every UserConfig of the file.
 
-    def __init__(self):
-        self.conf_path = 'angelo.yml'
-        self.config = self.__read_conf(self.conf_path)
+    The values of its `env` section are read with get() and the typed
+    get_bool(), get_int(), get_float() and get_str(), which don't read the
+    file. on_change() calls a function with the key and its new value when
+    a value changes, from a thread watching the file that the first
+    callback starts; the values read are then kept up to date too.
+    Otherwise reload() reads the file again, if it changed.
+    """
 
-    def __read_conf(self, conf_path):
-        with open(conf_path, 'r') as f:
-            config = f.read()
-            encoded_config = yaml.safe_load(config.encode('utf-8'))
-            return encoded_config 
+    def __init__(self, conf_path='angelo.yml'):
+        self.conf_path = conf_path
+        self.shared = get_shared_config(conf_path)
+        self.shared.refresh()
+
+    @property
+    def config(self):
+        return self.shared.snapshot.config
 
     def reload(self):
-        self.config = self.__read_conf(self.conf_path)
+        self.shared.refresh()
+
+    def get(self, key, default=None):
+        value = self.shared.snapshot.env.get(key)
+        return default if value is None else value
+
+    def get_bool(self, key, default=False):
+        value = self.get(key)
+        return default if value is None else bool(to_boolean(value))
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else int(to_int(value))
+
+    def get_float(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else float(to_float(value))
+
+    def get_str(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else to_str(value)
+
+    def on_change(self, key, callback):
+        """Call `callback(key, value)` when the value of `key` changes."""
+        self.shared.subscribe(self, key, callback)
+
+    def close(self):
+        """Remove the callbacks of this UserConfig, the last one stops the watcher."""
+        self.shared.unsubscribe(self)
+
 
 class SystemConfig:
 
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+Detection of services that keep crashing.
+
+supervisord restarts a process that exits unexpectedly right away, so a
+service that crashes shortly after starting is respawned forever. The MQTT
+daemon polls supervisord and, once a service exited `restarts` times within
+`window` seconds, stops it, publishes a `service_crashloop` event and starts
+it again after a delay that doubles with every further crash loop.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import time
+from collections import deque
+from collections import namedtuple
+
+from .configuration import UserConfig
+from .errors import OperationFailedError
+from .logstore import get_log_options
+from .logstore import LogStore
+from .metrics import parse_interval
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1
+DEFAULT_RESTARTS = 5
+DEFAULT_WINDOW = 60
+DEFAULT_BACKOFF = 10
+DEFAULT_MAX_BACKOFF = 600
+DEFAULT_LOG_LINES = 20
+
+EVENT_TYPE = 'service_crashloop'
+
+RUNNING_STATES = ('STARTING', 'RUNNING', 'BACKOFF')
+# States supervisord leaves a process in until it is started again
+HELD_STATES = ('STOPPED', 'FATAL')
+
+
+class CrashLoopOptions(namedtuple('_CrashLoopOptions',
+                                  'enabled interval restarts window backoff max_backoff log_lines')):
+    """
+    :param enabled: whether the daemon watches for crash loops at all
+    :param interval: seconds between two polls of supervisord
+    :param restarts: exits within `window` after which a service is in a crash loop
+    :param window: seconds over which exits are counted
+    :param backoff: seconds a service is held stopped after its first crash loop
+    :param max_backoff: the longest a service is held stopped
+    :param log_lines: lines of output sent with the event
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            bool(options.get('enabled', True)),
+            parse_interval(options.get('interval'), DEFAULT_INTERVAL),
+            int(options.get('restarts', DEFAULT_RESTARTS)),
+            parse_interval(options.get('window'), DEFAULT_WINDOW),
+            parse_interval(options.get('backoff'), DEFAULT_BACKOFF),
+            parse_interval(options.get('max_backoff'), DEFAULT_MAX_BACKOFF),
+            int(options.get('log_lines', DEFAULT_LOG_LINES)),
+        )
+
+
+def get_crashloop_options():
+    """Read the `crashloop` section of angelo.yml."""
+    try:
+        user_config = UserConfig().config or {}
+    except IOError:
+        user_config = {}
+    return CrashLoopOptions.from_dict(user_config.get('crashloop'))
+
+
+class ProcessHistory(object):
+    """What the watcher remembers about a process between two polls."""
+
+    def __init__(self, info):
+        self.last_stop = info['stop']
+        # (time, exit status or None when the process was respawned unseen)
+        self.exits = deque()
+        # Crash loops since the process last ran for a whole window
+        self.level = 0
+        self.held_until = None
+        self.held_stop = None
+
+
+class CrashLoopWatcher(object):
+    """
+    Poll supervisord for processes that keep exiting, and hold them stopped
+    with an exponential backoff.
+
+    :param supervisor: the :class:`angelo.supervisor.Supervisor`
+    :param publish_event: called with (data, type) when a crash loop is detected
+    :param store: the :class:`angelo.logstore.LogStore` the last lines are read from
+    """
+
+    def __init__(self, supervisor, publish_event, options, store=None, clock=time.time):
+        self.supervisor = supervisor
+        self.publish_event = publish_event
+        self.options = options
+        self.store = store
+        self.clock = clock
+        self.processes = {}
+
+    def poll(self):
+        try:
+            infos = self.supervisor.get_all_process_info()
+        except OperationFailedError as e:
+            log.debug('Not watching for crash loops: {}'.format(e.msg))
+            return
+        now = self.clock()
+        for info in infos:
+            try:
+                self.update(info, now)
+            except OperationFailedError as e:
+                log.error('Crash loop backoff of {} failed: {}'.format(info['name'], e.msg))
+
+    def update(self, info, now):
+        # Instances of scaled services are only known by group:name
+        name = '{}:{}'.format(info['group'], info['name'])
+        history = self.processes.get(name)
+        if history is None:
+            self.processes[name] = ProcessHistory(info)
+            return
+
+        if history.held_until is not None:
+            self.hold(name, info, history, now)
+            return
+
+        # Processes stopped on request are not crashing
+        if info['stop'] != history.last_stop and info['statename'] not in ('STOPPED', 'STOPPING'):
+            # supervisord only keeps the exit status until it respawns the process
+            status = info['exitstatus'] if info['statename'] == 'EXITED' else None
+            history.exits.append((now, status))
+        history.last_stop = info['stop']
+
+        while history.exits and history.exits[0][0] <= now - self.options.window:
+            history.exits.popleft()
+        if (info['statename'] == 'RUNNING' and not history.exits and
+                info['start'] <= now - self.options.window):
+            history.level = 0
+
+        # After a crash loop, a single crash is enough to back off further
+        threshold = self.options.restarts if history.level == 0 else 1
+        if len(history.exits) >= threshold:
+            self.back_off(name, info, history, now)
+
+    def back_off(self, name, info, history, now):
+        delay = min(self.options.backoff * 2 ** history.level, self.options.max_backoff)
+        history.level += 1
+        history.held_until = now + delay
+        exit_codes = [status for _, status in history.exits if status is not None]
+        restarts = len(history.exits)
+        history.exits.clear()
+
+        log.warning('{} exited {} times in {}s, restarting it in {}s'.format(
+            name, restarts, self.options.window, delay))
+        self.publish_event({
+            'service': info['group'],
+            'process': info['name'],
+            'restarts': restarts,
+            'exit_codes': exit_codes,
+            'backoff': delay,
+            'logs': self.last_lines(info['name']),
+        }, EVENT_TYPE)
+        self.hold(name, info, history, now)
+
+    def hold(self, name, info, history, now):
+        """Keep a backed off process stopped, and start it once its delay is over."""
+        state = info['statename']
+        if history.held_stop is None:
+            if state in HELD_STATES:
+                history.held_stop = info['stop']
+            elif state in RUNNING_STATES:
+                # Including a process supervisord respawned since it exited
+                self.supervisor.stop_processes([name], wait=False)
+        elif state in RUNNING_STATES:
+            # Started by hand in the meantime
+            self.release(info, history)
+            return
+
+        if now < history.held_until:
+            return
+        if history.held_stop is not None and info['stop'] == history.held_stop:
+            log.info('Restarting {} after crash loop backoff'.format(name))
+            self.supervisor.start_processes([name], wait=False)
+        self.release(info, history)
+
+    def release(self, info, history):
+        history.held_until = None
+        history.held_stop = None
+        history.last_stop = info['stop']
+
+    def last_lines(self, name):
+        if self.store is None:
+            return []
+        try:
+            return [record.line for record in
+                    self.store.get(name).read(tail=self.options.log_lines)]
+        except (IOError, OSError) as e:
+            log.debug('Could not read the logs of {}: {}'.format(name, e))
+            return []
+
+
+def create_crashloop_watcher(options, publish_event, supervisor):
+    return CrashLoopWatcher(supervisor, publish_event, options, LogStore(get_log_options()))
@@ -36,9 +36,9 @@ class HealthCheckException(Exception):
 
 
 class HealthCheckFailed(HealthCheckException):
-    def __init__(self, container_id):
+    def __init__(self, service_name):
         super(HealthCheckFailed, self).__init__(
-            'Container "{}" is unhealthy.'.format(container_id)
+            'Service "{}" is unhealthy.'.format(service_name)
         )
 
 
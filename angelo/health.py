@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+import six
+from six.moves.urllib.request import urlopen
+
+from .errors import HealthCheckFailed
+from .errors import NoHealthCheckConfigured
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1
+DEFAULT_TIMEOUT = 1
+DEFAULT_RETRIES = 3
+
+STARTING = 'starting'
+HEALTHY = 'healthy'
+UNHEALTHY = 'unhealthy'
+
+NANOSECONDS = 1e9
+
+
+class TcpProbe(namedtuple('_TcpProbe', 'host port')):
+    """Healthy when a TCP connection to host:port is accepted."""
+
+    @classmethod
+    def parse(cls, value):
+        host, _, port = six.text_type(value).rpartition(':')
+        return cls(host or 'localhost', int(port))
+
+    def check(self, timeout):
+        socket.create_connection((self.host, self.port), timeout).close()
+
+    def __str__(self):
+        return 'tcp {}:{}'.format(self.host, self.port)
+
+
+class HttpProbe(namedtuple('_HttpProbe', 'url')):
+    """Healthy when a GET of the url answers with a status below 400."""
+
+    @classmethod
+    def parse(cls, value):
+        if value.startswith('/') or value[:1].isdigit():
+            value = 'http://localhost' + (':' if value[:1].isdigit() else '') + value
+        return cls(value)
+
+    def check(self, timeout):
+        # urlopen raises HTTPError for 4xx and 5xx responses
+        urlopen(self.url, timeout=timeout).close()
+
+    def __str__(self):
+        return 'http {}'.format(self.url)
+
+
+class ExecProbe(namedtuple('_ExecProbe', 'command shell')):
+    """Healthy when the command exits with status 0."""
+
+    @classmethod
+    def parse(cls, test):
+        if isinstance(test, six.string_types):
+            return cls(test, True)
+        if test[0] == 'CMD-SHELL':
+            return cls(' '.join(test[1:]), True)
+        return cls(list(test[1:]), False)
+
+    def check(self, timeout):
+        with open(os.devnull, 'wb') as devnull:
+            returncode = subprocess.call(self.command, shell=self.shell, timeout=timeout,
+                                         stdout=devnull, stderr=devnull)
+        if returncode != 0:
+            raise OSError('exited with status {}'.format(returncode))
+
+    def __str__(self):
+        return 'exec {}'.format(self.command)
+
+
+class Healthcheck(namedtuple('_Healthcheck', 'probe interval timeout retries start_period')):
+    """
+    The readiness probe of a service, from its `healthcheck` section:
+
+        healthcheck:
+          tcp: 8080                  # or http: /ready, or test: [CMD, ...]
+          interval: 1s
+          timeout: 1s
+          retries: 3
+          start_period: 10s
+
+    Durations are in seconds.
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        """Return the healthcheck described by `options`, or None if there is none."""
+        options = options or {}
+        if 'tcp' in options:
+            probe = TcpProbe.parse(options['tcp'])
+        elif 'http' in options:
+            probe = HttpProbe.parse(options['http'])
+        elif options.get('test') and options['test'] != ['NONE']:
+            probe = ExecProbe.parse(options['test'])
+        else:
+            return None
+        return cls(
+            probe,
+            seconds(options.get('interval'), DEFAULT_INTERVAL),
+            seconds(options.get('timeout'), DEFAULT_TIMEOUT),
+            int(options.get('retries', DEFAULT_RETRIES)),
+            seconds(options.get('start_period'), 0),
+        )
+
+    def check(self):
+        """Run the probe once. Returns True if it passed."""
+        try:
+            self.probe.check(self.timeout)
+        except Exception as e:
+            log.debug('{} failed: {}'.format(self.probe, e))
+            return False
+        return True
+
+
+def seconds(value, default):
+    # config.process_healthcheck turns durations into nanoseconds
+    if value is None:
+        return default
+    return value / NANOSECONDS
+
+
+class ProbeRunner(object):
+    """
+    Run a healthcheck every `interval` in a background thread.
+
+    The status is `starting` until the probe first passes and becomes
+    `unhealthy` once it failed `retries` times in a row, not counting
+    failures during `start_period`.
+    """
+
+    def __init__(self, healthcheck):
+        self.healthcheck = healthcheck
+        self.status = STARTING
+        self.failures = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.update(self.healthcheck.check(), time.time())
+            self.stopped.wait(self.healthcheck.interval)
+
+    def update(self, passed, now):
+        if passed:
+            self.failures = 0
+            self.status = HEALTHY
+        elif now - self.started_at >= self.healthcheck.start_period:
+            self.failures += 1
+            if self.failures >= self.healthcheck.retries:
+                self.status = UNHEALTHY
+
+    def stop(self):
+        self.stopped.set()
+
+
+class HealthMonitor(object):
+    """
+    Keep a ProbeRunner per service, to gate the start of services that
+    depend on another one with `condition: service_healthy`.
+    """
+
+    def __init__(self):
+        self.runners = {}
+        self.lock = threading.Lock()
+
+    def watch(self, service):
+        """Start probing `service`, if it has a healthcheck."""
+        healthcheck = Healthcheck.from_dict(service.options.get('healthcheck'))
+        if healthcheck is None:
+            return
+        with self.lock:
+            if service.name in self.runners:
+                self.runners[service.name].stop()
+            runner = self.runners[service.name] = ProbeRunner(healthcheck)
+        runner.start()
+
+    def ready_check(self, service):
+        """
+        A `ready_check` for parallel.parallel_execute: True once the service is
+        healthy, raises HealthCheckFailed once it is unhealthy.
+        """
+        if Healthcheck.from_dict(service.options.get('healthcheck')) is None:
+            raise NoHealthCheckConfigured(service.name)
+        runner = self.runners.get(service.name)
+        if runner is None or runner.status == STARTING:
+            return False
+        if runner.status == UNHEALTHY:
+            raise HealthCheckFailed(service.name)
+        return True
+
+    def check(self, services):
+        """
+        Probe each service once, in parallel. Returns {name: status} for the
+        services that have a healthcheck.
+        """
+        healthchecks = dict(
+            (service.name, Healthcheck.from_dict(service.options.get('healthcheck')))
+            for service in services)
+        statuses = {}
+
+        def check(name, healthcheck):
+            statuses[name] = HEALTHY if healthcheck.check() else UNHEALTHY
+
+        threads = [threading.Thread(target=check, args=(name, healthcheck))
+                   for name, healthcheck in healthchecks.items() if healthcheck is not None]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses
+
+    def stop(self):
+        with self.lock:
+            for runner in self.runners.values():
+                runner.stop()
+            self.runners = {}
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+The command lines of the processes angelo runs Python modules in.
+
+From a Python install a module is run with `python -m`. The angelo binary
+built by PyInstaller can't run modules that way, it runs itself with a
+hidden subcommand instead, which main() of the CLI hands to the module.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import importlib
+import sys
+
+#  The modules run in other processes, and their subcommands in the binary
+INTERNAL_COMMANDS = {
+    'angelo.agent': '__agent',
+    'angelo.limits': '__limits',
+    'angelo.logstore': '__logstore',
+    'supervisor.supervisord': '__supervisord',
+}
+
+
+def module_command(module):
+    """The command line running main() of `module`, before its arguments."""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, INTERNAL_COMMANDS[module]]
+    return [sys.executable, '-m', module]
+
+
+def run_internal_command(argv):
+    """Run the module an internal subcommand names and exit, if `argv` starts with one."""
+    if not argv:
+        return
+    for module, command in INTERNAL_COMMANDS.items():
+        if argv[0] == command:
+            sys.exit(importlib.import_module(module).main(argv[1:]))
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+Resource limits of supervised services.
+
+supervisord can't limit the processes it spawns, so the command of a service
+with limits is prefixed with `python -m angelo.limits <limits> --`, which
+applies them to itself and then execs the service's command. It only imports
+the standard library to keep the start of services fast.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import ctypes
+import errno
+import logging
+import os
+import platform
+import resource
+import sys
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_NAME = 'angelo'
+CPU_PERIOD = 100000
+PROCESS_NUM = '%(process_num)d'
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+# ioprio_set has no wrapper in libc and its number depends on the architecture
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'armv6l': 314,
+    'riscv64': 30,
+}
+
+RLIMITS = {
+    'as': 'RLIMIT_AS',
+    'core': 'RLIMIT_CORE',
+    'cpu': 'RLIMIT_CPU',
+    'data': 'RLIMIT_DATA',
+    'fsize': 'RLIMIT_FSIZE',
+    'locks': 'RLIMIT_LOCKS',
+    'memlock': 'RLIMIT_MEMLOCK',
+    'msgqueue': 'RLIMIT_MSGQUEUE',
+    'nice': 'RLIMIT_NICE',
+    'nofile': 'RLIMIT_NOFILE',
+    'nproc': 'RLIMIT_NPROC',
+    'rss': 'RLIMIT_RSS',
+    'rtprio': 'RLIMIT_RTPRIO',
+    'sigpending': 'RLIMIT_SIGPENDING',
+    'stack': 'RLIMIT_STACK',
+}
+
+
+class ResourceLimits(namedtuple('_ResourceLimits',
+                                'cpus cpuset mem_limit nice ionice ulimits pin_cpus')):
+    """
+    :param cpus: CPU time as a number of CPUs, e.g. 1.5 (cgroup cpu.max)
+    :param cpuset: the CPUs the service may run on, e.g. "0-1,3"
+    :param mem_limit: bytes of memory (cgroup memory.max)
+    :param nice: the nice value, -20 to 19
+    :param ionice: the I/O scheduling (class, level), e.g. ("best-effort", 4)
+    :param ulimits: {name: (soft, hard)} rlimits, e.g. {"nofile": (1024, 2048)}
+    :param pin_cpus: the index of the instance, pinned to the CPU of the same
+                     index in `cpuset` or in the CPUs it may run on, or None
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        """The limits of a processed service dict, or None if it has none."""
+        ionice = options.get('ionice')
+        if isinstance(ionice, dict):
+            ionice = (ionice.get('class', 'best-effort'), ionice.get('level'))
+        elif ionice is not None:
+            ionice = parse_ionice(ionice)
+
+        ulimits = {}
+        for name, value in (options.get('ulimits') or {}).items():
+            if isinstance(value, dict):
+                ulimits[name] = (value['soft'], value['hard'])
+            else:
+                ulimits[name] = (value, value)
+
+        limits = cls(
+            float(options['cpus']) if options.get('cpus') else None,
+            str(options['cpuset']) if options.get('cpuset') is not None else None,
+            options.get('mem_limit'),
+            options.get('nice'),
+            ionice,
+            ulimits,
+            # supervisord replaces it with the index of each instance
+            PROCESS_NUM if options.get('pin_cpus') else None,
+        )
+        if limits == cls(None, None, None, None, None, {}, None):
+            return None
+        return limits
+
+    def args(self, name):
+        """Arguments for `python -m angelo.limits` applying these limits to service `name`."""
+        args = []
+        if self.cpus:
+            args += ['--cpus', str(self.cpus)]
+        if self.cpuset is not None:
+            args += ['--cpuset', self.cpuset]
+        if self.mem_limit:
+            args += ['--memory', str(self.mem_limit)]
+        if self.nice is not None:
+            args += ['--nice', str(self.nice)]
+        if self.ionice is not None:
+            ioclass, level = self.ionice
+            args += ['--ionice', ioclass if level is None else '%s:%s' % (ioclass, level)]
+        for limit, (soft, hard) in sorted(self.ulimits.items()):
+            args += ['--ulimit', '%s=%s:%s' % (limit, soft, hard)]
+        if self.pin_cpus is not None:
+            args += ['--pin-cpus', str(self.pin_cpus)]
+        if self.cpus or self.mem_limit:
+            args += ['--cgroup', name]
+        return args
+
+    def apply(self, name):
+        """Apply the limits to the current process, which children inherit."""
+        if self.pin_cpus is not None:
+            cpus = sorted(parse_cpuset(self.cpuset) if self.cpuset is not None
+                          else os.sched_getaffinity(0))
+            os.sched_setaffinity(0, [cpus[self.pin_cpus % len(cpus)]])
+        elif self.cpuset is not None:
+            os.sched_setaffinity(0, parse_cpuset(self.cpuset))
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self.ionice is not None:
+            set_ioprio(*self.ionice)
+        for limit, (soft, hard) in self.ulimits.items():
+            if limit not in RLIMITS:
+                log.warning('Unknown ulimit {}'.format(limit))
+                continue
+            resource.setrlimit(getattr(resource, RLIMITS[limit]), (soft, hard))
+        if self.cpus or self.mem_limit:
+            set_cgroup_limits(name, self.cpus, self.mem_limit)
+
+
+def parse_ionice(value):
+    ioclass, _, level = str(value).partition(':')
+    return ioclass, int(level) if level else None
+
+
+def parse_cpuset(value):
+    """Parse a cpuset like "0-1,3" into a set of CPU numbers."""
+    cpus = set()
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def set_ioprio(ioclass, level=None):
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        log.warning('ionice is not supported on {}'.format(platform.machine()))
+        return
+    if ioclass == 'idle':
+        level = 0
+    elif level is None:
+        level = 4
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT | level
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def set_cgroup_limits(name, cpus, mem_limit, root=CGROUP_ROOT):
+    """
+    Move the current process to the cgroup v2 angelo/<name> with the given
+    cpu.max and memory.max. Only warns when cgroups v2 isn't available or
+    isn't writable, e.g. when angelo doesn't run as root.
+    """
+    if not os.path.exists(os.path.join(root, 'cgroup.controllers')):
+        log.warning('Not limiting the CPU and memory of {}: cgroup v2 is not mounted on {}'
+                    .format(name, root))
+        return
+    parent = os.path.join(root, CGROUP_NAME)
+    path = os.path.join(parent, name)
+    try:
+        for directory in (parent, path):
+            try:
+                os.mkdir(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Controllers must be enabled in every ancestor, which can't hold
+        # processes themselves except for the root
+        controllers = ' '.join(
+            '+' + controller for controller, value in (('cpu', cpus), ('memory', mem_limit))
+            if value)
+        for directory in (root, parent):
+            write(os.path.join(directory, 'cgroup.subtree_control'), controllers)
+        if cpus:
+            write(os.path.join(path, 'cpu.max'), '%d %d' % (cpus * CPU_PERIOD, CPU_PERIOD))
+        if mem_limit:
+            write(os.path.join(path, 'memory.max'), str(mem_limit))
+        write(os.path.join(path, 'cgroup.procs'), str(os.getpid()))
+    except (IOError, OSError) as e:
+        log.warning('Not limiting the CPU and memory of {}: {}'.format(name, e))
+
+
+def write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m angelo.limits')
+    parser.add_argument('--cpus', type=float)
+    parser.add_argument('--cpuset')
+    parser.add_argument('--memory', type=int)
+    parser.add_argument('--nice', type=int)
+    parser.add_argument('--ionice', type=parse_ionice)
+    parser.add_argument('--ulimit', action='append', default=[])
+    parser.add_argument('--pin-cpus', type=int)
+    parser.add_argument('--cgroup')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.command[:1] == ['--']:
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error('no command given')
+
+    ulimits = {}
+    for ulimit in args.ulimit:
+        limit, _, values = ulimit.partition('=')
+        soft, _, hard = values.partition(':')
+        ulimits[limit] = (int(soft), int(hard or soft))
+    limits = ResourceLimits(args.cpus, args.cpuset, args.memory, args.nice, args.ionice, ulimits,
+                            args.pin_cpus)
+    return limits, args.cgroup, args.command
+
+
+def main(argv=None):
+    logging.basicConfig(format='angelo.limits: %(message)s')
+    limits, name, command = parse_args(sys.argv[1:] if argv is None else argv)
+    limits.apply(name)
+    os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+Timestamped storage of the output of services.
+
+supervisord sends the output of every program to an event listener running
+`python -m angelo.logstore`, which appends it line by line to the logs of the
+service under ~/.angelo/logs/<service>/. The logs are split in segments of a
+bounded size, and each segment has a sparse index of the offset of a line
+every few kilobytes, so that the lines since a point in time or the last lines
+are found without reading whole segments.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import argparse
+import errno
+import logging
+import os
+import re
+import struct
+import sys
+import time
+from collections import namedtuple
+
+from .configuration import UserConfig
+from .utils import parse_bytes
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LOG_PATH = os.path.join(os.path.expanduser("~"), ".angelo", "logs")
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 8
+# Bytes of log between two entries of the index
+INDEX_INTERVAL = 4096
+# Longest partial line kept while waiting for its end
+MAX_LINE = 64 * 1024
+
+# timestamp, offset of the line in the segment
+INDEX_RECORD = struct.Struct('<dQ')
+
+INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9._-]')
+
+
+class LogOptions(namedtuple('_LogOptions', 'path segment_size max_segments')):
+    """
+    :param path: directory holding a directory of segments per service
+    :param segment_size: bytes after which a new segment is started
+    :param max_segments: segments kept per service, older ones are deleted
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            os.path.expanduser(options.get('path', DEFAULT_LOG_PATH)),
+            parse_bytes(options.get('segment_size', DEFAULT_SEGMENT_SIZE)),
+            int(options.get('max_segments', DEFAULT_MAX_SEGMENTS)),
+        )
+
+    def args(self):
+        """Arguments for `python -m angelo.logstore` using these options."""
+        return ['--path', self.path,
+                '--segment-size', str(self.segment_size),
+                '--max-segments', str(self.max_segments)]
+
+
+def get_log_options():
+    """Read the `logs` section of angelo.yml."""
+    try:
+        user_config = UserConfig().config or {}
+    except IOError:
+        user_config = {}
+    return LogOptions.from_dict(user_config.get('logs'))
+
+
+class LogRecord(namedtuple('_LogRecord', 'timestamp line')):
+    pass
+
+
+class Segment(object):
+    """
+    A segment of logs: `<number>.log` holds "<timestamp>\\t<line>\\n" records
+    and `<number>.idx` fixed size (timestamp, offset) records. The first line
+    of a segment is always indexed.
+    """
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.log_path = os.path.join(directory, '%010d.log' % number)
+        self.index_path = os.path.join(directory, '%010d.idx' % number)
+
+    def index(self):
+        """Return (read, count) where read(i) is the i-th (timestamp, offset) entry."""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None, 0
+            raise
+        count = len(data) // INDEX_RECORD.size
+
+        def read(i):
+            return INDEX_RECORD.unpack_from(data, i * INDEX_RECORD.size)
+
+        return read, count
+
+    def first_timestamp(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read(INDEX_RECORD.size)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if len(data) < INDEX_RECORD.size:
+            return None
+        return INDEX_RECORD.unpack(data)[0]
+
+    def offset_before(self, timestamp):
+        """The offset of the last indexed line logged before `timestamp`."""
+        read, count = self.index()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if read(middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return read(low - 1)[1] if low else 0
+
+    def read(self, offset=0, since=None):
+        """Yield the complete records from `offset`, skipping those before `since`."""
+        try:
+            f = open(self.log_path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    # Still being written
+                    return
+                record = parse_record(raw)
+                if record is None or (since is not None and record.timestamp < since):
+                    continue
+                yield record
+
+    def tail(self, lines):
+        """The last `lines` records, read from the end of the segment backwards."""
+        read, count = self.index()
+        back = 1
+        while True:
+            offset = read(count - back)[1] if back <= count else 0
+            records = list(self.read(offset))
+            if len(records) >= lines or offset == 0:
+                return records[-lines:]
+            back *= 2
+
+    def remove(self):
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def parse_record(raw):
+    timestamp, _, line = raw.decode('utf-8', 'replace').partition('\t')
+    try:
+        return LogRecord(float(timestamp), line[:-1])
+    except ValueError:
+        return None
+
+
+class ServiceLog(object):
+    """The segments of a service, from the oldest to the current one."""
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        self.directory = os.path.join(options.path, INVALID_NAME_CHARS.sub('_', name))
+        self.writer = None
+
+    def segments(self):
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return []
+        numbers = sorted(int(f[:-4]) for f in filenames if f.endswith('.log'))
+        return [Segment(self.directory, number) for number in numbers]
+
+    def read(self, since=None, tail=None):
+        """The records logged since `since`, or the last `tail` ones, or all."""
+        segments = self.segments()
+        if tail is not None:
+            records = []
+            for segment in reversed(segments):
+                if len(records) >= tail:
+                    break
+                records = segment.tail(tail - len(records)) + records
+            return [r for r in records if since is None or r.timestamp >= since][-tail:] \
+                if tail else []
+        return list(self.since(segments, since))
+
+    def since(self, segments, since):
+        if since is not None:
+            # The last segment started before `since`, its predecessors are older
+            low, high = 0, len(segments)
+            while low < high:
+                middle = (low + high) // 2
+                first = segments[middle].first_timestamp()
+                if first is not None and first < since:
+                    low = middle + 1
+                else:
+                    high = middle
+            segments = segments[max(low - 1, 0):]
+        for segment in segments:
+            offset = segment.offset_before(since) if since is not None else 0
+            for record in segment.read(offset, since):
+                yield record
+
+    def append(self, timestamp, data):
+        """Append output of the service. A partial last line is kept until it ends."""
+        if self.writer is None:
+            self.writer = SegmentWriter(self)
+        self.writer.append(timestamp, data)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class SegmentWriter(object):
+    """Append records to the current segment of a service, rotating it when full."""
+
+    def __init__(self, service_log):
+        self.service_log = service_log
+        self.options = service_log.options
+        self.partial = b''
+        self.last_timestamp = 0
+        if not os.path.isdir(service_log.directory):
+            os.makedirs(service_log.directory)
+        segments = service_log.segments()
+        self.open(segments[-1] if segments else Segment(service_log.directory, 0))
+
+    def open(self, segment):
+        self.segment = segment
+        self.log_fd = os.open(segment.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index_fd = os.open(segment.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.log_fd).st_size
+        # Resume from the last index entry instead of scanning the segment
+        read, count = segment.index()
+        if count:
+            self.last_timestamp, self.indexed = read(count - 1)
+        else:
+            self.indexed = None
+
+    def rotate(self):
+        self.close()
+        self.open(Segment(self.service_log.directory, self.segment.number + 1))
+        segments = self.service_log.segments()
+        for segment in segments[:-self.options.max_segments]:
+            segment.remove()
+
+    def append(self, timestamp, data):
+        # Lines must be in order to be searched by timestamp
+        timestamp = max(timestamp, self.last_timestamp)
+        self.last_timestamp = timestamp
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE:
+            lines.append(self.partial)
+            self.partial = b''
+        if not lines:
+            return
+
+        prefix = ('%.6f\t' % timestamp).encode('ascii')
+        records = []
+        index = []
+        offset = self.size
+        for line in lines:
+            if self.indexed is None or offset - self.indexed >= INDEX_INTERVAL:
+                index.append(INDEX_RECORD.pack(timestamp, offset))
+                self.indexed = offset
+            record = prefix + line + b'\n'
+            records.append(record)
+            offset += len(record)
+        # The index never points past the data
+        os.write(self.log_fd, b''.join(records))
+        if index:
+            os.write(self.index_fd, b''.join(index))
+        self.size = offset
+        if self.size >= self.options.segment_size:
+            self.rotate()
+
+    def close(self):
+        os.close(self.log_fd)
+        os.close(self.index_fd)
+
+
+class LogStore(object):
+    """The logs of every service."""
+
+    def __init__(self, options=None):
+        self.options = options or LogOptions.from_dict({})
+        self.logs = {}
+
+    def get(self, name):
+        if name not in self.logs:
+            self.logs[name] = ServiceLog(name, self.options)
+        return self.logs[name]
+
+    def append(self, name, timestamp, data):
+        self.get(name).append(timestamp, data)
+
+    def close(self):
+        for service_log in self.logs.values():
+            service_log.close()
+
+
+def parse_headers(line):
+    return dict(token.split(':', 1) for token in line.split())
+
+
+def listen(store, stdin, stdout):
+    """
+    Serve supervisord's event listener protocol, storing PROCESS_LOG events.
+    See http://supervisord.org/events.html
+    """
+    while True:
+        stdout.write(b'READY\n')
+        stdout.flush()
+        line = stdin.readline()
+        if not line:
+            return
+        headers = parse_headers(line.decode('utf-8'))
+        payload = stdin.read(int(headers['len']))
+        if headers['eventname'].startswith('PROCESS_LOG'):
+            header, _, data = payload.partition(b'\n')
+            try:
+                store.append(parse_headers(header.decode('utf-8'))['processname'],
+                             time.time(), data)
+            except (IOError, OSError) as e:
+                # Never reject an event, supervisord would send it again
+                log.error('Failed to store logs: {}'.format(e))
+        stdout.write(b'RESULT 2\nOK')
+        stdout.flush()
+
+
+def main(argv=None):
+    logging.basicConfig(format='angelo.logstore: %(message)s')
+    parser = argparse.ArgumentParser(prog='python -m angelo.logstore')
+    parser.add_argument('--path', default=DEFAULT_LOG_PATH)
+    parser.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE)
+    parser.add_argument('--max-segments', type=int, default=DEFAULT_MAX_SEGMENTS)
+    args = parser.parse_args(argv)
+
+    store = LogStore(LogOptions(args.path, args.segment_size, args.max_segments))
+    try:
+        listen(store, sys.stdin.buffer, sys.stdout.buffer)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,711 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import fnmatch
+import glob
+import logging
+import os
+import time
+from collections import deque
+from collections import namedtuple
+
+import six
+
+from .configuration import UserConfig
+from .timeseries import StoreOptions
+from .timeseries import TimeSeriesStore
+from .utils import parse_seconds_float
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 1
+DEFAULT_PUBLISH_INTERVAL = 10
+DEFAULT_MAX_BATCH = 600
+DEFAULT_MOUNTS = ['/']
+
+SECTOR_SIZE = 512
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+IGNORED_BLOCK_DEVICES = ('loop', 'ram', 'zram')
+IGNORED_INTERFACES = ('lo',)
+
+
+class MetricsOptions(namedtuple('_MetricsOptions', 'enabled interval publish_interval max_batch mounts store deadband')):
+    """
+    :param enabled: whether the daemon collects metrics at all
+    :type  enabled: bool
+    :param interval: seconds between two samples
+    :type  interval: float
+    :param publish_interval: seconds between two published batches
+    :type  publish_interval: float
+    :param max_batch: samples kept in memory while waiting to be published
+    :type  max_batch: int
+    :param mounts: mount points whose disk usage is reported
+    :type  mounts: :class:`list`
+    :param store: where samples are kept on the device
+    :type  store: :class:`angelo.timeseries.StoreOptions`
+    :param deadband: the default rule and the (pattern, rule) pairs used to
+                     filter values before they are published, or None
+    :type  deadband: tuple
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            bool(options.get('enabled', True)),
+            parse_interval(options.get('interval'), DEFAULT_SAMPLE_INTERVAL),
+            parse_interval(options.get('publish_interval'), DEFAULT_PUBLISH_INTERVAL),
+            int(options.get('max_batch', DEFAULT_MAX_BATCH)),
+            list(options.get('mounts', DEFAULT_MOUNTS)),
+            StoreOptions.from_dict(options.get('store')),
+            parse_deadband(options.get('deadband', {})),
+        )
+
+
+class DeadbandRule(namedtuple('_DeadbandRule', 'absolute percent max_silence delta')):
+    """
+    :param absolute: report a value once it moved by more than this amount
+    :param percent: report a value once it moved by more than this percentage
+    :param max_silence: seconds after which a value is reported even if unchanged
+    :param delta: report the series as differences to the last reported value
+    """
+
+    @classmethod
+    def from_dict(cls, options, default):
+        options = options or {}
+        return cls(
+            float(options.get('absolute', default.absolute)),
+            float(options.get('percent', default.percent)),
+            parse_interval(options.get('max_silence'), default.max_silence),
+            bool(options.get('delta', default.delta)),
+        )
+
+    def exceeded(self, last, value):
+        change = abs(value - last)
+        if not self.absolute and not self.percent:
+            return change > 0
+        if self.absolute and change > self.absolute:
+            return True
+        if self.percent:
+            if not last:
+                return change > 0
+            return 100.0 * change / abs(last) > self.percent
+        return False
+
+
+DEFAULT_DEADBAND_RULE = DeadbandRule(absolute=0.0, percent=0.0, max_silence=60, delta=False)
+
+
+def parse_deadband(options):
+    """
+    Parse the `metrics.deadband` section: rule defaults at the top level and
+    per series overrides under `series`, keyed by shell-style patterns.
+    """
+    if options is False:
+        return None
+    options = dict(options or {})
+    series = options.pop('series', None) or {}
+    default = DeadbandRule.from_dict(options, DEFAULT_DEADBAND_RULE)
+    rules = [(pattern, DeadbandRule.from_dict(rule, default))
+             for pattern, rule in sorted(series.items())]
+    return default, rules
+
+
+class DeadbandFilter(object):
+    """
+    Only report values that moved more than their deadband since they were
+    last reported, or that have been silent for longer than `max_silence`.
+
+    Series whose rule sets `delta` are reported as the difference to their
+    last reported value, and absolutely at least every `max_silence` seconds
+    so that a receiver that missed a batch can resynchronize.
+    """
+
+    def __init__(self, default, rules=None):
+        self.default = default
+        self.rules = rules or []
+        self.series_rules = {}
+        self.last = {}
+
+    def rule(self, name):
+        if name not in self.series_rules:
+            self.series_rules[name] = next(
+                (rule for pattern, rule in self.rules if fnmatch.fnmatchcase(name, pattern)),
+                self.default)
+        return self.series_rules[name]
+
+    def filter(self, timestamp, values):
+        """Return the (absolute, deltas) values worth reporting in a sample."""
+        absolute = {}
+        deltas = {}
+        for name, value in values.items():
+            rule = self.rule(name)
+            last = self.last.get(name)
+            if last is None or timestamp - last[2] >= rule.max_silence:
+                absolute[name] = value
+                self.last[name] = (timestamp, value, timestamp)
+                continue
+            sent_at, sent, keyframe_at = last
+            if not rule.exceeded(sent, value) and timestamp - sent_at < rule.max_silence:
+                continue
+            if rule.delta:
+                deltas[name] = value - sent
+            else:
+                absolute[name] = value
+                keyframe_at = timestamp
+            self.last[name] = (timestamp, value, keyframe_at)
+        return absolute, deltas
+
+
+def get_metrics_options():
+    """Read the `metrics` section of angelo.yml."""
+    try:
+        user_config = UserConfig().config or {}
+    except IOError:
+        user_config = {}
+    return MetricsOptions.from_dict(user_config.get('metrics'))
+
+
+def parse_interval(value, default):
+    """Accept either a number of seconds or a duration string such as `10s`."""
+    if value is None:
+        return default
+    if isinstance(value, (six.integer_types, float)):
+        return value
+    seconds = parse_seconds_float(value)
+    if seconds is None:
+        raise ValueError('Invalid metrics interval: "{}"'.format(value))
+    return seconds
+
+
+class ProcFile(object):
+    """A /proc or /sys file that is kept open between reads.
+
+    procfs and sysfs regenerate a file's contents whenever it is read from
+    offset 0, so one descriptor can be reused with pread() instead of paying
+    for open() and close() on every sample.
+    """
+
+    def __init__(self, path, bufsize=4096):
+        self.path = path
+        self.bufsize = bufsize
+        self.fd = None
+
+    def read(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        chunks = []
+        offset = 0
+        while True:
+            chunk = os.pread(self.fd, self.bufsize, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        # Size the buffer after the file so the next read is a single call
+        if offset >= self.bufsize:
+            self.bufsize = offset * 2
+        return b''.join(chunks).decode('utf-8', 'replace')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CounterRates(object):
+    """Turn monotonically increasing counters into per-second rates."""
+
+    def __init__(self):
+        self.previous = {}
+
+    def rate(self, key, value, now):
+        previous = self.previous.get(key)
+        self.previous[key] = (now, value)
+        if previous is None:
+            return None
+        then, last = previous
+        elapsed = now - then
+        # A counter going backwards has wrapped or been reset
+        if elapsed <= 0 or value < last:
+            return None
+        return (value - last) / elapsed
+
+
+class HostMetricsCollector(object):
+    """
+    Sample system resource metrics by parsing /proc and /sys directly.
+
+    Every sample is a flat mapping of series name to value, for example
+    `cpu.percent`, `mem.used_percent` or `net.eth0.rx_bps`. Counters are
+    reported as rates, so the first sample after start up omits them.
+    """
+
+    def __init__(self, proc_root='/proc', sys_root='/sys', mounts=None):
+        self.proc_root = proc_root
+        self.sys_root = sys_root
+        self.mounts = list(DEFAULT_MOUNTS if mounts is None else mounts)
+        self.files = {}
+        self.rates = CounterRates()
+        self.cpu_times = None
+        self.thermal_zones = None
+
+    def proc_file(self, root, *parts):
+        path = os.path.join(root, *parts)
+        if path not in self.files:
+            self.files[path] = ProcFile(path)
+        return self.files[path]
+
+    def collect(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        values = {}
+        for reader in (self.read_cpu,
+                       self.read_memory,
+                       self.read_load,
+                       self.read_disks,
+                       self.read_network,
+                       self.read_thermal,
+                       self.read_mounts):
+            try:
+                reader(values, now)
+            except (IOError, OSError, ValueError, IndexError) as e:
+                log.debug('Failed to collect metrics with {}: {}'.format(reader.__name__, e))
+        return values
+
+    def read_cpu(self, values, now):
+        for line in self.proc_file(self.proc_root, 'stat').read().splitlines():
+            if line.startswith('cpu '):
+                # guest time is already accounted for in user time
+                times = [int(field) for field in line.split()[1:9]]
+                break
+        else:
+            return
+
+        total = sum(times)
+        idle = times[3] + times[4]
+        previous, self.cpu_times = self.cpu_times, (total, idle, times[4])
+        if previous is None or total <= previous[0]:
+            return
+        elapsed = total - previous[0]
+        values['cpu.percent'] = 100.0 * (elapsed - (idle - previous[1])) / elapsed
+        values['cpu.iowait_percent'] = 100.0 * (times[4] - previous[2]) / elapsed
+
+    def read_memory(self, values, now):
+        meminfo = {}
+        for line in self.proc_file(self.proc_root, 'meminfo').read().splitlines():
+            key, _, rest = line.partition(':')
+            fields = rest.split()
+            if fields:
+                meminfo[key] = int(fields[0]) * 1024
+
+        total = meminfo.get('MemTotal')
+        if not total:
+            return
+        available = meminfo.get('MemAvailable')
+        if available is None:
+            available = sum(meminfo.get(k, 0) for k in ('MemFree', 'Buffers', 'Cached'))
+        values['mem.total_bytes'] = total
+        values['mem.available_bytes'] = available
+        values['mem.used_percent'] = 100.0 * (total - available) / total
+
+        swap_total = meminfo.get('SwapTotal')
+        if swap_total:
+            swap_free = meminfo.get('SwapFree', 0)
+            values['swap.used_percent'] = 100.0 * (swap_total - swap_free) / swap_total
+
+    def read_load(self, values, now):
+        fields = self.proc_file(self.proc_root, 'loadavg').read().split()
+        values['load.1m'] = float(fields[0])
+        values['load.5m'] = float(fields[1])
+        values['load.15m'] = float(fields[2])
+
+    def read_disks(self, values, now):
+        for line in self.proc_file(self.proc_root, 'diskstats').read().splitlines():
+            fields = line.split()
+            if len(fields) < 10 or fields[2].startswith(IGNORED_BLOCK_DEVICES):
+                continue
+            name = fields[2]
+            self.set_rate(values, 'disk.{}.read_bps'.format(name), int(fields[5]) * SECTOR_SIZE, now)
+            self.set_rate(values, 'disk.{}.write_bps'.format(name), int(fields[9]) * SECTOR_SIZE, now)
+
+    def read_network(self, values, now):
+        # The first two lines of /proc/net/dev are column headers
+        for line in self.proc_file(self.proc_root, 'net', 'dev').read().splitlines()[2:]:
+            name, _, counters = line.partition(':')
+            name = name.strip()
+            fields = counters.split()
+            if name in IGNORED_INTERFACES or len(fields) < 9:
+                continue
+            self.set_rate(values, 'net.{}.rx_bps'.format(name), int(fields[0]), now)
+            self.set_rate(values, 'net.{}.tx_bps'.format(name), int(fields[8]), now)
+
+    def read_thermal(self, values, now):
+        if self.thermal_zones is None:
+            self.thermal_zones = self.find_thermal_zones()
+        for name, temp_file in self.thermal_zones:
+            try:
+                values['thermal.{}'.format(name)] = int(temp_file.read().strip()) / 1000.0
+            except (IOError, OSError, ValueError):
+                # Some zones (e.g. disabled sensors) refuse to be read
+                continue
+
+    def find_thermal_zones(self):
+        zones = []
+        seen = set()
+        pattern = os.path.join(self.sys_root, 'class', 'thermal', 'thermal_zone*')
+        for zone in sorted(glob.glob(pattern)):
+            try:
+                with open(os.path.join(zone, 'type')) as f:
+                    name = f.read().strip()
+            except (IOError, OSError):
+                name = os.path.basename(zone)
+            if name in seen:
+                name = '{}_{}'.format(name, len(seen))
+            seen.add(name)
+            zones.append((name, ProcFile(os.path.join(zone, 'temp'))))
+        return zones
+
+    def read_mounts(self, values, now):
+        for mount in self.mounts:
+            stat = os.statvfs(mount)
+            used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+            available = stat.f_bavail * stat.f_frsize
+            name = mount.strip('/').replace('/', '_') or 'root'
+            values['fs.{}.free_bytes'.format(name)] = available
+            if used + available:
+                values['fs.{}.used_percent'.format(name)] = 100.0 * used / (used + available)
+
+    def set_rate(self, values, key, counter, now):
+        rate = self.rates.rate(key, counter, now)
+        if rate is not None:
+            values[key] = rate
+
+    def close(self):
+        for proc_file in self.files.values():
+            proc_file.close()
+        for _, temp_file in self.thermal_zones or []:
+            temp_file.close()
+
+
+class ProcessStat(namedtuple('_ProcessStat', 'starttime cpu_ticks rss_bytes threads fds read_bytes write_bytes')):
+    """Counters of a single process, as read from /proc/<pid>."""
+
+
+class ProcessUsage(namedtuple('_ProcessUsage', 'processes cpu_percent rss_bytes threads fds read_bps write_bps')):
+    """
+    Resource usage of a whole process tree. The rate fields are None until
+    the tree has been sampled twice.
+    """
+
+
+class ProcessAccounting(object):
+    """
+    Account CPU, memory, descriptor and I/O usage to services by walking the
+    process tree rooted at the pid supervisord started each service with.
+
+    Rates are computed per process from the previous sample, keyed on pid and
+    start time, so children exiting or pids being reused between two samples
+    never produce negative or inflated rates.
+    """
+
+    def __init__(self, proc_root='/proc'):
+        self.proc_root = proc_root
+        self.files = {}
+        self.previous = {}
+        self.parents = None
+        self.has_children_files = None
+
+    def sample(self, pids, now=None):
+        """
+        Return a mapping of service name to :class:`ProcessUsage` for `pids`,
+        a mapping of service name to root pid, or to the list of root pids of
+        its instances.
+        """
+        if now is None:
+            now = time.monotonic()
+        current = {}
+        usage = {}
+        self.parents = None
+        for name, root_pids in pids.items():
+            tree = ProcessTreeUsage()
+            if not isinstance(root_pids, list):
+                root_pids = [root_pids]
+            for pid in (pid for root_pid in root_pids for pid in self.walk(root_pid)):
+                stat = self.read_process(pid)
+                if stat is None:
+                    continue
+                key = (pid, stat.starttime)
+                current[key] = (now, stat)
+                tree.add(stat, self.previous.get(key), now)
+            usage[name] = tree.usage()
+
+        # Forget processes that exited, along with their open descriptors
+        self.previous = current
+        alive = set(pid for pid, _ in current)
+        for pid in [pid for pid in self.files if pid not in alive]:
+            self.close_process(pid)
+        return usage
+
+    def walk(self, pid):
+        stack = [pid]
+        while stack:
+            pid = stack.pop()
+            yield pid
+            stack.extend(self.children(pid))
+
+    def children(self, pid):
+        if self.has_children_files is False:
+            if self.parents is None:
+                self.parents = self.read_parents()
+            return self.parents.get(pid, [])
+
+        task_dir = os.path.join(self.proc_root, str(pid), 'task')
+        try:
+            tasks = os.listdir(task_dir)
+        except OSError:
+            return []
+        if self.has_children_files is None and tasks:
+            self.has_children_files = os.path.exists(os.path.join(task_dir, tasks[0], 'children'))
+            if not self.has_children_files:
+                return self.children(pid)
+        children = []
+        for tid in tasks:
+            try:
+                content = self.read_file(pid, os.path.join('task', tid, 'children'))
+            except (IOError, OSError):
+                continue
+            children.extend(int(child) for child in content.split())
+        return children
+
+    def read_parents(self):
+        """
+        Map every pid to its children by scanning /proc, for kernels built
+        without /proc/<pid>/task/<tid>/children.
+        """
+        parents = {}
+        for entry in os.listdir(self.proc_root):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.proc_root, entry, 'stat')) as f:
+                    ppid = int(f.read().rpartition(')')[2].split()[1])
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+            parents.setdefault(ppid, []).append(int(entry))
+        return parents
+
+    def read_process(self, pid):
+        try:
+            fields = self.read_file(pid, 'stat').rpartition(')')[2].split()
+        except (IOError, OSError):
+            return None
+        try:
+            io = dict(
+                line.split(':', 1) for line in self.read_file(pid, 'io').splitlines() if ':' in line
+            )
+            read_bytes = int(io['read_bytes'])
+            write_bytes = int(io['write_bytes'])
+        except (IOError, OSError, KeyError, ValueError):
+            # /proc/<pid>/io is only readable by the owner of the process
+            read_bytes = write_bytes = None
+        try:
+            fds = len(os.listdir(os.path.join(self.proc_root, str(pid), 'fd')))
+        except OSError:
+            fds = None
+        return ProcessStat(
+            starttime=int(fields[19]),
+            cpu_ticks=int(fields[11]) + int(fields[12]),
+            rss_bytes=int(fields[21]) * PAGE_SIZE,
+            threads=int(fields[17]),
+            fds=fds,
+            read_bytes=read_bytes,
+            write_bytes=write_bytes,
+        )
+
+    def read_file(self, pid, name):
+        files = self.files.setdefault(pid, {})
+        if name not in files:
+            files[name] = ProcFile(os.path.join(self.proc_root, str(pid), name))
+        try:
+            return files[name].read()
+        except (IOError, OSError):
+            files.pop(name).close()
+            raise
+
+    def close_process(self, pid):
+        for proc_file in self.files.pop(pid, {}).values():
+            proc_file.close()
+
+    def close(self):
+        for pid in list(self.files):
+            self.close_process(pid)
+
+
+class ProcessTreeUsage(object):
+    """Sum the usage of the processes of one tree."""
+
+    def __init__(self):
+        self.processes = 0
+        self.rss_bytes = 0
+        self.threads = 0
+        self.fds = 0
+        self.cpu_percent = None
+        self.read_bps = None
+        self.write_bps = None
+
+    def add(self, stat, previous, now):
+        self.processes += 1
+        self.rss_bytes += stat.rss_bytes
+        self.threads += stat.threads
+        self.fds += stat.fds or 0
+        if previous is None:
+            return
+        then, last = previous
+        elapsed = now - then
+        if elapsed <= 0:
+            return
+        self.cpu_percent = (self.cpu_percent or 0) + \
+            100.0 * (stat.cpu_ticks - last.cpu_ticks) / CLOCK_TICKS / elapsed
+        if stat.read_bytes is not None and last.read_bytes is not None:
+            self.read_bps = (self.read_bps or 0) + (stat.read_bytes - last.read_bytes) / elapsed
+            self.write_bps = (self.write_bps or 0) + (stat.write_bytes - last.write_bytes) / elapsed
+
+    def usage(self):
+        return ProcessUsage(
+            processes=self.processes,
+            cpu_percent=self.cpu_percent,
+            rss_bytes=self.rss_bytes,
+            threads=self.threads,
+            fds=self.fds,
+            read_bps=self.read_bps,
+            write_bps=self.write_bps,
+        )
+
+
+class ServiceMetricsCollector(object):
+    """
+    Report the usage of every supervisor-managed service as
+    `service.<name>.<field>` series. The instances of a scaled service are
+    reported as `service.<instance>.<field>` too, e.g. `service.worker_0.cpu_percent`,
+    and their sum under the name of the service, as `top` shows them.
+
+    :param get_pids: returns a mapping of instance name to (service name, pid)
+    """
+
+    def __init__(self, get_pids, proc_root='/proc'):
+        self.get_pids = get_pids
+        self.accounting = ProcessAccounting(proc_root)
+
+    def collect(self, now=None):
+        try:
+            pids = self.get_pids()
+        except Exception as e:
+            # supervisord is not running (yet), there is nothing to account
+            log.debug('Failed to get service pids: {}'.format(e))
+            return {}
+        usages = self.accounting.sample(dict((name, pid) for name, (_, pid) in pids.items()), now)
+        values = {}
+        totals = {}
+        for name, usage in usages.items():
+            service = pids[name][0]
+            for field, value in usage._asdict().items():
+                if value is None:
+                    continue
+                values['service.{}.{}'.format(name, field)] = value
+                if service != name:
+                    key = 'service.{}.{}'.format(service, field)
+                    totals[key] = totals.get(key, 0) + value
+        values.update(totals)
+        return values
+
+    def close(self):
+        self.accounting.close()
+
+
+class MetricsReporter(object):
+    """
+    Sample a set of collectors and publish the samples in batches.
+
+    Samples wait in a bounded queue between two publishes, so a lost broker
+    connection drops the oldest samples instead of growing without bound.
+    When a store is given every sample is also recorded on the device, and
+    when a deadband filter is given only the values it lets through are
+    published.
+    """
+
+    def __init__(self, collectors, publish, max_batch=DEFAULT_MAX_BATCH, store=None,
+                 deadband=None):
+        self.collectors = list(collectors)
+        self.publish = publish
+        self.batch = deque(maxlen=max_batch)
+        self.store = store
+        self.deadband = deadband
+
+    def sample(self):
+        values = {}
+        for collector in self.collectors:
+            values.update(collector.collect())
+        if not values:
+            return
+        timestamp = time.time()
+        if self.store is not None:
+            try:
+                self.store.append_sample({'timestamp': timestamp, 'metrics': values})
+            except (IOError, OSError) as e:
+                log.error('Failed to record metrics: {}'.format(e))
+        values = dict((k, round(v, 2)) for k, v in values.items())
+        deltas = None
+        if self.deadband is not None:
+            values, deltas = self.deadband.filter(timestamp, values)
+            if not values and not deltas:
+                return
+        sample = {'timestamp': timestamp, 'metrics': values}
+        if deltas:
+            sample['deltas'] = dict((k, round(v, 2)) for k, v in deltas.items())
+        self.batch.append(sample)
+
+    def flush(self):
+        if not self.batch:
+            return
+        samples = list(self.batch)
+        try:
+            self.publish({'samples': samples})
+        except Exception as e:
+            log.error('Failed to publish metrics: {}'.format(e))
+            return
+        self.batch.clear()
+
+    def close(self):
+        for collector in self.collectors:
+            collector.close()
+        if self.store is not None:
+            self.store.close()
+
+
+def create_metrics_reporter(options, publish, supervisor=None):
+    collectors = [HostMetricsCollector(mounts=options.mounts)]
+    if supervisor is not None:
+        collectors.append(ServiceMetricsCollector(supervisor.get_service_pids))
+    store = TimeSeriesStore(options.store) if options.store.enabled else None
+    deadband = DeadbandFilter(*options.deadband) if options.deadband else None
+    return MetricsReporter(collectors, publish, options.max_batch, store, deadband)
@@ -6,11 +6,23 @@ import errno
 import logging
 import schedule
 
+from .crashloop import create_crashloop_watcher
+from .crashloop import get_crashloop_options
+from .metrics import create_metrics_reporter
+from .metrics import get_metrics_options
+from .errors import OperationFailedError
+from .pidctl import DEFAULT_GRACE_PERIOD
+from .pidctl import pid_exists
+from .pidctl import terminate
+
 class daemon:
     """A generic daemon class.
 
     Usage: subclass the daemon class and override the run() method."""
 
+    # Seconds stop() gives the daemon to exit before killing it
+    grace_period = DEFAULT_GRACE_PERIOD
+
     def __init__(self, pidfile, conf):
         self.pidfile = pidfile
         self.conf = conf
@@ -96,20 +108,17 @@ class daemon:
             sys.stderr.write(message.format(self.pidfile))
             return  # not an error in a restart
 
-        # Try killing the daemon process
+        # Terminate the daemon and wait for it to exit
         try:
-            self.delpid()
-            while 1:
-                os.kill(pid, signal.SIGTERM)
-                time.sleep(0.1)
+            terminate(pid, self.grace_period)
+        except OperationFailedError as err:
+            sys.stderr.write(err.msg + '\n')
+            sys.exit(1)
         except OSError as err:
-            e = str(err.args)
-            if e.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
-                print(str(err.args))
-                sys.exit(1)
+            print(str(err.args))
+            sys.exit(1)
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
 
     def restart(self):
         """Restart the daemon."""
@@ -128,17 +137,11 @@ class daemon:
             return False
         # The PID file may still exist even if the daemon isn't running,
         # for example if it has crashed.
-        try:
-            os.kill(pid, 0)
-        except OSError as e:
-            if e.errno == errno.ESRCH:
-                # In this case the PID file shouldn't have existed in
-                # the first place, so we remove it
-                os.remove(self.pidfile)
-                return False
-            # We may also get an exception if we're not allowed to use
-            # kill on the process, but that means that the process does
-            # exist, which is all we care about here.
+        if not pid_exists(pid):
+            # In this case the PID file shouldn't have existed in
+            # the first place, so we remove it
+            os.remove(self.pidfile)
+            return False
         return True
 
     def get_pid(self):
@@ -158,8 +161,10 @@ class MqttClient(daemon):
     Subclass of daemon to run mqtt loop as a background process
     """
 
-    def __init__(self, pidfile, conf):
+    def __init__(self, pidfile, conf, supervisor=None):
         super().__init__(pidfile, conf)
+        self.supervisor = supervisor
+        self.client = None
 
     def initialize_client(self):
         conf_settings = self.read_conf()
@@ -177,30 +182,89 @@ class MqttClient(daemon):
         self.client.connect(broker_host, port=int(broker_port))
         self.client.loop_start()
 
+    def ensure_client(self):
+        """Initialize the client unless it was already, e.g. by the agent serving it."""
+        if self.client is None:
+            self.initialize_client()
+
     def run(self):
         try:
-            logging.debug("Starting MQTT Client...")
-            self.initialize_client()
-            config_channel = '{}/config'.format(self.channel_id)
-            config_sync_channel = '{}/sync'.format(self.channel_id)
-            self.client.loop_start()
-            self.client.subscribe([(config_channel, 1), (config_sync_channel, 1)])
             killer = GracefulKiller()
-            self.publish_presence('connected')
-            self.sync_config(config_channel)
-            schedule.every(5).seconds.do(self.publish_presence, status='connected')
-            while not killer.kill_now:
-                schedule.run_pending()
-                time.sleep(1)
-                pass
-            schedule.clear()
-            self.publish_presence('disconnected')
-            self.client.loop_stop()
-            self.client.disconnect()
+            self.serve(lambda: killer.kill_now)
             self.stop()
         except Exception as e:
             print(e)
 
+    def serve(self, should_stop):
+        """Stay connected and run the scheduled jobs until should_stop() is true."""
+        self.connect()
+        metrics_reporter = self.schedule_metrics()
+        self.schedule_crashloop_watcher()
+        while not should_stop():
+            schedule.run_pending()
+            time.sleep(1)
+        schedule.clear()
+        self.close_metrics(metrics_reporter)
+        self.disconnect()
+
+    def connect(self):
+        """Connect to the broker, and keep the PSYGIG platform told of the device and its config."""
+        logging.debug("Starting MQTT Client...")
+        self.initialize_client()
+        config_channel = '{}/config'.format(self.channel_id)
+        config_sync_channel = '{}/sync'.format(self.channel_id)
+        self.client.subscribe([(config_channel, 1), (config_sync_channel, 1)])
+        self.publish_presence('connected')
+        self.sync_config(config_channel)
+        schedule.every(5).seconds.do(self.publish_presence, status='connected')
+
+    def disconnect(self):
+        self.publish_presence('disconnected')
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def is_connected(self):
+        """Whether the client is connected to the broker."""
+        return self.client is not None and self.client.is_connected()
+
+    def schedule_metrics(self):
+        """
+        Sample system resource metrics and publish them in batches, as
+        configured by the `metrics` section of angelo.yml. Samples are
+        recorded whether or not the client is connected, and only wait for
+        the connection to be published.
+        """
+        options = get_metrics_options()
+        if not options.enabled:
+            return None
+        reporter = create_metrics_reporter(options, self.publish_metrics, self.supervisor)
+        schedule.every(options.interval).seconds.do(reporter.sample)
+        schedule.every(options.publish_interval).seconds.do(self.flush_metrics, reporter)
+        return reporter
+
+    def flush_metrics(self, reporter):
+        if self.is_connected():
+            reporter.flush()
+
+    def close_metrics(self, reporter):
+        if reporter is not None:
+            self.flush_metrics(reporter)
+            reporter.close()
+
+    def schedule_crashloop_watcher(self):
+        """
+        Back off services that keep crashing and publish a `service_crashloop`
+        event for them, as configured by the `crashloop` section of angelo.yml.
+        Services are backed off whether or not the client is connected.
+        """
+        options = get_crashloop_options()
+        if not options.enabled or self.supervisor is None:
+            return None
+        watcher = create_crashloop_watcher(options, self.publish_event_if_connected,
+                                           self.supervisor)
+        schedule.every(options.interval).seconds.do(watcher.poll)
+        return watcher
+
     def publish_presence(self, status):
         presence_channel = '{}/presence'.format(self.channel_id)
         presence_payload = self.default_payload.copy()
@@ -225,12 +289,22 @@ class MqttClient(daemon):
         event_payload['type'] = type
         self.client.publish(event_channel, payload=json.dumps(event_payload))
 
+    def publish_event_if_connected(self, data, type):
+        if self.is_connected():
+            self.publish_event(data, type)
+
     def publish_metrics(self, data):
         metrics_channel = '{}/metrics'.format(self.channel_id)
         metrics_payload = self.default_payload.copy()
         metrics_payload['payload'] = data
         self.client.publish(metrics_channel, payload=json.dumps(metrics_payload))
 
+    def is_configured(self):
+        """Whether angelo.conf holds the settings of a registered device."""
+        config = configparser.ConfigParser()
+        config.read(self.conf)
+        return config.has_section('app.psygig.com') and bool(config.options('app.psygig.com'))
+
     def read_conf(self):
         config = configparser.ConfigParser()
         config.read(self.conf)
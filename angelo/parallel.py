@@ -19,9 +19,12 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import io
 import logging
 import operator
 import sys
+from contextlib import contextmanager
+from threading import local
 from threading import Lock
 from threading import Semaphore
 from threading import Thread
@@ -71,15 +74,6 @@ def parallel_execute_watch(events, writer, errors, results, msg, get_name, fail_
             else:
                 writer.write(msg, get_name(obj), 'done', green)
             results.append(result)
-        elif isinstance(exception, ImageNotFound):
-            # This is to bubble up ImageNotFound exceptions to the client so we
-            # can prompt the user if they want to rebuild.
-            errors[get_name(obj)] = exception.explanation
-            writer.write(msg, get_name(obj), 'error', red)
-            error_to_reraise = exception
-        elif isinstance(exception, APIError):
-            errors[get_name(obj)] = exception.explanation
-            writer.write(msg, get_name(obj), 'error', red)
         elif isinstance(exception, (OperationFailedError, HealthCheckFailed, NoHealthCheckConfigured)):
             errors[get_name(obj)] = exception.msg
             writer.write(msg, get_name(obj), 'error', red)
@@ -101,12 +95,11 @@ def parallel_execute(objects, func, get_name, msg, get_deps=None, limit=None, fa
         in the CLI logs, but don't raise an exception (such as attempting to start 0 containers)
     """
     objects = list(objects)
-    stream = get_output_stream(sys.stderr)
 
-    if ParallelStreamWriter.instance:
-        writer = ParallelStreamWriter.instance
-    else:
-        writer = ParallelStreamWriter(stream)
+    writer = ParallelStreamWriter.get_instance()
+    if writer is None:
+        writer = ParallelStreamWriter.instance = ParallelStreamWriter(get_output_stream(sys.stderr))
+    stream = writer.stream
 
     for obj in objects:
         writer.add_object(msg, get_name(obj))
@@ -282,16 +275,23 @@ class ParallelStreamWriter(object):
     noansi = False
     lock = Lock()
     instance = None
+    #  The writers of the threads in capture_progress()
+    local = local()
 
     @classmethod
     def set_noansi(cls, value=True):
         cls.noansi = value
 
-    def __init__(self, stream):
+    @classmethod
+    def get_instance(cls):
+        return getattr(cls.local, 'writer', None) or cls.instance
+
+    def __init__(self, stream, noansi=None):
         self.stream = stream
         self.lines = []
         self.width = 0
-        ParallelStreamWriter.instance = self
+        if noansi is not None:
+            self.noansi = noansi
 
     def add_object(self, msg, obj_index):
         if msg is None:
@@ -337,12 +337,30 @@ class ParallelStreamWriter(object):
 
 
 def get_stream_writer():
-    instance = ParallelStreamWriter.instance
+    instance = ParallelStreamWriter.get_instance()
     if instance is None:
         raise RuntimeError('ParallelStreamWriter has not yet been instantiated')
     return instance
 
 
+@contextmanager
+def capture_progress():
+    """
+    Write the progress of the operations run by this thread to a writer of
+    its own instead of stderr, and yield the list of the lines written once
+    the block ends. The agent sends them to the CLI that asked for the
+    operations.
+    """
+    lines = []
+    stream = io.StringIO()
+    ParallelStreamWriter.local.writer = ParallelStreamWriter(stream, noansi=True)
+    try:
+        yield lines
+    finally:
+        ParallelStreamWriter.local.writer = None
+        lines.extend(line.rstrip() for line in stream.getvalue().splitlines() if line.strip())
+
+
 def parallel_operation(containers, operation, options, message):
     parallel_execute(
         containers,
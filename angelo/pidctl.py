@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+Signal processes known by their pid and wait for them to exit.
+
+On Linux 5.3 and later the wait is a poll() on a pidfd, which returns as soon
+as the process exits. Elsewhere our own children are reaped with waitpid()
+and other processes are probed with kill(pid, 0), at an interval growing up
+to MAX_POLL_INTERVAL.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import errno
+import logging
+import os
+import select
+import signal
+import time
+from collections import namedtuple
+
+from .errors import OperationFailedError
+
+log = logging.getLogger(__name__)
+
+#  Seconds a process gets to exit after SIGTERM before it is killed
+DEFAULT_GRACE_PERIOD = 10
+#  Seconds to wait for a killed process to be gone
+KILL_TIMEOUT = 5
+MIN_POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.1
+
+
+class ProcessExit(namedtuple('_ProcessExit', 'pid returncode killed')):
+    """
+    How a process ended. `returncode` is only known for our own children,
+    and is -N when signal N ended it. `killed` is True when it had to be
+    sent SIGKILL.
+    """
+
+
+def pid_exists(pid):
+    """Whether process `pid` runs, an exited one waiting to be reaped doesn't."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        #  EPERM: it exists but isn't ours to signal
+        if e.errno == errno.ESRCH:
+            return False
+    return not is_zombie(pid)
+
+
+def is_zombie(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return False
+    #  The command name in parentheses may hold spaces
+    return stat[stat.rfind(b')') + 2:][:1] == b'Z'
+
+
+def open_pidfd(pid):
+    """A pidfd of the process, None when the platform has none. Raises ProcessLookupError."""
+    pidfd_open = getattr(os, 'pidfd_open', None)
+    if pidfd_open is None:
+        return None
+    try:
+        return pidfd_open(pid)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            raise ProcessLookupError(pid)
+        #  ENOSYS on kernels older than 5.3
+        return None
+
+
+def reap(pid):
+    """
+    (exited, returncode) of process `pid` if it is our child, None if it
+    isn't.
+    """
+    try:
+        waited, status = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        return None
+    if not waited:
+        return False, None
+    return True, exit_code(status)
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_pid(pid, timeout=None):
+    """
+    Wait for process `pid` to exit, for at most `timeout` seconds. Return
+    (exited, returncode), returncode being None for processes that aren't
+    our children.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        pidfd = open_pidfd(pid)
+    except ProcessLookupError:
+        return True, None
+
+    try:
+        if pidfd is not None:
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not poller.poll(None if remaining is None else remaining * 1000):
+                return False, None
+            reaped = reap(pid)
+            if reaped is None:
+                return True, None
+            if reaped[0]:
+                return reaped
+            #  Readable before the zombie can be reaped, rarely
+            return True, exit_code(os.waitpid(pid, 0)[1])
+
+        interval = MIN_POLL_INTERVAL
+        while True:
+            reaped = reap(pid)
+            if reaped is not None and reaped[0]:
+                return reaped
+            if reaped is None and not pid_exists(pid):
+                return True, None
+            if deadline is not None and time.time() >= deadline:
+                return False, None
+            sleep = interval if deadline is None else min(interval, deadline - time.time())
+            time.sleep(max(0, sleep))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def terminate(pid, grace_period=DEFAULT_GRACE_PERIOD, signum=signal.SIGTERM):
+    """
+    Send `signum` to process `pid`, wait up to `grace_period` seconds for it
+    to exit and kill it if it doesn't. Returns a ProcessExit, raises
+    OperationFailedError if the process survived SIGKILL.
+    """
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        #  Not ours to reap if it ever was our child: it is gone already
+        return ProcessExit(pid, None, False)
+
+    exited, returncode = wait_pid(pid, grace_period)
+    if exited:
+        return ProcessExit(pid, returncode, False)
+
+    log.warning("Process {} didn't exit within {}s, killing it".format(pid, grace_period))
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        return ProcessExit(pid, None, False)
+    exited, returncode = wait_pid(pid, KILL_TIMEOUT)
+    if not exited:
+        raise OperationFailedError("Process {} survived SIGKILL".format(pid))
+    return ProcessExit(pid, returncode, True)
@@ -8,5 +8,9 @@ def run(module, base_url):
   event = Event(base_url)
   user_config = UserConfig()
 
-  if (not (main_process is None)):
-    main_process(event, user_config)
+  try:
+    if (not (main_process is None)):
+      main_process(event, user_config)
+  finally:
+    # stop watching angelo.yml for the callbacks of the module
+    user_config.close()
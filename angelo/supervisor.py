@@ -50,13 +50,40 @@ import sys
 import os
 import errno
 import hashlib
+import json
+import socket
+import subprocess
+import threading
 import time
 from textwrap import dedent
 import traceback
 from configparser import RawConfigParser, NoSectionError, NoOptionError
 from io import StringIO
-from supervisor import supervisord, supervisorctl
-from signal import SIGTERM
+from supervisor.xmlrpc import Faults, SupervisorTransport, getFaultDescription
+from six.moves import http_client
+from six.moves import shlex_quote
+from six.moves import xmlrpc_client as xmlrpclib
+
+from .errors import OperationFailedError
+from .launcher import module_command
+from .limits import ResourceLimits
+from .pidctl import pid_exists
+
+#  Credentials for supervisorctl to talk to supervisord.  They only guard
+#  against other local users, so they're derived from a constant.
+RPC_USERNAME = hashlib.md5("angelo".encode('utf-8')).hexdigest()[:7]
+RPC_PASSWORD = hashlib.md5(RPC_USERNAME.encode('utf-8')).hexdigest()
+#  This picks a "random" port in the 9000 range to listen on when no unix
+#  socket is configured.  It's derived from the password, so it's stable
+#  but multiple projects are unlikely to collide.
+RPC_PORT = int(hashlib.md5(RPC_PASSWORD.encode('utf-8')).hexdigest()[:3], 16) % 1000
+#  Seconds to wait for supervisord or a program to come up.
+START_TIMEOUT = 60
+LOG_POLL_INTERVAL = 0.5
+LOGSTORE_LISTENER = "angelo_logs"
+#  Events queued while the log listener is busy before supervisord drops them
+LOGSTORE_BUFFER_SIZE = 1024
+
 
 class Supervisor(object):
 
@@ -73,74 +100,274 @@ loglevel=warn
 
 """
 
-    def __init__(self, services):
+    def __init__(self, services, log_options=None):
         self.services = services
+        self.log_options = log_options
         self.pid_file = "supervisord.pid"
+        self.socket_file = os.path.abspath("supervisord.sock")
+        self.config_file = os.path.abspath("supervisord.conf")
         self.mqtt_pid = "mqtt.pid"
-
-    def run_supervisor(self):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        newpid = os.fork()
-        if newpid == 0:
-            supervisord.main(("-c",cfg_file))
-        exit()
+        self._local = threading.local()
+        self._rendered = None
+
+    def run_supervisor(self, timeout=START_TIMEOUT):
+        """Start supervisord and return once it answers RPC calls."""
+        self.write_config()
+        #  A new interpreter rather than a fork, the agent runs threads.
+        #  supervisord opens its socket before daemonizing, so once the
+        #  child has exited the socket is there to connect to.
+        subprocess.call(module_command("supervisor.supervisord") + ["-c", self.config_file])
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.call("supervisor.getState")
+            except OperationFailedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
 
     def start_process(self, name="all"):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        try:
-            supervisorctl.main(("-c",cfg_file, "start", name))
-        except:
-            pass
+        if name == "all":
+            return self.check_results(self.call("supervisor.startAllProcesses"))
+        return self.start_processes([name])
 
     def stop_process(self, name="all"):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        try:
-            supervisorctl.main(("-c",cfg_file, "stop", name))
-        except:
-            pass
+        if name == "all":
+            return self.check_results(self.call("supervisor.stopAllProcesses"))
+        return self.stop_processes([name])
 
     def restart_process(self, name="all"):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        try:
-            supervisorctl.main(("-c", cfg_file, "restart", name))
-        except:
-            pass
+        if name == "all":
+            self.stop_process()
+            return self.start_process()
+        self.stop_processes([name])
+        return self.start_processes([name])
 
     def reload_config(self):
-        os.kill(self.get_pid(), SIGTERM)
-        time.sleep(3)
-        self.run_supervisor()
+        """
+        Apply the current services to the running supervisord. Only the
+        programs whose definition changed are restarted, the others keep
+        running. Returns the (added, changed, removed) program names.
+        """
+        if self.read_config_hash() == self.config_hash():
+            return [], [], []
+        self.write_config()
+        [[added, changed, removed]] = self.call("supervisor.reloadConfig")
+        #  Like `supervisorctl update`: changed groups are replaced, and
+        #  adding a group starts its autostart programs.
+        self.stop_groups(changed + removed)
+        self.multicall("supervisor.removeProcessGroup", [(name,) for name in changed + removed],
+                       ignore=(Faults.BAD_NAME,))
+        self.multicall("supervisor.addProcessGroup", [(name,) for name in changed + added],
+                       ignore=(Faults.ALREADY_ADDED,))
+        return added, changed, removed
+
+    def write_config(self):
+        """Write the merged config for supervisord, headed by its hash."""
+        data = "; config hash: %s\n%s" % (self.config_hash(), self.get_merged_config())
+        tmp_file = self.config_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(data)
+        os.rename(tmp_file, self.config_file)
+
+    def read_config_hash(self):
+        """The hash of the config supervisord was last given, or None."""
+        try:
+            with open(self.config_file, "r") as f:
+                header = f.readline()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if not header.startswith("; config hash: "):
+            return None
+        return header.split(":", 1)[1].strip()
 
     def signal_process(self, name="all", signal="SIGKILL"):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        try:
-            supervisorctl.main(("-c",cfg_file, "signal", signal, name))  
-        except:
-            pass
-            
+        if name == "all":
+            return self.check_results(self.call("supervisor.signalAllProcesses", signal))
+        return self.signal_processes([name], signal)
+
+    #  supervisord answers the calls of a multicall that wait for a process
+    #  one tick apart, so batched calls don't wait and state is polled instead.
+
+    def start_processes(self, names, wait=True):
+        results = self.multicall("supervisor.startProcess", [(name, False) for name in names],
+                                 ignore=(Faults.ALREADY_STARTED,))
+        if wait:
+            for name in names:
+                self.wait_running(name)
+        return results
+
+    def stop_processes(self, names, wait=True):
+        results = self.multicall("supervisor.stopProcess", [(name, False) for name in names],
+                                 ignore=(Faults.NOT_RUNNING,))
+        if wait:
+            self.wait_stopped(names)
+        return results
+
+    def stop_groups(self, names):
+        results = self.multicall("supervisor.stopProcessGroup", [(name, False) for name in names],
+                                 ignore=(Faults.NOT_RUNNING, Faults.BAD_NAME))
+        self.wait_stopped(names)
+        return results
+
+    def signal_processes(self, names, signal):
+        return self.multicall("supervisor.signalProcess", [(name, signal) for name in names],
+                              ignore=(Faults.NOT_RUNNING,))
+
+    def wait_running(self, name, timeout=START_TIMEOUT):
+        """
+        Wait for a program that is starting to be RUNNING. Raises
+        OperationFailedError if it gives up or doesn't start in time.
+        """
+        deadline = time.time() + timeout
+        while True:
+            info = self.call("supervisor.getProcessInfo", name)
+            if info['statename'] == 'RUNNING':
+                return info
+            if info['statename'] not in ('STARTING', 'BACKOFF'):
+                raise OperationFailedError("%s is %s: %s" % (
+                    name, info['statename'], info['spawnerr'] or info['description']))
+            if time.time() > deadline:
+                raise OperationFailedError("%s did not start in %s seconds" % (name, timeout))
+            time.sleep(0.1)
+
+    def wait_stopped(self, names, timeout=START_TIMEOUT):
+        """Wait for the programs, groups or group:program in `names` to stop."""
+        deadline = time.time() + timeout
+        while True:
+            running = [info['name'] for info in self.get_all_process_info()
+                       if (info['name'] in names or info['group'] in names or
+                           "%s:%s" % (info['group'], info['name']) in names) and
+                       info['statename'] in ('STARTING', 'RUNNING', 'BACKOFF', 'STOPPING')]
+            if not running:
+                return
+            if time.time() > deadline:
+                raise OperationFailedError("%s did not stop in %s seconds" % (
+                    ", ".join(running), timeout))
+            time.sleep(0.1)
+
     def get_process_status(self, name=None):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        args = list()
-        if name is not None:
-            args.append(name)
-        try:            
-            supervisorctl.main(("-c",cfg_file, "status") + tuple(args))
-        except:
-            pass
-    
-    def logs(self, name, follow=False, tail=1600):
-        cfg_file = OnDemandStringIO(self.get_merged_config)
-        args = list()
-        if follow:
-            args.append("-f")
-        else:
-            args.append("-" + str(tail))
-        args.append(name)
+        """Return the info dicts of the given programs, or of all of them."""
+        infos = self.get_all_process_info()
+        if name is None:
+            return infos
+        infos = [info for info in infos if info['name'] == name]
+        if not infos:
+            raise OperationFailedError("No such process: %s" % name)
+        return infos
+
+    def log_offset(self, name):
+        """The current size of the stdout log of process `name`."""
+        return self.call("supervisor.tailProcessStdoutLog", name, 0, 0)[1]
+
+    def follow_log(self, name, offset, interval=LOG_POLL_INTERVAL):
+        """
+        Yield what process `name` writes to its stdout log from `offset` on.
+        Only the size of the log is polled while nothing is written.
+        """
+        while True:
+            size = self.call("supervisor.tailProcessStdoutLog", name, offset, 0)[1]
+            if size < offset:
+                #  supervisord rotated the log
+                offset = 0
+            if size > offset:
+                yield self.call("supervisor.readProcessStdoutLog", name, offset, size - offset)
+                offset = size
+            else:
+                time.sleep(interval)
 
-        try:            
-            supervisorctl.main(("-c",cfg_file, "tail") + tuple(args))  
-        except:
-            pass
+    @property
+    def rpc(self):
+        """
+        An XML-RPC proxy to supervisord, whose connection is kept open between
+        calls. Each thread gets its own connection, so that services can be
+        started in parallel.
+        """
+        if getattr(self._local, 'rpc', None) is None:
+            cfg = RawConfigParser()
+            cfg.read_string(self.get_merged_config())
+            self._local.transport = SupervisorTransport(cfg.get("supervisorctl", "username"),
+                                                        cfg.get("supervisorctl", "password"),
+                                                        cfg.get("supervisorctl", "serverurl"))
+            self._local.rpc = xmlrpclib.ServerProxy("http://127.0.0.1",
+                                                    transport=self._local.transport)
+        return self._local.rpc
+
+    def get_rpc(self):
+        """Return an XML-RPC proxy to the running supervisord."""
+        return self.rpc
+
+    def close(self):
+        """Close the connection of the calling thread."""
+        if getattr(self._local, 'transport', None) is not None:
+            self._local.transport.close()
+        self._local.rpc = None
+        self._local.transport = None
+
+    def call(self, method, *args):
+        """
+        Call a supervisord XML-RPC method, e.g. "supervisor.getAllProcessInfo".
+        Faults and connection failures are raised as OperationFailedError.
+        """
+        for attempt in range(2):
+            function = self.rpc
+            for part in method.split("."):
+                function = getattr(function, part)
+            try:
+                return function(*args)
+            except xmlrpclib.Fault as e:
+                raise OperationFailedError(fault_message(e.faultCode, e.faultString))
+            except (socket.error, xmlrpclib.ProtocolError, http_client.HTTPException) as e:
+                # A kept-alive connection goes stale when supervisord restarts
+                self.close()
+                if attempt:
+                    raise OperationFailedError("Could not reach supervisord: %s" % e)
+
+    def multicall(self, method, calls, ignore=()):
+        """
+        Run `method` once per argument tuple in `calls` in a single round
+        trip. Returns the results in order, and raises OperationFailedError
+        listing every call that failed with a fault not in `ignore`.
+        """
+        if not calls:
+            return []
+        results = self.call("system.multicall",
+                            [{"methodName": method, "params": list(args)} for args in calls])
+        errors = []
+        for args, result in zip(calls, results):
+            if isinstance(result, dict) and "faultCode" in result:
+                if result["faultCode"] not in ignore:
+                    errors.append("%s: %s" % (args[0], fault_message(
+                        result["faultCode"], result["faultString"])))
+        if errors:
+            raise OperationFailedError("\n".join(errors))
+        return results
+
+    def check_results(self, results):
+        """Raise the failures reported by one of supervisord's *AllProcesses calls."""
+        errors = ["%s: %s" % (result["name"], result["description"])
+                  for result in results
+                  if result["status"] not in (Faults.SUCCESS, Faults.ALREADY_STARTED,
+                                              Faults.NOT_RUNNING)]
+        if errors:
+            raise OperationFailedError("\n".join(errors))
+        return results
+
+    def get_all_process_info(self):
+        """Return supervisord's info dict (name, pid, statename...) for every program."""
+        return self.call("supervisor.getAllProcessInfo")
+
+    def get_pids(self):
+        """Map the name of every running program to its pid."""
+        return dict((info['name'], info['pid'])
+                    for info in self.get_all_process_info() if info['pid'])
+
+    def get_service_pids(self):
+        """Map the name of every running program to its service and its pid."""
+        return dict((info['name'], (info['group'], info['pid']))
+                    for info in self.get_all_process_info() if info['pid'])
 
     def is_running(self):
         """
@@ -151,17 +378,11 @@ loglevel=warn
             return False
         # The PID file may still exist even if the daemon isn't running,
         # for example if it has crashed.
-        try:
-            os.kill(pid, 0)
-        except OSError as e:
-            if e.errno == errno.ESRCH:
-                # In this case the PID file shouldn't have existed in
-                # the first place, so we remove it
-                os.remove(self.pid_file)
-                return False
-            # We may also get an exception if we're not allowed to use
-            # kill on the process, but that means that the process does
-            # exist, which is all we care about here.
+        if not pid_exists(pid):
+            # In this case the PID file shouldn't have existed in
+            # the first place, so we remove it
+            os.remove(self.pid_file)
+            return False
         return True
 
     def get_pid(self):
@@ -186,13 +407,34 @@ loglevel=warn
                 return None
             raise
 
+    def config_hash(self, **options):
+        """Hash of the service definitions and options the config is rendered from.
+
+        Two calls return the same hash exactly when get_merged_config would
+        render the same config, so a reload can tell whether anything changed.
+        """
+        data = json.dumps([[(service.name, service.options) for service in self.services],
+                           self.log_options, options], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
     def get_merged_config(self, **options):
         """Get the final merged configuration for supvervisord, as a string.
 
-        This is the top-level function exported by this module.  It combines
-        the config file from the main project with default settings and those
-        specified in the command-line, processes various special section names,
-        and returns the resulting configuration as a string.
+        This is the top-level function exported by this module.  The config
+        is only rendered again when the services or options changed, see
+        render_config.
+        """
+        key = self.config_hash(**options)
+        if self._rendered is None or self._rendered[0] != key:
+            self._rendered = (key, self.render_config(**options))
+        return self._rendered[1]
+
+    def render_config(self, **options):
+        """Render the merged configuration for supervisord.
+
+        It combines the config file from the main project with default settings
+        and those specified in the command-line, processes various special
+        section names, and returns the resulting configuration as a string.
         """
         config_file = "supervisord.conf"
         
@@ -202,7 +444,7 @@ loglevel=warn
         #  values from later files overwrite values from former.
         cfg = RawConfigParser()
         #  Start from the default configuration options.
-        cfg.readfp(StringIO(self.DEFAULT_CONFIG))
+        cfg.read_string(self.DEFAULT_CONFIG)
         """
         #  Add in the project-specific config file.
         with open(config_file,"r") as f:
@@ -210,9 +452,9 @@ loglevel=warn
         cfg.readfp(StringIO(data))
         """
         #  Add in the options from the self.services
-        cfg.readfp(StringIO(self.get_config_from_services()))
+        cfg.read_string(self.get_config_from_services())
         #  Add in the options specified on the command-line.
-        cfg.readfp(StringIO(self.get_config_from_options(**options)))
+        cfg.read_string(self.get_config_from_options(**options))
         #  Add options from [program:__defaults__] to each program section
         #  if it happens to be missing that option.
         PROG_DEFAULTS = "program:__defaults__"
@@ -239,18 +481,14 @@ loglevel=warn
         #  If they have configured a unix socket then use that, otherwise
         #  use an inet server on localhost at fixed-but-randomish port.
         
-        username = hashlib.md5("angelo".encode('utf-8')).hexdigest()[:7]
-        password = hashlib.md5(username.encode('utf-8')).hexdigest()
+        username = RPC_USERNAME
+        password = RPC_PASSWORD
         if cfg.has_section("unix_http_server"):
             self.set_if_missing(cfg,"unix_http_server","username",username)
             self.set_if_missing(cfg,"unix_http_server","password",password)
             serverurl = "unix://" + cfg.get("unix_http_server","file")
         else:
-            #  This picks a "random" port in the 9000 range to listen on.
-            #  It's derived from the secret key, so it's stable for a given
-            #  project but multiple projects are unlikely to collide.
-            port = int(hashlib.md5(password.encode('utf-8')).hexdigest()[:3],16) % 1000
-            addr = "127.0.0.1:9%03d" % (port,)
+            addr = "127.0.0.1:9%03d" % (RPC_PORT,)
             self.set_if_missing(cfg,"inet_http_server","port",addr)
             self.set_if_missing(cfg,"inet_http_server","username",username)
             self.set_if_missing(cfg,"inet_http_server","password",password)
@@ -305,7 +543,35 @@ loglevel=warn
         """Get config file fragment reflecting self.services"""
         data = []
         for service in self.services:
-            data.append("[program:%s]\ncommand=%s\n\n" % (service.name, service.options['command']))
+            command = service.options['command']
+            scale = get_scale(service)
+            limits = ResourceLimits.from_dict(service.options)
+            if limits is not None:
+                #  The launcher applies the limits and execs the command.
+                name = service.name if scale == 1 else "%s_%%(process_num)d" % (service.name,)
+                launcher = module_command("angelo.limits") + limits.args(name)
+                command = "%s -- %s" % (" ".join(shlex_quote(arg) for arg in launcher), command)
+            data.append("[program:%s]\ncommand=%s\n" % (service.name, command))
+            #  Instances are numbered processes of a single program, told
+            #  apart by their environment.
+            if scale > 1:
+                data.append("process_name=%%(program_name)s_%%(process_num)d\nnumprocs=%d\n"
+                            "environment=ANGELO_INSTANCE=\"%%(process_num)d\",ANGELO_INSTANCES=\"%d\"\n"
+                            % (scale, scale))
+            #  Services with dependencies are started by angelo once their
+            #  upstreams are running, supervisord only starts the others.
+            if service.options.get('depends_on'):
+                data.append("autostart=false\n")
+            #  Output is sent to the angelo.logstore event listener.
+            if self.log_options is not None:
+                data.append("stdout_events_enabled=true\nstderr_events_enabled=true\n")
+            data.append("\n")
+
+        if self.log_options is not None:
+            listener = module_command("angelo.logstore") + self.log_options.args()
+            data.append("[eventlistener:%s]\ncommand=%s\nevents=PROCESS_LOG\nbuffer_size=%d\n\n"
+                        % (LOGSTORE_LISTENER, " ".join(shlex_quote(arg) for arg in listener),
+                           LOGSTORE_BUFFER_SIZE))
 
         return "".join(data)
 
@@ -319,6 +585,8 @@ loglevel=warn
             data.append("pidfile=%s\n" % (options["pidfile"],))
         if options.get("logfile",None):
             data.append("logfile=%s\n" % (options["logfile"],))
+        #  Talk to supervisord over a unix socket next to its pid file.
+        data.append("[unix_http_server]\nfile=%s\n" % (options.get("socket", self.socket_file),))
         #  Set which programs to launch automatically on startup.
         for progname in options.get("launch",None) or []:
             data.append("[program:%s]\nautostart=true\n" % (progname,))
@@ -352,46 +620,21 @@ loglevel=warn
         except NoOptionError:
             cfg.set(section,option,value)
 
-class OnDemandStringIO(object):
-    """StringIO standin that demand-loads its contents and resets on EOF.
+def get_scale(service):
+    return int(service.options.get('scale') or 1)
 
-    This class is a little bit of a hack to make supervisord reloading work
-    correctly.  It provides the readlines() method expected by supervisord's
-    config reader, but it resets itself after indicating end-of-file.  If
-    the supervisord process then SIGHUPs and tries to read the config again,
-    it will be re-created and available for updates.
-    """
 
-    def __init__(self, callback, *args, **kwds):
-        self._fp = None
-        self.callback = callback
-        self.args = args
-        self.kwds = kwds
+def process_names(service):
+    """The names of the processes running `service`, as supervisord's RPC calls take them."""
+    scale = get_scale(service)
+    if scale == 1:
+        return [service.name]
+    return ["%s:%s_%d" % (service.name, service.name, num) for num in range(scale)]
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        line = self.fp.readline(*self.args, **self.kwds)
-        if not line:
-            self._fp = None
-            raise StopIteration
-        return line
-
-    @property
-    def fp(self):
-        if self._fp is None:
-            self._fp = StringIO(self.callback(*self.args, **self.kwds))
-        return self._fp
-
-    def read(self, *args, **kwds):
-        data = self.fp.read(*args, **kwds)
-        if not data:
-            self._fp = None
-        return data
-
-    def readline(self, *args, **kwds):
-        line = self.fp.readline(*args, **kwds)
-        if not line:
-            self._fp = None
-        return line
\ No newline at end of file
+def fault_message(code, text):
+    """Describe a supervisord fault, e.g. "BAD_NAME: foo"."""
+    description = getFaultDescription(code)
+    if text.startswith(description):
+        return text
+    return "%s: %s" % (description, text)
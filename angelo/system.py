@@ -17,29 +17,30 @@
 #  */
 
 import six
-import requests
 import json
 import os
 import configparser
 import logging
 import sys
-from signal import SIGTERM
-import random
-import ssl
-import websockets
-import asyncio
-import argparse
 import time
 import datetime
-import pathspec
 import shutil
+import operator
+import heapq
 
-from .zipper import get_all_file_paths, compress, decompress
+from . import parallel
 
 from .process import Process
+from .supervisor import process_names
 from .supervisor import Supervisor
 from .errors import OperationFailedError
-from .mqtt import MqttClient
+from .health import HealthMonitor
+from .logstore import get_log_options
+from .logstore import LogRecord
+from .logstore import LogStore
+from .metrics import ProcessAccounting
+from .pidctl import DEFAULT_GRACE_PERIOD
+from .pidctl import terminate
 
 # TODO: Change to staging/production?
 BASE_URL = "https://tracer.world"
@@ -58,9 +59,22 @@ class System(object):
         self.name = name
         self.services = services
         self.config_version = config_version
-        self.supervisor = Supervisor(services)
+        self.supervisor = Supervisor(services, get_log_options())
+        self.health = HealthMonitor()
         self.angelo_conf = os.path.expanduser("~") + "/.angelo/angelo.conf"
-        self.mqtt_client = MqttClient("mqtt.pid", self.angelo_conf)
+        self._mqtt_client = None
+
+    @property
+    def mqtt_client(self):
+        # paho-mqtt is only imported by the commands that talk to the platform
+        if self._mqtt_client is None:
+            from .mqtt import MqttClient
+            self._mqtt_client = MqttClient("mqtt.pid", self.angelo_conf, self.supervisor)
+        return self._mqtt_client
+
+    @mqtt_client.setter
+    def mqtt_client(self, mqtt_client):
+        self._mqtt_client = mqtt_client
 
     @classmethod
     def from_config(cls, name, config_data, default_platform=None):
@@ -134,6 +148,7 @@ class System(object):
         return uniques
 
     def register(self, identifier=None, id=None, secret=None):
+        import requests
         data = {
             'identifier': identifier,
             'app_id': id,
@@ -191,48 +206,13 @@ class System(object):
         elif registration_response.status_code == 401:
             logging.error(registration_response_data['message'])
 
-    def up(self, service_names=None, start_deps=True, timeout=None, detached=False):
-
-        pid = os.fork()
-        if pid == 0:
-            if not self.mqtt_client.is_running():
-                self.mqtt_client.start()
-            return
-
-        # if service_names is None or len(service_names) == 0:
-        #     if not self.supervisor.is_running():
-        #         self.supervisor.run_supervisor()
-        #     self.supervisor.start_process()
-        #     return
-
-        # if not self.supervisor.is_running():
-        #     raise OperationFailedError("Services must first be started with \'up\' or 'start'")
-
-        # services = self.get_services(service_names, include_deps=start_deps) 
-        # for service in services:
-        #     self.supervisor.start_process(service.name)
+    def up(self, service_names=None, start_deps=True, timeout=None, detached=False,
+           scale_override=None):
+        self.start_system(service_names, scale_override)
 
     def down(self):
-
-        pid = os.fork()
-        if pid == 0:
-            if self.mqtt_client.is_running():
-                self.mqtt_client.stop()
-                return;
-                
-
-        # if not self.supervisor.is_running():
-        #     raise OperationFailedError("Services must first be started with \'up\' or 'start'")
-
-        # if service_names is None or len(service_names) == 0:
-        #     self.supervisor.stop_process()
-        #     return
-
-        # services = self.get_services(
-        #     service_names)
-
-        # for service in services:
-        #     self.supervisor.stop_process(service.name)
+        # The MQTT client runs in the agent, which `down` shuts down
+        logging.error("The angelo agent is not running")
 
     def start(self,
            start_deps=True,
@@ -248,66 +228,133 @@ class System(object):
            renew_anonymous_volumes=False,
            silent=False,
            ):
+        self.start_system(scale_override=scale_override)
 
-        pid = os.fork()
-        if pid == 0:
-            if not self.mqtt_client.is_running():
-                # Anything after self.mqtt_client.start() will never be executed because parent processes are killed when
-                # creating the daemon, daemon blocks the program, and killing the client ends the program.
-                # Therefore, by running it in a child process, the supervisor is still able to run
-                self.mqtt_client.start()
-            return
+    def start_system(self, service_names=None, scale_override=None):
+        """
+        Start supervisord if it isn't running and then the services. With
+        `scale_override` ({service name: instances}), a running supervisord
+        is given the new number of instances first.
+        """
+        for name, scale in (scale_override or {}).items():
+            self.get_service(name).options['scale'] = scale
 
         if not self.supervisor.is_running():
-            # Starting the supervisor starts processes so self.supervisor.start_process() should not be run.
+            # supervisord starts the services without dependencies by itself,
+            # the others are started below once their upstreams are running.
             self.supervisor.run_supervisor()
+        elif scale_override:
+            self.supervisor.reload_config()
 
-        if not self.supervisor.is_running():
-            raise OperationFailedError("Services must first be started with \'up\' or 'start'")
-
-        self.supervisor.start_process()
+        self.start_services(service_names)
 
     def stop(self, timeout=None):
-        if not self.supervisor.is_running() and not self.mqtt_client.is_running:
+        if not self.supervisor.is_running():
             raise OperationFailedError("Services must first be started with \'up\' or 'start'")
 
+        # Stop dependents before their upstreams, supervisord would stop
+        # everything at once.
         try:
-            os.kill(self.supervisor.get_pid(), SIGTERM)
-            logging.debug('Supervisor shutting down...')
-        except ProcessLookupError as e:
-            logging.debug("No supervisor running. Removing pid file.")
-            os.remove(self.supervisor.pid_file)
-        except TypeError as e:
+            self.stop_services()
+        except OperationFailedError as e:
+            logging.error(e.msg)
+
+        pid = self.supervisor.get_pid()
+        if pid is None:
             logging.debug("No supervisor process id found. Already killed?")
             logging.error("This service may have already been stopped.")
+            return
 
-        try:
-            os.kill(self.mqtt_client.get_pid(), SIGTERM)
-            logging.debug('MQTT Client shutting down...')
-        except ProcessLookupError as e:
-            logging.debug("No MQTT Client running. Removing pid file.")
-            self.mqtt_client.delpid()
-        except TypeError as e:
-            logging.debug("No MQTT Client process id found. Already killed?")
-            logging.error("This service may have already been stopped.")
+        logging.debug('Supervisor shutting down...')
+        result = terminate(pid, DEFAULT_GRACE_PERIOD if timeout is None else timeout)
+        if result.killed:
+            logging.warning("Supervisor didn't shut down in time and was killed")
+        if os.path.exists(self.supervisor.pid_file):
+            # Left behind when supervisord was killed or had already crashed
+            os.remove(self.supervisor.pid_file)
 
     def reload(self):
-        self.supervisor.reload_config()
+        """
+        Apply the config file to the running services: new and changed
+        services are (re)started, removed ones are stopped, and services that
+        didn't change keep running.
+        """
+        if not self.supervisor.is_running():
+            self.supervisor.run_supervisor()
+            self.start_services()
+            return
+
+        added, changed, removed = self.supervisor.reload_config()
+        for action, names in (('Added', added), ('Changed', changed), ('Removed', removed)):
+            if names:
+                logging.info("{}: {}".format(action, ", ".join(names)))
+        # supervisord starts the log listener itself
+        names = [name for name in added + changed if name in self.service_names]
+        if names:
+            self.start_services(names)
 
     def restart(self, service_names=None, timeout=None):
         
         if not self.supervisor.is_running():
             raise OperationFailedError("Services must first be started with \'up\' or 'start'")
 
-        if service_names is None or len(service_names) == 0:
-            self.supervisor.restart_process()
-            return
+        self.stop_services(service_names)
+        self.start_services(service_names)
 
-        services = self.get_services(
-            service_names)
+    def get_deps(self, service):
+        """
+        The (upstream service, ready check) pairs `service` depends on. An
+        upstream with `condition: service_healthy` must also pass its
+        healthcheck.
+        """
+        depends_on = service.options.get('depends_on') or {}
+        return set(
+            (self.get_service(name),
+             self.health.ready_check
+             if (depends_on[name] or {}).get('condition') == 'service_healthy' else None)
+            for name in depends_on
+        )
+
+    def get_dependents(self, service):
+        """The services that depend on `service`, in the form of get_deps."""
+        return set(
+            (other, None) for other in self.services
+            if service.name in (other.options.get('depends_on') or {})
+        )
+
+    def start_services(self, service_names=None):
+        """
+        Start services in parallel, each one as soon as the services it
+        depends on are running.
+        """
+        def start_service(service):
+            self.supervisor.start_processes(process_names(service))
+            self.health.watch(service)
 
-        for service in services:
-            self.supervisor.restart_process(service.name)
+        try:
+            results, errors = parallel.parallel_execute(
+                self.get_services(service_names),
+                start_service,
+                operator.attrgetter('name'),
+                'Starting',
+                self.get_deps,
+            )
+        finally:
+            self.health.stop()
+        if errors:
+            raise OperationFailedError("Failed to start: %s" % ", ".join(sorted(errors)))
+
+    def stop_services(self, service_names=None):
+        """Stop services in parallel, each one once its dependents are stopped."""
+        results, errors = parallel.parallel_execute(
+            self.get_services(service_names),
+            lambda service: self.supervisor.stop_processes(process_names(service)),
+            operator.attrgetter('name'),
+            'Stopping',
+            self.get_dependents,
+        )
+        if errors:
+            raise OperationFailedError("Failed to stop: %s" % ", ".join(sorted(errors)))
 
     def kill(self, service_names=None, signal="SIGKILL"):
 
@@ -321,52 +368,143 @@ class System(object):
             self.supervisor.signal_process("all", signal)
             return
 
-        services = self.get_services(
-            service_names)
+        names = [name for service in self.get_services(service_names)
+                 for name in process_names(service)]
+        self.supervisor.signal_processes(names, signal)
+
+    def ps(self, service_names=None):
+        """
+        Return an info dict for each service, fetched in a single call, with
+        the instances of scaled services aggregated. Services supervisord
+        doesn't know about are left out. The `health` of running services
+        with a healthcheck is probed once.
+        """
+        if not self.supervisor.is_running():
+            raise OperationFailedError("Services must first be started with \'up\' or 'start'")
 
+        infos = self.get_service_infos(service_names)
+        services = [service for service in self.get_services(service_names)
+                    if service.name in infos]
+        health = self.health.check(
+            [service for service in services if infos[service.name]['statename'] == 'RUNNING'])
         for service in services:
-            self.supervisor.signal_process(service.name, signal)
+            infos[service.name]['health'] = health.get(service.name)
+        return [infos[service.name] for service in services]
 
-    def top(self, service_names=None):
-        
+    def get_service_infos(self, service_names=None):
+        """
+        Map the name of each service to supervisord's info dict for it. For
+        services with several instances, `statename` is their common state or
+        a count of each state, and `pids` lists the pid of every instance.
+        """
+        groups = {}
+        for info in self.supervisor.get_all_process_info():
+            groups.setdefault(info['group'], []).append(info)
+
+        infos = {}
+        for service in self.get_services(service_names):
+            instances = groups.get(service.name)
+            if not instances:
+                continue
+            info = dict(instances[0], name=service.name, instances=len(instances),
+                        pids=[instance['pid'] for instance in instances if instance['pid']])
+            states = [instance['statename'] for instance in instances]
+            if len(instances) > 1:
+                if len(set(states)) > 1:
+                    info['statename'] = ', '.join(
+                        '{} {}'.format(states.count(state), state) for state in sorted(set(states)))
+                info['description'] = '{} instances'.format(len(instances))
+            infos[service.name] = info
+        return infos
+
+    def top(self, service_names=None, delay=1):
+        """
+        Measure the resource usage of each service's process tree over `delay`
+        seconds, summed over its instances. Returns a list of (name, state,
+        ProcessUsage) tuples, where the usage is None for services that are
+        not running.
+        """
         if not self.supervisor.is_running():
             raise OperationFailedError("Services must first be started with \'up\' or 'start'")
 
-        if service_names is None or len(service_names) == 0:
-            self.supervisor.get_process_status()
-            return
-
-        services = self.get_services(
-            service_names)
+        names = [service.name for service in self.get_services(service_names)]
+        infos = self.get_service_infos(service_names)
+        pids = dict((name, infos[name]['pids']) for name in names
+                    if name in infos and infos[name]['pids'])
 
-        for service in services:
-            self.supervisor.get_process_status(service.name)
+        accounting = ProcessAccounting()
+        try:
+            accounting.sample(pids)
+            time.sleep(delay)
+            usage = accounting.sample(pids)
+        finally:
+            accounting.close()
+
+        return [
+            (name, infos[name]['statename'] if name in infos else 'UNKNOWN', usage.get(name))
+            for name in names
+        ]
+
+    def instance_names(self, service_names=None):
+        """The names the output of each instance of the services is shown under."""
+        return [name.rpartition(':')[2] for service in self.get_services(service_names)
+                for name in process_names(service)]
+
+    def logs(self, service_names=None, tail=None, since=None):
+        """
+        Return the stored output of services as (instance name, LogRecord)
+        pairs, merged in the order it was logged. Without `since`, only the
+        last `tail` lines of each instance are returned.
+        """
+        if tail is None and since is None:
+            tail = 1600
 
-    def logs(self, 
-             service_names=None,
-             follow=False,
-             tail=None):
+        store = LogStore(self.supervisor.log_options)
+        records = [
+            [(record.timestamp, name, record.line)
+             for record in store.get(name).read(since=since, tail=tail)]
+            for name in self.instance_names(service_names)
+        ]
+        return [(name, LogRecord(timestamp, line))
+                for timestamp, name, line in heapq.merge(*records)]
 
+    def follow_logs(self, service_names=None):
+        """
+        Return {instance name: generator of its output}, starting from what
+        the services write after this call.
+        """
         if not self.supervisor.is_running():
             raise OperationFailedError("Services must first be started with \'up\' or 'start'")
 
-        if tail is None:
-            tail = 1600
+        streams = {}
+        for service in self.get_services(service_names):
+            for name in process_names(service):
+                offset = self.supervisor.log_offset(name)
+                streams[name.rpartition(':')[2]] = self.supervisor.follow_log(name, offset)
+        return streams
 
-        services = self.get_services(
-            service_names)
-
-        for service in services:
-            self.supervisor.logs(service.name, follow, tail)
-            
-    def live(self, experimental=False):
+    def live(self, experimental=False, background=False):
+        """
+        Stream the camera to the PSYGIG platform. The call runs in a thread
+        when `background` is True, in the agent, otherwise this process
+        becomes a daemon running it.
+        """
         if experimental:
+            if background:
+                raise OperationFailedError(
+                    "live --experimental opens the camera itself, stop the agent with 'down' first")
             from .webrtc_experimental import WebRTCClient
             method = 'webrtc-room'
         else:
             from .webrtc import WebRTCClient
+            from .capture import get_capture_pipeline
             method = 'webrtc'
-        self.mqtt_client.initialize_client()
+            # The call opens the camera once it runs, a daemon doesn't keep
+            # the threads of the pipeline across its fork
+            capture = get_capture_pipeline(start=False)
+            if capture is not None and 'webrtc' in capture.branches:
+                raise OperationFailedError("The video stream is already live")
+        self.mqtt_client.ensure_client()
         self.mqtt_client.publish_live(method)
         our_id = "{}:{}".format(self.mqtt_client.default_payload['group_id'], self.mqtt_client.default_payload['identifier'])
         server = 'wss://webrtc-signal-server-staging.app.psygig.com:443/'
@@ -374,17 +512,33 @@ class System(object):
         room_id = self.mqtt_client.channel_id
 
         c = WebRTCClient(our_id, room_id, server, 'webrtc.pid', self.angelo_conf)
+        if background:
+            c.start_call()
+            return
         if c.is_running():
             logging.error("Webrtc client already running?")
             sys.exit(1)
         c.start()
-        asyncio.get_event_loop().run_until_complete(c.connect())
-        res = asyncio.get_event_loop().run_until_complete(c.loop())
+        if experimental:
+            import asyncio
+            asyncio.get_event_loop().run_until_complete(c.connect())
+            res = asyncio.get_event_loop().run_until_complete(c.loop())
+        else:
+            res = c.run_call()
         sys.exit(res)
 
     def offline(self):
+        from .capture import get_capture_pipeline
+        capture = get_capture_pipeline(start=False)
+        if capture is not None and capture.detach('webrtc'):
+            # The call ran in this process, the agent
+            self.mqtt_client.ensure_client()
+            self.mqtt_client.publish_live(None)
+            return
+
+        import random
         from .webrtc_experimental import WebRTCClient
-        self.mqtt_client.initialize_client()
+        self.mqtt_client.ensure_client()
         our_id = random.randrange(10, 10000)
         peerid = self.mqtt_client.channel_id
         server = 'wss://webrtc-signal-server-staging.app.psygig.com:443/'
@@ -394,20 +548,66 @@ class System(object):
         if not c.is_running():
             raise OperationFailedError("Video stream must first be started with \'live\'")
 
-        try:
-            os.kill(c.get_pid(), SIGTERM)
-            self.mqtt_client.publish_live(None)
-            c.stop()
-            logging.debug("Stopping stream...")
-        except ProcessLookupError as e:
-            logging.debug("No webrtc client running. Removing pid file.")
-            os.remove(c.pidfile)
-        except TypeError as e:
-            logging.debug("No webrtc client process id found. Already killed?")
-            logging.error("This service may have already been stopped.")
+        logging.debug("Stopping stream...")
+        # Waits for the client to exit, removing its pid file
+        c.stop()
+        self.mqtt_client.publish_live(None)
+
+    def attach_capture(self, name, kind, location):
+        """Attach a branch to the capture pipeline of this process, False when it was already."""
+        from .capture import get_capture_pipeline
+        capture = get_capture_pipeline()
+        if name in capture.branches:
+            return False
+        capture.attach(name, kind, location)
+        return True
+
+    def broadcast(self, location):
+        """Stream the camera to an RTMP server."""
+        if not self.attach_capture('broadcast', 'rtmp', location):
+            raise OperationFailedError("A broadcast is already running")
+        logging.info('Broadcasting to {}'.format(location))
+
+    def stop_broadcast(self):
+        from .capture import get_capture_pipeline
+        capture = get_capture_pipeline(start=False)
+        if capture is None or not capture.detach('broadcast'):
+            raise OperationFailedError("No broadcast is running")
+
+    def record(self, path):
+        """
+        Record the camera to MP4 files, `path` being a pattern of their names
+        like video%05d.mp4.
+        """
+        if not self.attach_capture('record', 'record', os.path.abspath(path)):
+            raise OperationFailedError("A recording is already running")
+        logging.info('Recording to {}'.format(path))
+
+    def stop_recording(self):
+        from .capture import get_capture_pipeline
+        capture = get_capture_pipeline(start=False)
+        if capture is None or not capture.detach('record'):
+            raise OperationFailedError("No recording is running")
+
+    def share_frames(self):
+        """Share the frames of the camera with modules, returning the socket they are read from."""
+        from .capture import FRAMES_SOCKET
+        from .capture import get_capture_pipeline
+        socket_path = os.path.abspath(FRAMES_SOCKET)
+        get_capture_pipeline().acquire('frames', 'frames', socket_path)
+        return socket_path
+
+    def stop_sharing_frames(self):
+        """Stop sharing frames with a module, the last one detaching the frames branch."""
+        from .capture import get_capture_pipeline
+        capture = get_capture_pipeline(start=False)
+        if capture is not None:
+            capture.release('frames')
 
     def install(self, module_name, remote=False, version=None):
+        import requests
         from shutil import copyfile
+        from .zipper import decompress
         try:
             # decouple the config parser with mqtt_client later on
             config = self.mqtt_client.read_conf()
@@ -522,6 +722,9 @@ class System(object):
             raise Exception("Module is not yet registered")
 
     def publish(self, module_path):
+        import pathspec
+        import requests
+        from .zipper import compress, get_all_file_paths
 
         cwd = os.getcwd()
 
@@ -603,6 +806,7 @@ class System(object):
             print("Could not find module in current directory")
 
     def track(self):
+        import requests
         print("Connecting to PSYGIG platform...", end = '')
         try:
             self.mqtt_client.initialize_client()
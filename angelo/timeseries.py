@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import errno
+import logging
+import mmap
+import os
+import re
+import struct
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = os.path.join(os.path.expanduser("~"), ".angelo", "metrics")
+DEFAULT_RAW_POINTS = 3600
+DEFAULT_MINUTE_POINTS = 1440
+DEFAULT_HOUR_POINTS = 720
+DEFAULT_MAX_SERIES = 128
+
+RAW = 'raw'
+MINUTE = '1m'
+HOUR = '1h'
+RESOLUTIONS = {RAW: 0, MINUTE: 60, HOUR: 3600}
+
+MAGIC = b'ATS1'
+# magic, name, capacity of each tier
+HEADER = struct.Struct('<4s64sIII')
+# head and count of each tier
+RING = struct.Struct('<II')
+# timestamp, value
+RAW_RECORD = struct.Struct('<dd')
+# bucket start, sum, min, max, count
+ROLLUP_RECORD = struct.Struct('<ddddd')
+
+INVALID_SERIES_CHARS = re.compile(r'[^a-zA-Z0-9._-]')
+
+
+class Point(namedtuple('_Point', 'timestamp value min max count')):
+    """
+    A point of a series. For rolled up resolutions `value` is the mean of the
+    `count` raw values of the bucket starting at `timestamp`.
+    """
+
+
+class StoreOptions(namedtuple('_StoreOptions', 'enabled path raw_points minute_points hour_points max_series')):
+    """
+    :param enabled: whether samples are recorded at all
+    :param path: directory holding one file per series
+    :param raw_points: raw samples kept per series
+    :param minute_points: one minute rollups kept per series
+    :param hour_points: one hour rollups kept per series
+    :param max_series: number of series recorded, further series are dropped
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            bool(options.get('enabled', True)),
+            os.path.expanduser(options.get('path', DEFAULT_STORE_PATH)),
+            int(options.get('raw_points', DEFAULT_RAW_POINTS)),
+            int(options.get('minute_points', DEFAULT_MINUTE_POINTS)),
+            int(options.get('hour_points', DEFAULT_HOUR_POINTS)),
+            int(options.get('max_series', DEFAULT_MAX_SERIES)),
+        )
+
+    @property
+    def series_size(self):
+        return SeriesFile.size(self.raw_points, self.minute_points, self.hour_points)
+
+
+class NoSuchSeries(Exception):
+    def __init__(self, name):
+        self.name = name
+        self.msg = "No such series: %s" % name
+
+    def __str__(self):
+        return self.msg
+
+
+class SeriesFile(object):
+    """
+    One series stored as fixed-size ring buffers in a memory mapped file.
+
+    The file holds a header, the open one minute and one hour buckets and
+    three rings: raw samples, one minute and one hour rollups. Rollups are
+    updated as samples are appended, and the file never grows after it has
+    been created.
+    """
+
+    def __init__(self, path, name=None, capacities=None, readonly=False):
+        self.path = path
+        flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+        fd = os.open(path, flags, 0o644)
+        try:
+            if capacities is not None and not self.has_layout(fd, capacities):
+                if os.fstat(fd).st_size:
+                    log.warning('Resetting series file {} to a new size'.format(path))
+                self.allocate(fd, name, capacities)
+            self.map = mmap.mmap(
+                fd, 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        magic, raw_name, raw_cap, minute_cap, hour_cap = HEADER.unpack_from(self.map, 0)
+        self.name = raw_name.rstrip(b'\0').decode('utf-8')
+        self.tiers = []
+        offset = HEADER.size + 3 * RING.size + 2 * ROLLUP_RECORD.size
+        for index, (resolution, capacity) in enumerate(
+                [(RAW, raw_cap), (MINUTE, minute_cap), (HOUR, hour_cap)]):
+            record = RAW_RECORD if resolution == RAW else ROLLUP_RECORD
+            self.tiers.append(Tier(resolution, capacity, record, offset,
+                                   HEADER.size + index * RING.size))
+            offset += capacity * record.size
+        self.last_timestamp = self.newest(self.tiers[0])
+
+    @staticmethod
+    def size(raw_points, minute_points, hour_points):
+        return (HEADER.size + 3 * RING.size + 2 * ROLLUP_RECORD.size +
+                raw_points * RAW_RECORD.size +
+                (minute_points + hour_points) * ROLLUP_RECORD.size)
+
+    @staticmethod
+    def has_layout(fd, capacities):
+        header = os.pread(fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return False
+        magic, _, raw_cap, minute_cap, hour_cap = HEADER.unpack(header)
+        return magic == MAGIC and (raw_cap, minute_cap, hour_cap) == tuple(capacities)
+
+    @classmethod
+    def allocate(cls, fd, name, capacities):
+        size = cls.size(*capacities)
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, size)
+        if hasattr(os, 'posix_fallocate'):
+            # Reserve the blocks now so that the store can't run out of disk later
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+        os.pwrite(fd, HEADER.pack(MAGIC, name.encode('utf-8')[:64], *capacities), 0)
+
+    def append(self, timestamp, value):
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            # The rings must stay in order to be searched by timestamp
+            return False
+        self.last_timestamp = timestamp
+        raw = self.tiers[0]
+        self.push(raw, RAW_RECORD.pack(timestamp, value))
+
+        for index, tier in enumerate(self.tiers[1:]):
+            bucket_offset = HEADER.size + 3 * RING.size + index * ROLLUP_RECORD.size
+            start = timestamp - timestamp % RESOLUTIONS[tier.resolution]
+            open_start, total, low, high, count = ROLLUP_RECORD.unpack_from(self.map, bucket_offset)
+            if count and open_start == start:
+                bucket = (start, total + value, min(low, value), max(high, value), count + 1)
+            else:
+                if count:
+                    self.push(tier, ROLLUP_RECORD.pack(open_start, total, low, high, count))
+                bucket = (start, value, value, value, 1)
+            ROLLUP_RECORD.pack_into(self.map, bucket_offset, *bucket)
+        return True
+
+    def push(self, tier, record):
+        head, count = RING.unpack_from(self.map, tier.ring_offset)
+        self.map[tier.offset + head * tier.record.size:
+                 tier.offset + (head + 1) * tier.record.size] = record
+        # Publish the record before moving the head, for concurrent readers
+        RING.pack_into(self.map, tier.ring_offset, (head + 1) % tier.capacity,
+                       min(count + 1, tier.capacity))
+
+    def points(self, tier):
+        """Return (read, count) where read(i) is the i-th oldest point of a tier."""
+        head, count = RING.unpack_from(self.map, tier.ring_offset)
+        first = (head - count) % tier.capacity if tier.capacity else 0
+
+        def read(i):
+            offset = tier.offset + ((first + i) % tier.capacity) * tier.record.size
+            fields = tier.record.unpack_from(self.map, offset)
+            return to_point(tier, fields)
+
+        return read, count
+
+    def open_bucket(self, tier):
+        index = [t.resolution for t in self.tiers].index(tier.resolution) - 1
+        fields = ROLLUP_RECORD.unpack_from(
+            self.map, HEADER.size + 3 * RING.size + index * ROLLUP_RECORD.size)
+        if not fields[4]:
+            return None
+        return to_point(tier, fields)
+
+    def newest(self, tier):
+        read, count = self.points(tier)
+        return read(count - 1).timestamp if count else None
+
+    def choose_tier(self, since):
+        """The finest tier that still holds everything since `since`."""
+        for tier in self.tiers:
+            read, count = self.points(tier)
+            if count < tier.capacity or since is None or (count and read(0).timestamp <= since):
+                return tier
+        return self.tiers[-1]
+
+    def query(self, since=None, until=None, resolution=None):
+        if resolution is None:
+            tier = self.choose_tier(since)
+        else:
+            tier = self.tiers[[t.resolution for t in self.tiers].index(resolution)]
+
+        read, count = self.points(tier)
+        start = 0 if since is None else bisect(read, count, since)
+        points = []
+        for i in range(start, count):
+            point = read(i)
+            if until is not None and point.timestamp > until:
+                return points
+            points.append(point)
+
+        if tier.resolution != RAW:
+            bucket = self.open_bucket(tier)
+            if bucket is not None and (since is None or bucket.timestamp >= since) and \
+                    (until is None or bucket.timestamp <= until):
+                points.append(bucket)
+        return points
+
+    def close(self):
+        self.map.close()
+
+
+class Tier(namedtuple('_Tier', 'resolution capacity record offset ring_offset')):
+    pass
+
+
+def to_point(tier, fields):
+    if tier.resolution == RAW:
+        return Point(fields[0], fields[1], fields[1], fields[1], 1)
+    start, total, low, high, count = fields
+    return Point(start, total / count, low, high, int(count))
+
+
+def bisect(read, count, timestamp):
+    """Index of the first point at or after `timestamp`."""
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if read(middle).timestamp < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def series_filename(name):
+    return INVALID_SERIES_CHARS.sub('_', name) + '.ts'
+
+
+class TimeSeriesStore(object):
+    """
+    A local store of metric series under ~/.angelo/metrics.
+
+    Every series lives in a preallocated file of `options.series_size`
+    bytes, and at most `options.max_series` series are recorded, so the
+    memory and disk used by the store are fixed by its options. Modules can
+    record their own measurements with `append()` next to the device metrics.
+    """
+
+    def __init__(self, options=None, readonly=False):
+        self.options = options or StoreOptions.from_dict({})
+        self.readonly = readonly
+        self.series = {}
+        self.dropped = set()
+        if not readonly and not os.path.isdir(self.options.path):
+            os.makedirs(self.options.path)
+
+    @property
+    def capacities(self):
+        return (self.options.raw_points, self.options.minute_points, self.options.hour_points)
+
+    def get_series(self, name, create=False):
+        if name in self.series:
+            return self.series[name]
+        path = os.path.join(self.options.path, series_filename(name))
+        if not os.path.exists(path):
+            if not create:
+                raise NoSuchSeries(name)
+            if len(self.names()) >= self.options.max_series:
+                if name not in self.dropped:
+                    log.warning('Not recording series {}: the store is limited to {} series'
+                                .format(name, self.options.max_series))
+                    self.dropped.add(name)
+                return None
+        series = SeriesFile(path, name,
+                            None if self.readonly else self.capacities,
+                            readonly=self.readonly)
+        self.series[name] = series
+        return series
+
+    def append(self, name, timestamp, value):
+        series = self.get_series(name, create=True)
+        if series is None:
+            return False
+        return series.append(timestamp, value)
+
+    def append_sample(self, sample):
+        """Record a sample as produced by :class:`angelo.metrics.MetricsReporter`."""
+        for name, value in sample['metrics'].items():
+            self.append(name, sample['timestamp'], value)
+
+    def query(self, name, since=None, until=None, resolution=None):
+        return self.get_series(name).query(since, until, resolution)
+
+    def names(self):
+        try:
+            filenames = os.listdir(self.options.path)
+        except OSError:
+            return []
+        return sorted(f[:-3] for f in filenames if f.endswith('.ts'))
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series = {}
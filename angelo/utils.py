@@ -153,8 +153,22 @@ def splitdrive(path):
     return ntpath.splitdrive(path)
 
 
+BYTE_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
 def parse_bytes(n):
-    return None
+    """Parse a size like 512, "512k" or "1.5gb" into bytes, or None if it is invalid."""
+    if isinstance(n, six.integer_types):
+        return n
+    try:
+        n = n.strip().lower()
+        if n[-2:-1].isalpha() and n[-1] == 'b':
+            n = n[:-1]
+        if n[-1:].isalpha():
+            return int(float(n[:-1]) * BYTE_UNITS[n[-1]])
+        return int(n)
+    except (AttributeError, KeyError, ValueError):
+        return None
 
 
 def unquote_path(s):
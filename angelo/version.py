@@ -18,10 +18,36 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-from distutils.version import LooseVersion
+import re
+from functools import total_ordering
 
+# distutils.version.LooseVersion's parsing: importing distutils pulls in
+# setuptools, which is slower to import than the rest of the CLI
+COMPONENT_RE = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
 
-class AngeloVersion(LooseVersion):
+
+@total_ordering
+class AngeloVersion(object):
     """ A hashable version object """
+    def __init__(self, vstring):
+        self.vstring = vstring
+        components = [x for x in COMPONENT_RE.split(vstring) if x and x != '.']
+        self.version = [int(x) if x.isdigit() else x for x in components]
+
+    def __str__(self):
+        return self.vstring
+
+    def __repr__(self):
+        return "AngeloVersion ('%s')" % self.vstring
+
+    def _coerce(self, other):
+        return other if isinstance(other, AngeloVersion) else AngeloVersion(other)
+
+    def __eq__(self, other):
+        return self.version == self._coerce(other).version
+
+    def __lt__(self, other):
+        return self.version < self._coerce(other).version
+
     def __hash__(self):
         return hash(self.vstring)
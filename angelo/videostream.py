@@ -3,10 +3,16 @@
 
 class VideoStream:
 	def __init__(self, src=0, usePiCamera=False, useFlirCamera=False, resolution=(320, 240),
-		framerate=32, **kwargs):
+		framerate=32, useCapture=False, **kwargs):
 		# check to see if the picamera module should be used
 
-		if usePiCamera:
+		if useCapture:
+			# frames of the capture pipeline angelo shares with live video
+			# and broadcasts, rather than opening the camera again
+			from .capture import CaptureVideoStream
+			self.stream = CaptureVideoStream()
+
+		elif usePiCamera:
 			# only import the picamera packages unless we are
 			# explicity told to do so -- this helps remove the
 			# requirement of `picamera[array]` from desktops or
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# /*
+#  * Copyright (C) 2019 PSYGIG株式会社
+#  *
+#  * Licensed under the Apache License, Version 2.0 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  * http://www.apache.org/licenses/LICENSE-2.0
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+#  */
+"""
+Watching of the config files.
+
+The agent applies angelo.yml as soon as it changes, whether it was edited
+locally or written by the MQTT client with a config from the PSYGIG
+platform. The directories of the config files are watched with inotify,
+so that files replaced by a rename are seen too, or polled where inotify
+isn't available. A burst of writes is applied once it has been quiet for
+`debounce` seconds, and only if the content of the files changed.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from .configuration import UserConfig
+from .metrics import parse_interval
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEBOUNCE = 0.2
+# Seconds between two checks of the files without inotify
+POLL_INTERVAL = 1
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+# Not IN_MODIFY: the logs supervisord keeps open next to angelo.yml would
+# wake the watcher on every line
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# wd, mask, cookie, len, followed by len bytes of name
+EVENT = struct.Struct('iIII')
+
+
+class WatchOptions(namedtuple('_WatchOptions', 'enabled debounce')):
+    """
+    :param enabled: whether the agent applies the config when it changes
+    :param debounce: seconds without writes after which a change is applied
+    """
+
+    @classmethod
+    def from_dict(cls, options):
+        options = options or {}
+        return cls(
+            bool(options.get('enabled', True)),
+            parse_interval(options.get('debounce'), DEFAULT_DEBOUNCE),
+        )
+
+
+def get_watch_options():
+    """Read the `watch` section of angelo.yml."""
+    try:
+        user_config = UserConfig().config or {}
+    except IOError:
+        user_config = {}
+    return WatchOptions.from_dict(user_config.get('watch'))
+
+
+def content_hash(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except IOError:
+            digest.update(b'-')
+    return digest.hexdigest()
+
+
+class Inotify(object):
+    """inotify watches on directories, through libc."""
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories = {}
+        try:
+            for directory in directories:
+                wd = libc.inotify_add_watch(self.fd, directory.encode('utf-8'), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                self.directories[wd] = directory
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout):
+        """
+        The paths changed within `timeout` seconds, None when the kernel
+        dropped events and any path may have changed.
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.directories:
+                paths.add(os.path.join(self.directories[wd], name))
+        return paths
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Poller(object):
+    """Stands for Inotify where it isn't available, comparing mtimes."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.mtimes = self.stat()
+
+    def stat(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def read(self, timeout):
+        time.sleep(min(timeout, POLL_INTERVAL))
+        mtimes = self.stat()
+        changed = set(path for path in self.paths if mtimes[path] != self.mtimes[path])
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+
+class ConfigWatcher(object):
+    """
+    Call `on_change` when the content of config files changed.
+
+    :param paths: the config files
+    :param on_change: called without arguments, in the watcher's thread
+    """
+
+    def __init__(self, paths, on_change, debounce=DEFAULT_DEBOUNCE):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.on_change = on_change
+        self.debounce = debounce
+        self.digest = content_hash(self.paths)
+        self.stopping = threading.Event()
+        self.thread = None
+        try:
+            self.source = Inotify(sorted(set(os.path.dirname(path) for path in self.paths)))
+        except OSError as e:
+            log.debug('Polling the config files, no inotify: {}'.format(e))
+            self.source = Poller(self.paths)
+
+    def changed(self, paths):
+        return paths is None or any(path in paths for path in self.paths)
+
+    def check(self, timeout=POLL_INTERVAL):
+        """Wait up to `timeout` seconds for a change and apply it, if any."""
+        if not self.changed(self.source.read(timeout)):
+            return False
+        # Coalesce the writes of an editor or of a file written in parts
+        last_change = time.time()
+        while not self.stopping.is_set():
+            remaining = last_change + self.debounce - time.time()
+            if remaining <= 0:
+                break
+            if self.changed(self.source.read(remaining)):
+                last_change = time.time()
+        digest = content_hash(self.paths)
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        try:
+            self.on_change()
+        except Exception:
+            log.exception('Applying the changed config failed')
+        return True
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                self.check()
+        finally:
+            self.source.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='config-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        # on_change may stop its own watcher
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
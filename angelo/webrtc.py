@@ -6,7 +6,9 @@ import os
 import sys
 import json
 import argparse
-import subprocess
+import threading
+from .capture import check_plugins
+from .capture import get_capture_pipeline
 from .mqtt import daemon
 
 import gi
@@ -17,29 +19,8 @@ from gi.repository import GstWebRTC
 gi.require_version('GstSdp', '1.0')
 from gi.repository import GstSdp
 
-RPI_PIPELINE_DESC = '''
-webrtcbin name=sendrecv bundle-policy=max-bundle
- rpicamsrc bitrate=5000000 do-timestamp=true preview=false ! video/x-h264,width=1024,height=768,framerate=30/1 ! h264parse ! 
- rtph264pay config-interval=1 pt=9 ! queue ! application/x-rtp,media=video,encoding-name=H264,payload=97 ! sendrecv. 
-'''
-
-PIPELINE_DESC = '''
-webrtcbin name=sendrecv bundle-policy=max-bundle
- v4l2src device=/dev/video0 ! videoconvert ! queue ! vp8enc deadline=1 ! rtpvp8pay !
- queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 ! sendrecv.
- audiotestsrc is-live=true wave=red-noise ! audioconvert ! audioresample ! queue ! opusenc ! rtpopuspay !
- queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 ! sendrecv.
-'''
-
-JETSON_PIPELINE_DESC = '''
-webrtcbin name=sendrecv bundle-policy=max-bundle
- v4l2src device=/dev/video0 ! video/x-raw,format=RGB16 ! videoscale ! video/x-raw,width=640,height=480 ! videoconvert ! queue ! vp8enc deadline=1 ! rtpvp8pay !
- queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 ! sendrecv.
-'''
-
-
 class WebRTCClient(daemon):
-    def __init__(self, id_, peer_id, server, pid, conf):
+    def __init__(self, id_, peer_id, server, pid, conf, capture=None):
         self.id_ = id_
         self.conn = None
         self.pipe = None
@@ -48,6 +29,10 @@ class WebRTCClient(daemon):
         self.server = server or 'wss://webrtc-signal-server-staging.app.psygig.com:443/'
         self.pidfile = pid
         self.conf = conf
+        # the shared capture pipeline the webrtc branch is attached to,
+        # that of the process running the call unless given
+        self.capture = capture
+        self.event_loop = None
 
     async def connect(self):
         sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
@@ -67,8 +52,11 @@ class WebRTCClient(daemon):
         with open('webrtc.log', 'a+') as log:
             log.write('Sending offer:\n%s\n' % text)
         msg = json.dumps({'sdp': {'type': 'offer', 'sdp': text}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(msg))
+        self.send_message(msg)
+
+    def send_message(self, msg):
+        # called from GStreamer's threads, the connection belongs to the call's loop
+        asyncio.run_coroutine_threadsafe(self.conn.send(msg), self.event_loop)
 
     def on_offer_created(self, promise, _, __):
         promise.wait()
@@ -85,8 +73,7 @@ class WebRTCClient(daemon):
 
     def send_ice_candidate_message(self, _, mlineindex, candidate):
         icemsg = json.dumps({'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(icemsg))
+        self.send_message(icemsg)
 
     def on_incoming_decodebin_stream(self, _, pad):
         if not pad.has_current_caps():
@@ -131,25 +118,23 @@ class WebRTCClient(daemon):
         #decodebin.sync_state_with_parent()
         #self.webrtc.link(decodebin)
 
-    def start_pipeline(self):
-        # Check for jetson nano
-        cmd = "cat /proc/device-tree/model"
-        try:
-            result = subprocess.check_output(cmd, shell=True)
-            if result == 'jetson-nano' or result == b'NVIDIA Jetson Nano Developer Kit\x00':
-                self.pipe = Gst.parse_launch(JETSON_PIPELINE_DESC)
-            elif result.decode('utf-8').startswith('Raspberry Pi'):
-                self.pipe = Gst.parse_launch(RPI_PIPELINE_DESC)
-            else:
-                self.pipe = Gst.parse_launch(PIPELINE_DESC)
-        except subprocess.CalledProcessError:
-            self.pipe = Gst.parse_launch(PIPELINE_DESC)
-
-        self.webrtc = self.pipe.get_by_name('sendrecv')
+    def setup_webrtc(self, bin):
+        # connected before the branch plays, to see its first negotiation
+        self.webrtc = bin.get_by_name('sendrecv')
         self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
         self.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
         self.webrtc.connect('pad-added', self.on_incoming_stream)
-        self.pipe.set_state(Gst.State.PLAYING)
+
+    def on_detach(self, branch):
+        # `angelo offline` or a failure of the branch ends the call
+        if self.conn is not None and self.event_loop is not None:
+            asyncio.run_coroutine_threadsafe(self.conn.close(), self.event_loop)
+
+    def start_pipeline(self):
+        if self.capture is None:
+            self.capture = get_capture_pipeline()
+        self.capture.attach('webrtc', 'webrtc', setup=self.setup_webrtc, on_detach=self.on_detach)
+        self.pipe = self.capture.pipe
 
     async def handle_sdp(self, message):
         assert (self.webrtc)
@@ -174,39 +159,43 @@ class WebRTCClient(daemon):
 
     async def loop(self):
         assert self.conn
-        async for message in self.conn:
-            if message == 'HELLO':
-                await self.setup_call()
-            elif message == 'SESSION_OK':
-                self.start_pipeline()
-            elif message.startswith('ERROR'):
-                print (message)
-                return 1
-            else:
-                await self.handle_sdp(message)
+        try:
+            async for message in self.conn:
+                if message == 'HELLO':
+                    await self.setup_call()
+                elif message == 'SESSION_OK':
+                    self.start_pipeline()
+                elif message.startswith('ERROR'):
+                    print (message)
+                    return 1
+                else:
+                    await self.handle_sdp(message)
+        finally:
+            if self.capture is not None:
+                self.capture.detach('webrtc')
         return 0
 
+    def run_call(self):
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        self.event_loop.run_until_complete(self.connect())
+        return self.event_loop.run_until_complete(self.loop())
 
-def check_plugins():
-    needed = ["opus", "vpx", "nice", "webrtc", "dtls", "srtp", "rtp",
-              "rtpmanager", "videotestsrc", "audiotestsrc"]
-    missing = list(filter(lambda p: Gst.Registry.get().find_plugin(p) is None, needed))
-    if len(missing):
-        print('Missing gstreamer plugins:', missing)
-        return False
-    return True
+    def start_call(self):
+        """Run the call in a thread, for the agent."""
+        thread = threading.Thread(target=self.run_call, name='webrtc')
+        thread.daemon = True
+        thread.start()
 
 
 if __name__=='__main__':
     Gst.init(None)
-    if not check_plugins():
+    if not check_plugins(Gst, 'webrtc'):
         sys.exit(1)
     parser = argparse.ArgumentParser()
     parser.add_argument('peerid', help='String ID of the peer to connect to')
     parser.add_argument('--server', help='Signalling server to connect to, eg "wss://127.0.0.1:8443"')
     args = parser.parse_args()
     our_id = random.randrange(10, 10000)
-    c = WebRTCClient(our_id, args.peerid, args.server)
-    asyncio.get_event_loop().run_until_complete(c.connect())
-    res = asyncio.get_event_loop().run_until_complete(c.loop())
-    sys.exit(res)
\ No newline at end of file
+    c = WebRTCClient(our_id, args.peerid, args.server, 'webrtc.pid', None, get_capture_pipeline())
+    sys.exit(c.run_call())
\ No newline at end of file
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark how long the commands of the angelo CLI take, from exec to their
+first output and to their exit, with supervisord and the agent stubbed out
+by stubbed_angelo.py.
+
+    python tests/benchmarks/cli_startup.py --output bench.json
+    python tests/benchmarks/cli_startup.py --compare bench.json
+
+Every command of TopLevelCommand runs against every config under
+tests/fixtures, in a scratch copy of the fixture with its own HOME:
+
+- cold runs get an empty bytecode cache, like the first run after an install
+- warm runs follow a run that filled the cache
+- the import graph of a warm run is recorded with `-X importtime`
+
+Pythons before 3.8 can't give cold runs a cache of their own, and before 3.7
+have no `-X importtime`: their results leave those parts out.
+
+Commands that need the network, a camera or a terminal (live, register...)
+are timed with --help, which covers the startup cost shared by all commands.
+With --compare, the warm medians are compared with those of an earlier
+result file, and the exit status is 1 when a command got slower than the
+threshold.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import re
+import selectors
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+STUBBED_ANGELO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubbed_angelo.py')
+
+# The arguments each command is run with
+COMMANDS = [
+    ('version', ['version']),
+    ('help', ['help']),
+    ('config', ['config']),
+    ('ps', ['ps']),
+    ('top', ['top', '--delay', '0.05']),
+    ('logs', ['logs', '--tail', '10']),
+    ('metrics', ['metrics']),
+    ('up', ['up', '-d']),
+    ('start', ['start']),
+    ('restart', ['restart']),
+    ('reload', ['reload']),
+    ('kill', ['kill']),
+    ('stop', ['stop']),
+    ('down', ['down']),
+    ('run', ['run']),
+    ('install', ['install']),
+    ('publish', ['publish']),
+    ('register', ['register', '--help']),
+    ('live', ['live', '--help']),
+    ('offline', ['offline', '--help']),
+    ('broadcast', ['broadcast', '--help']),
+    ('record', ['record', '--help']),
+    ('track', ['track', '--help']),
+]
+
+# PYTHONPYCACHEPREFIX is ignored before Python 3.8, -X importtime before 3.7
+HAS_PYCACHE_PREFIX = sys.version_info >= (3, 8)
+HAS_IMPORT_TIME = sys.version_info >= (3, 7)
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+TOP_IMPORTS = 15
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def summarize(timings):
+    return {
+        'runs': len(timings),
+        'min': min(timings),
+        'median': median(timings),
+        'max': max(timings),
+    }
+
+
+class Workspace(object):
+    """A scratch copy of a fixture, with a HOME of its own."""
+
+    def __init__(self, fixture):
+        self.path = tempfile.mkdtemp(prefix='angelo-bench-')
+        self.cwd = os.path.join(self.path, 'project')
+        shutil.copytree(os.path.join(FIXTURES, fixture), self.cwd)
+        self.home = os.path.join(self.path, 'home')
+        os.mkdir(self.home)
+
+    def env(self, pycache=None):
+        env = dict(os.environ)
+        env.pop('ANGELO_PATH', None)
+        env['HOME'] = self.home
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        if pycache is not None:
+            env['PYTHONPYCACHEPREFIX'] = pycache
+        return env
+
+    def run(self, argv, pycache=None, python_args=()):
+        """Run a command, returning (seconds to first output, seconds to exit, stderr)."""
+        args = [sys.executable] + list(python_args) + [STUBBED_ANGELO] + list(argv)
+        start = time.time()
+        process = subprocess.Popen(args, cwd=self.cwd, env=self.env(pycache),
+                                   stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        first_output = None
+        stderr = []
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ)
+            selector.register(process.stderr, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    if key.fileobj is process.stderr:
+                        stderr.append(data)
+                    # -X importtime writes to stderr before the command does
+                    if first_output is None and not (
+                            python_args and key.fileobj is process.stderr):
+                        first_output = time.time() - start
+        process.wait()
+        total = time.time() - start
+        stderr = b''.join(stderr).decode('utf-8', 'replace')
+        if process.returncode != 0:
+            raise RuntimeError('angelo {} exited with status {}:\n{}'.format(
+                ' '.join(argv), process.returncode, stderr))
+        return first_output if first_output is not None else total, total, stderr
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+
+def parse_import_time(stderr):
+    """The total import time and the slowest imports, from `-X importtime` output."""
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules.append((name, int(self_us)))
+        if not indent:
+            total += int(cumulative_us)
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return {
+        'total_us': total,
+        'modules': len(modules),
+        'slowest': [[name, self_us] for name, self_us in modules[:TOP_IMPORTS]],
+    }
+
+
+def benchmark(workspace, argv, cold_runs, warm_runs):
+    result = {'argv': argv}
+    if cold_runs:
+        cold_first, cold_total = [], []
+        for _ in range(cold_runs):
+            pycache = tempfile.mkdtemp(dir=workspace.path)
+            first_output, total, _ = workspace.run(argv, pycache=pycache)
+            cold_first.append(first_output)
+            cold_total.append(total)
+            shutil.rmtree(pycache)
+        result['cold'] = {'first_output': summarize(cold_first), 'total': summarize(cold_total)}
+
+    # Fills the cache warm runs use
+    workspace.run(argv)
+    warm_first, warm_total = [], []
+    for _ in range(warm_runs):
+        first_output, total, _ = workspace.run(argv)
+        warm_first.append(first_output)
+        warm_total.append(total)
+    result['warm'] = {'first_output': summarize(warm_first), 'total': summarize(warm_total)}
+
+    if HAS_IMPORT_TIME:
+        _, _, stderr = workspace.run(argv, python_args=['-X', 'importtime'])
+        result['imports'] = parse_import_time(stderr)
+    return result
+
+
+def run_suite(fixtures, commands, cold_runs, warm_runs):
+    results = {}
+    for fixture in fixtures:
+        workspace = Workspace(fixture)
+        try:
+            for name, argv in commands:
+                key = '{}/{}'.format(fixture, name)
+                result = results[key] = benchmark(workspace, argv, cold_runs, warm_runs)
+                cold = 'cold {:7.3f}s  '.format(
+                    result['cold']['total']['median']) if 'cold' in result else ''
+                print('{:<40} {}warm {:7.3f}s  first output {:7.3f}s'.format(
+                    key, cold, result['warm']['total']['median'],
+                    result['warm']['first_output']['median']), file=sys.stderr)
+        finally:
+            workspace.close()
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold, min_delta):
+    """Print the change of every warm median, and return the regressed commands."""
+    regressions = []
+    rows = []
+    for key in sorted(current['results']):
+        if key not in baseline['results']:
+            continue
+        before = baseline['results'][key]['warm']['total']['median']
+        after = current['results'][key]['warm']['total']['median']
+        change = (after - before) / before if before else 0
+        regressed = change > threshold and after - before > min_delta
+        if regressed:
+            regressions.append(key)
+        rows.append('{:<40} {:8.3f}s {:8.3f}s {:+7.1%}{}'.format(
+            key, before, after, change, '  REGRESSION' if regressed else ''))
+    print('{:<40} {:>9} {:>9} {:>7}'.format('Command', 'Before', 'After', 'Change'))
+    print('\n'.join(rows))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the angelo CLI.')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression (default: 0.1)')
+    parser.add_argument('--min-delta', type=float, default=0.02,
+                        help='seconds of slowdown below which nothing is reported '
+                             '(default: 0.02)')
+    parser.add_argument('--cold-runs', type=int, default=2)
+    parser.add_argument('--warm-runs', type=int, default=5)
+    parser.add_argument('--fixture', action='append',
+                        help='fixture directory under tests/fixtures (default: all)')
+    parser.add_argument('--command', action='append',
+                        help='command to benchmark (default: all)')
+    args = parser.parse_args(argv)
+
+    fixtures = args.fixture or sorted(
+        name for name in os.listdir(FIXTURES)
+        if os.path.isdir(os.path.join(FIXTURES, name)))
+    commands = [(name, command_argv) for name, command_argv in COMMANDS
+                if not args.command or name in args.command]
+    cold_runs = args.cold_runs
+    if cold_runs and not HAS_PYCACHE_PREFIX:
+        print('warning: Python {} ignores PYTHONPYCACHEPREFIX, not timing cold runs'.format(
+            platform.python_version()), file=sys.stderr)
+        cold_runs = 0
+    if not HAS_IMPORT_TIME:
+        print('warning: Python {} has no -X importtime, not recording import graphs'.format(
+            platform.python_version()), file=sys.stderr)
+    current = run_suite(fixtures, commands, cold_runs, args.warm_runs)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, current, args.threshold, args.min_delta):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
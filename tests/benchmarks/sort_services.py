@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark sort_service_dicts on generated service sets of growing size.
+
+    python tests/benchmarks/sort_services.py
+    python tests/benchmarks/sort_services.py --sizes 1000 2000 4000 8000 --output sort.json
+
+Every size is sorted in a few shapes:
+
+- chain: every service depends on the previous one
+- fan: every service depends on the first one
+- layers: services in layers of 50, each depending on 3 services of the
+  layer before through depends_on, links or pid
+
+The median time of each run is printed along with its ratio to the
+previous size, which stays close to the ratio of the sizes when the sort
+scales linearly.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+from angelo.config.sort_services import sort_service_dicts  # noqa: E402
+
+LAYER_SIZE = 50
+
+
+def chain(size):
+    return [
+        {'name': 'service{}'.format(i), 'depends_on': ['service{}'.format(i - 1)] if i else []}
+        for i in range(size)
+    ]
+
+
+def fan(size):
+    return [
+        {'name': 'service{}'.format(i), 'depends_on': ['service0'] if i else []}
+        for i in range(size)
+    ]
+
+
+def layers(size):
+    rand = random.Random(size)
+    services = []
+    for i in range(size):
+        service = {'name': 'service{}'.format(i)}
+        if i >= LAYER_SIZE:
+            layer_start = (i // LAYER_SIZE - 1) * LAYER_SIZE
+            deps = ['service{}'.format(layer_start + rand.randrange(LAYER_SIZE)) for _ in range(3)]
+            service['depends_on'] = deps[:1]
+            service['links'] = ['{}:alias'.format(deps[1])]
+            service['pid'] = 'service:{}'.format(deps[2])
+        services.append(service)
+    rand.shuffle(services)
+    return services
+
+
+SHAPES = [('chain', chain), ('fan', fan), ('layers', layers)]
+
+
+def run(sizes, runs):
+    results = {}
+    for shape, generate in SHAPES:
+        previous = None
+        for size in sizes:
+            services = generate(size)
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                sort_service_dicts(services)
+                times.append(time.perf_counter() - start)
+            median = statistics.median(times)
+            results['{} {}'.format(shape, size)] = median
+            ratio = '' if previous is None else '{:6.2f}x'.format(median / previous)
+            print('{:<8} {:>7} services  {:9.4f}s  {}'.format(shape, size, median, ratio))
+            previous = median
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sort of services by dependencies.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000, 8000])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.runs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Run the angelo CLI with supervisord and the agent stubbed out, for
+cli_startup.py to time commands without starting any service.
+
+    python tests/benchmarks/stubbed_angelo.py ps
+
+angelo.cli.main is imported before anything is stubbed, so that
+`-X importtime` reports the imports of the CLI itself.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import sys
+import time
+
+import angelo.cli.main
+from angelo.supervisor import process_names
+from angelo.supervisor import Supervisor
+
+
+class FakeSupervisord(object):
+    """Answer supervisord's RPC calls as if every service of the config was RUNNING."""
+
+    def __init__(self):
+        self.states = {}
+        self.started = int(time.time())
+
+    def infos(self, supervisor):
+        for service in supervisor.services:
+            for name in process_names(service):
+                group, _, process = name.rpartition(':')
+                state = self.states.get(name, 'RUNNING')
+                yield {
+                    'name': process,
+                    'group': group or process,
+                    'statename': state,
+                    'pid': os.getpid() if state == 'RUNNING' else 0,
+                    'start': self.started,
+                    'stop': 0,
+                    'now': int(time.time()),
+                    'exitstatus': 0,
+                    'spawnerr': '',
+                    'description': 'pid {}'.format(os.getpid()),
+                }
+
+    def info(self, supervisor, name):
+        for info in self.infos(supervisor):
+            if name in (info['name'], '{}:{}'.format(info['group'], info['name'])):
+                return info
+        return None
+
+    def call(self, supervisor, method, *args):
+        if method == 'supervisor.getState':
+            return {'statecode': 1, 'statename': 'RUNNING'}
+        if method == 'supervisor.getAllProcessInfo':
+            return list(self.infos(supervisor))
+        if method == 'supervisor.getProcessInfo':
+            return self.info(supervisor, args[0])
+        if method == 'supervisor.reloadConfig':
+            return [[[], [], []]]
+        if method == 'supervisor.tailProcessStdoutLog':
+            return ['', 0, False]
+        if method.endswith('AllProcesses'):
+            return []
+        if method == 'system.multicall':
+            return [self.apply(supervisor, call['methodName'], call['params'])
+                    for call in args[0]]
+        return True
+
+    def apply(self, supervisor, method, params):
+        if method == 'supervisor.startProcess':
+            self.states[params[0]] = 'RUNNING'
+        elif method in ('supervisor.stopProcess', 'supervisor.stopProcessGroup'):
+            for info in self.infos(supervisor):
+                if params[0] in (info['group'], info['name'],
+                                 '{}:{}'.format(info['group'], info['name'])):
+                    self.states['{}:{}'.format(info['group'], info['name'])
+                                if info['group'] != info['name'] else info['name']] = 'STOPPED'
+        return True
+
+
+def install_stubs():
+    fake = FakeSupervisord()
+    Supervisor.call = lambda self, method, *args: fake.call(self, method, *args)
+    Supervisor.is_running = lambda self: True
+    # stop would signal the pid of supervisord
+    Supervisor.get_pid = lambda self: None
+    Supervisor.run_supervisor = lambda self, timeout=None: fake.call(self, 'supervisor.getState')
+    # Commands run by themselves rather than in an agent
+    angelo.cli.main.agent_from_options = lambda options: None
+
+
+if __name__ == '__main__':
+    install_stubs()
+    sys.argv[0] = 'angelo'
+    angelo.cli.main.main()
@@ -0,0 +1,143 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from angelo.agent import Agent
+from angelo.agent import AgentClient
+from angelo.agent import RemoteSystem
+from angelo.errors import OperationFailedError
+from angelo.parallel import parallel_execute
+from angelo.parallel import ParallelStreamWriter
+from angelo.system import NoSuchService
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.path, 'angelo.yml')
+        open(self.config_file, 'w').close()
+        self.socket_file = os.path.join(self.path, 'angelo.sock')
+        self.systems = []
+        self.agent = Agent(self.load_system, [self.config_file], socket_file=self.socket_file)
+        logging.getLogger().addHandler(self.agent.log_handler)
+        server = self.agent.bind()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.system = RemoteSystem(AgentClient(self.socket_file))
+
+    def tearDown(self):
+        self.agent.close_server()
+        logging.getLogger().removeHandler(self.agent.log_handler)
+        shutil.rmtree(self.path)
+
+    def load_system(self):
+        system = mock.Mock(service_names=['camera'])
+        system.get_service.return_value = mock.Mock(options={})
+        system.start_system.return_value = None
+        system.ps.return_value = [{'name': 'camera', 'statename': 'RUNNING', 'pids': [42]}]
+        self.systems.append(system)
+        return system
+
+    def test_commands_run_in_the_agent(self):
+        assert self.system.ps(service_names=['camera']) == \
+            [{'name': 'camera', 'statename': 'RUNNING', 'pids': [42]}]
+        self.system.up(service_names=['camera'], scale_override={'camera': 2})
+        assert self.system.service_names == ['camera']
+        system, = self.systems
+        system.ps.assert_called_once_with(service_names=['camera'])
+        system.start_system.assert_called_once_with(
+            service_names=['camera'], scale_override={'camera': 2})
+
+    def test_errors_and_logs_reach_the_cli(self):
+        def restart(service_names=None, timeout=None):
+            logging.getLogger('angelo.system').warning('Restarting %s', service_names[0])
+            raise NoSuchService(service_names[0])
+
+        self.agent.get_system().restart.side_effect = restart
+        with mock.patch('angelo.agent.log') as log:
+            with self.assertRaises(OperationFailedError) as context:
+                self.system.restart(service_names=['nope'])
+        assert context.exception.msg == 'No such service: nope'
+        log.log.assert_called_once_with(logging.WARNING, 'Restarting nope')
+
+    def test_scale_overrides_are_kept_when_the_config_changes(self):
+        self.system.up(scale_override={'camera': 3, 'nope': 2})
+        os.utime(self.config_file, (0, 0))
+        self.system.ps()
+        assert len(self.systems) == 2
+        assert self.systems[1].get_service('camera').options == {'scale': 3}
+        assert self.agent.scale_override == {'camera': 3}
+
+    def test_systems_loaded_again_share_the_mqtt_client_served(self):
+        self.agent.mqtt_client = self.agent.get_system().mqtt_client
+        os.utime(self.config_file, (0, 0))
+        assert self.agent.get_system().mqtt_client is self.systems[0].mqtt_client
+
+    def test_progress_of_each_command_reaches_the_cli(self):
+        def start_system(service_names=None, scale_override=None):
+            parallel_execute(service_names, lambda name: None, lambda name: name, 'Starting')
+
+        self.agent.get_system().start_system.side_effect = start_system
+        with mock.patch('angelo.agent.sys.stderr') as stderr, \
+                mock.patch.object(ParallelStreamWriter, 'instance', None):
+            self.system.up(service_names=['camera'])
+            self.system.up(service_names=['detector'])
+            assert ParallelStreamWriter.instance is None
+        written = [c[0][0] for c in stderr.write.call_args_list]
+        assert written == [
+            'Starting camera ...\n', 'Starting camera ... done\n',
+            'Starting detector ...\n', 'Starting detector ... done\n',
+        ]
+
+    def test_config_is_loaded_again_when_it_changes(self):
+        self.system.ps()
+        self.system.ps()
+        assert len(self.systems) == 1
+        os.utime(self.config_file, (0, 0))
+        self.system.ps()
+        assert len(self.systems) == 2
+
+    def test_read_commands_use_the_last_config_loaded_when_it_is_invalid(self):
+        self.system.ps()
+        os.utime(self.config_file, (0, 0))
+        self.agent.load_system = mock.Mock(side_effect=OperationFailedError('Invalid angelo.yml'))
+        with mock.patch('angelo.agent.log') as log:
+            assert self.system.ps() == [{'name': 'camera', 'statename': 'RUNNING', 'pids': [42]}]
+            with self.assertRaises(OperationFailedError) as context:
+                self.system.restart()
+        assert context.exception.msg == 'Invalid angelo.yml'
+        log.error.assert_called_once_with('Using the config last loaded: Invalid angelo.yml')
+
+    def test_requests_must_be_objects(self):
+        assert self.agent.handle(['ps']) == {'error': 'Malformed request'}
+
+    def test_shutdown_frees_the_socket(self):
+        client = AgentClient(self.socket_file)
+        assert client.is_running()
+        self.system.down()
+        assert not client.is_running()
+        assert not os.path.exists(self.socket_file)
+        assert self.agent.stopping.is_set()
+
+    def test_changed_config_is_applied(self):
+        self.agent.apply_config()
+        system, = self.systems
+        system.reload.assert_called_once_with()
+
+        os.utime(self.config_file, (0, 0))
+        self.load_system = mock.Mock(side_effect=OperationFailedError('Invalid angelo.yml'))
+        self.agent.load_system = self.load_system
+        with mock.patch('angelo.agent.log') as log:
+            self.agent.apply_config()
+        log.error.assert_called_once_with('Not applying the changed config: Invalid angelo.yml')
+        system.reload.assert_called_once_with()
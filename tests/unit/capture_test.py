@@ -0,0 +1,141 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from angelo.capture import branch_description
+from angelo.capture import CaptureOptions
+from angelo.capture import CapturePipeline
+from angelo.capture import encoder_description
+from angelo.capture import required_plugins
+from angelo.capture import source_description
+from angelo.errors import OperationFailedError
+from angelo.system import System
+
+
+class CaptureDescriptionTest(unittest.TestCase):
+    def test_options(self):
+        assert CaptureOptions.from_dict(None) == ('/dev/video0', 640, 480, 30, 2000, None)
+        options = CaptureOptions.from_dict({'device': '/dev/video1', 'width': '1280', 'framerate': 15})
+        assert (options.device, options.width, options.framerate) == ('/dev/video1', 1280, 15)
+
+    def test_camera_is_opened_once_for_all_branches(self):
+        options = CaptureOptions.from_dict({'device': '/dev/video1'})
+        description = source_description(options)
+        assert description.startswith('v4l2src device="/dev/video1"')
+        assert description.endswith('width=640,height=480,framerate=30/1 ! tee name=raw allow-not-linked=true')
+        assert source_description(options, 'jetson').startswith('nvarguscamerasrc ')
+        assert source_description(options, 'raspberrypi').startswith('rpicamsrc ')
+
+    def test_encoder(self):
+        options = CaptureOptions.from_dict({'bitrate': 4000})
+        assert 'x264enc tune=zerolatency speed-preset=ultrafast bitrate=4000 key-int-max=60' in \
+            encoder_description(options)
+        options = CaptureOptions.from_dict({'encoder': 'omxh264enc'})
+        description = encoder_description(options)
+        assert ' ! omxh264enc ! ' in description
+        assert description.endswith('tee name=h264 allow-not-linked=true')
+
+    def test_plugins(self):
+        options = CaptureOptions.from_dict(None)
+        assert required_plugins(('frames',), options) == \
+            ['coreelements', 'videoconvert', 'videoscale', 'videorate', 'shm']
+        assert required_plugins(('record',), options)[4:] == \
+            ['videoparsersbad', 'x264', 'isomp4', 'multifile']
+        options = CaptureOptions.from_dict({'encoder': 'omxh264enc'})
+        assert required_plugins(('record',), options)[4:] == ['videoparsersbad', 'isomp4', 'multifile']
+
+    def test_branches(self):
+        options = CaptureOptions.from_dict(None)
+        assert branch_description('rtmp', options, 'rtmp://example.com/"live"') == \
+            'queue ! flvmux streamable=true ! rtmpsink location="rtmp://example.com/\\"live\\" live=1"'
+        assert 'splitmuxsink location="/data/video%05d.mp4" max-size-time=600000000000' in \
+            branch_description('record', options, '/data/video%05d.mp4')
+        assert 'shm-size=3686400' in branch_description('frames', options, '/data/capture.sock')
+        with self.assertRaises(OperationFailedError):
+            branch_description('hls', options)
+
+
+class CapturePipelineTest(unittest.TestCase):
+    def test_acquired_branches_are_detached_after_their_last_user(self):
+        capture = CapturePipeline(CaptureOptions.from_dict(None))
+        with mock.patch.object(capture, 'attach'), \
+                mock.patch.object(capture, 'detach', return_value=True) as detach:
+            capture.acquire('frames', 'frames', '/data/capture.sock')
+            capture.acquire('frames', 'frames', '/data/capture.sock')
+            assert not capture.release('frames')
+            assert not detach.called
+            assert capture.release('frames')
+            detach.assert_called_once_with('frames')
+
+
+class SystemCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.system = System('angelotest', [])
+        self.capture = mock.Mock(branches={})
+        patcher = mock.patch('angelo.capture.get_capture_pipeline', return_value=self.capture)
+        self.get_capture_pipeline = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_broadcast_attaches_a_branch(self):
+        self.system.broadcast('rtmp://example.com/live')
+        self.capture.attach.assert_called_once_with('broadcast', 'rtmp', 'rtmp://example.com/live')
+
+        self.capture.branches['broadcast'] = self.capture.attach.return_value
+        with self.assertRaises(OperationFailedError):
+            self.system.broadcast('rtmp://example.com/live')
+
+        self.system.stop_broadcast()
+        self.capture.detach.assert_called_once_with('broadcast')
+        self.capture.detach.return_value = False
+        with self.assertRaises(OperationFailedError):
+            self.system.stop_broadcast()
+
+    def test_frames_are_shared_with_each_module(self):
+        socket_path = self.system.share_frames()
+        assert socket_path.endswith('/capture.sock')
+        assert self.system.share_frames() == socket_path
+        assert self.capture.acquire.call_args_list == [mock.call('frames', 'frames', socket_path)] * 2
+        self.system.stop_sharing_frames()
+        self.capture.release.assert_called_once_with('frames')
+
+    def test_live_opens_the_camera_after_becoming_a_daemon(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cwd = os.getcwd()
+        os.chdir(path)
+        self.addCleanup(os.chdir, cwd)
+        self.system.angelo_conf = os.path.join(path, 'angelo.conf')
+        open(self.system.angelo_conf, 'w').close()
+        self.system._mqtt_client = mock.Mock(
+            default_payload={'group_id': 'group', 'identifier': 'device'}, channel_id='room')
+        # Not running yet, then started by the call
+        self.get_capture_pipeline.side_effect = [None, self.capture]
+        calls_at_fork = []
+
+        def fork():
+            calls_at_fork.append(list(self.get_capture_pipeline.call_args_list))
+            return 0
+
+        # webrtc needs GStreamer's introspection, which its module imports
+        gi = mock.MagicMock()
+        modules = {'gi': gi, 'gi.repository': gi.repository}
+        with mock.patch.dict(sys.modules, modules), \
+                mock.patch('os.fork', side_effect=fork), \
+                mock.patch('os.setsid'), mock.patch('os.umask'), mock.patch('os.dup2'):
+            from angelo.webrtc import WebRTCClient
+            with mock.patch.object(WebRTCClient, 'run_call', autospec=True,
+                                   side_effect=lambda client: client.start_pipeline() or 0), \
+                    self.assertRaises(SystemExit):
+                self.system.live()
+
+        assert calls_at_fork == [[mock.call(start=False)]] * 2
+        assert self.get_capture_pipeline.call_args_list[-1] == mock.call()
+        assert self.capture.attach.call_args[0] == ('webrtc', 'webrtc')
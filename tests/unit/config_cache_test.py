@@ -0,0 +1,94 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from angelo import config
+from angelo.config.cache import ConfigCache
+from angelo.config.environment import Environment
+
+CONFIG = """
+version: "1.0"
+services:
+  camera:
+    command: camera --device ${CAMERA_DEVICE}
+    env_file: camera.env
+"""
+
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.path, 'angelo.yml')
+        self.env_file = os.path.join(self.path, 'camera.env')
+        self.write(self.config_file, CONFIG)
+        self.write(self.env_file, 'FPS=30\n')
+        self.cache = ConfigCache(os.path.join(self.path, 'cache'))
+        self.key = [[self.config_file], self.path, False, True]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, filename, content):
+        with open(filename, 'w') as f:
+            f.write(content)
+
+    def load(self, **variables):
+        environment = Environment(variables)
+        loads = []
+
+        def load_config():
+            loads.append(True)
+            return config.load(config.find(self.path, [self.config_file], environment))
+
+        config_data = self.cache.load(self.key, environment, load_config)
+        service, = config_data.services
+        return service, bool(loads)
+
+    def test_config_is_loaded_from_the_cache(self):
+        service, loaded = self.load(CAMERA_DEVICE='0')
+        assert loaded
+        service, loaded = self.load(CAMERA_DEVICE='0', UNRELATED='1')
+        assert not loaded
+        assert service['command'] == 'camera --device 0'
+        assert service['environment'] == {'FPS': '30'}
+
+    def test_referenced_variables_are_part_of_the_key(self):
+        self.load(CAMERA_DEVICE='0')
+        service, loaded = self.load(CAMERA_DEVICE='1')
+        assert loaded
+        assert service['command'] == 'camera --device 1'
+
+    def test_files_read_are_part_of_the_key(self):
+        self.load(CAMERA_DEVICE='0')
+        self.write(self.env_file, 'FPS=60\n')
+        service, loaded = self.load(CAMERA_DEVICE='0')
+        assert loaded
+        assert service['environment'] == {'FPS': '60'}
+
+        # Only the content matters
+        os.utime(self.config_file, (0, 0))
+        _, loaded = self.load(CAMERA_DEVICE='0')
+        assert not loaded
+
+    def test_unset_variables_are_warned_about_on_a_hit(self):
+        self.load()
+        with mock.patch('angelo.config.environment.log') as log:
+            _, loaded = self.load()
+        assert not loaded
+        log.warn.assert_called_once_with(
+            'The CAMERA_DEVICE variable is not set. Defaulting to a blank string.')
+
+    def test_config_is_loaded_when_the_cache_cannot_be_written(self):
+        error = OSError(errno.EROFS, 'Read-only file system')
+        with mock.patch('angelo.config.cache.tempfile.mkstemp', side_effect=error):
+            service, loaded = self.load(CAMERA_DEVICE='0')
+        assert loaded
+        assert service['command'] == 'camera --device 0'
@@ -0,0 +1,71 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from angelo.configuration import UserConfig
+
+
+class UserConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.conf_path = os.path.join(self.path, 'angelo.yml')
+        self.write('SHOW_GUI: "yes"\n  CAM_INDEX: "1"\n  ALERT_TEMP: 38.5\n  VIDEO_SRC: null\n')
+
+    def write(self, env):
+        with open(self.conf_path, 'w') as f:
+            f.write('version: "1.0"\nenv:\n  ' + env)
+
+    def user_config(self):
+        user_config = UserConfig(self.conf_path)
+        self.addCleanup(user_config.close)
+        return user_config
+
+    def test_typed_values(self):
+        user_config = self.user_config()
+        assert user_config.config['version'] == '1.0'
+        assert user_config.get_bool('SHOW_GUI') is True
+        assert user_config.get_int('CAM_INDEX') == 1
+        assert user_config.get_float('ALERT_TEMP') == 38.5
+        assert user_config.get_str('ALERT_TEMP') == '38.5'
+        assert user_config.get_str('VIDEO_SRC', 'rtsp://camera') == 'rtsp://camera'
+        assert user_config.get_bool('CAPTURE_FRAME') is False
+
+    def test_file_is_parsed_once(self):
+        user_config = self.user_config()
+        with mock.patch('angelo.configuration.yaml.safe_load') as safe_load:
+            other = self.user_config()
+            other.reload()
+        assert not safe_load.called
+        assert other.config is user_config.config
+
+    def test_reload_calls_back_on_changed_values(self):
+        user_config = self.user_config()
+        callback = mock.Mock()
+        with mock.patch('angelo.watcher.ConfigWatcher'):
+            user_config.on_change('CAM_INDEX', callback)
+            user_config.on_change('SHOW_GUI', callback)
+        self.write('SHOW_GUI: "yes"\n  CAM_INDEX: 2\n')
+        user_config.reload()
+        callback.assert_called_once_with('CAM_INDEX', 2)
+        assert user_config.get_int('CAM_INDEX') == 2
+        assert self.user_config().get('ALERT_TEMP') is None
+
+    def test_watched_file_calls_back(self):
+        user_config = self.user_config()
+        changed = threading.Event()
+        user_config.on_change('SHOW_GUI', lambda key, value: changed.set())
+        self.write('SHOW_GUI: false\n')
+        assert changed.wait(5)
+        assert user_config.get_bool('SHOW_GUI') is False
+
+        user_config.close()
+        assert user_config.shared.watcher is None
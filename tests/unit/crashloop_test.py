@@ -0,0 +1,67 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+import mock
+
+from angelo.crashloop import CrashLoopOptions
+from angelo.crashloop import CrashLoopWatcher
+
+
+def info(state, start, stop, exitstatus=0):
+    return {'name': 'camera', 'group': 'camera', 'statename': state,
+            'start': start, 'stop': stop, 'exitstatus': exitstatus}
+
+
+class CrashLoopWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = mock.Mock()
+        self.publish_event = mock.Mock()
+        self.watcher = CrashLoopWatcher(
+            self.supervisor, self.publish_event, CrashLoopOptions(True, 1, 3, 60, 10, 30, 20))
+
+    def poll(self, now, process):
+        self.supervisor.get_all_process_info.return_value = [process]
+        self.watcher.clock = lambda: now
+        self.watcher.poll()
+
+    def crash(self, now):
+        self.poll(now, info('EXITED', now - 2, now, exitstatus=3))
+
+    def test_backs_off_exponentially(self):
+        self.poll(0, info('RUNNING', 0, 0))
+        self.crash(2)
+        self.poll(3, info('RUNNING', 3, 2))
+        self.crash(5)
+        assert not self.publish_event.called
+        self.crash(8)
+        data, event_type = self.publish_event.call_args[0]
+        assert event_type == 'service_crashloop'
+        assert data['exit_codes'] == [3, 3, 3]
+        assert data['backoff'] == 10
+
+        # Respawned by supervisord, then stopped by the watcher
+        self.poll(9, info('STARTING', 9, 8))
+        self.supervisor.stop_processes.assert_called_once_with(['camera:camera'], wait=False)
+        self.poll(10, info('STOPPED', 9, 10))
+        self.poll(15, info('STOPPED', 9, 10))
+        assert not self.supervisor.start_processes.called
+        self.poll(18, info('STOPPED', 9, 10))
+        self.supervisor.start_processes.assert_called_once_with(['camera:camera'], wait=False)
+
+        # A single crash is now enough, and the delay doubles up to max_backoff
+        self.crash(21)
+        assert self.publish_event.call_args[0][0]['backoff'] == 20
+        self.poll(41, info('STOPPED', 19, 21))
+        self.poll(42, info('RUNNING', 42, 21))
+        self.crash(44)
+        assert self.publish_event.call_args[0][0]['backoff'] == 30
+
+    def test_processes_stopped_on_request_are_not_crashing(self):
+        self.poll(0, info('RUNNING', 0, 0))
+        for now in range(1, 10, 2):
+            self.poll(now, info('STOPPED', now - 1, now))
+            self.poll(now + 1, info('RUNNING', now + 1, now))
+        assert not self.publish_event.called
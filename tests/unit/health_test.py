@@ -0,0 +1,80 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import socket
+import unittest
+
+from angelo.errors import HealthCheckFailed
+from angelo.errors import NoHealthCheckConfigured
+from angelo.health import ExecProbe
+from angelo.health import Healthcheck
+from angelo.health import HealthMonitor
+from angelo.health import HttpProbe
+from angelo.health import ProbeRunner
+from angelo.health import TcpProbe
+from angelo.process import Process
+
+
+class HealthcheckTest(unittest.TestCase):
+    def test_probes_from_dict(self):
+        assert Healthcheck.from_dict({'tcp': 8080}).probe == TcpProbe('localhost', 8080)
+        assert Healthcheck.from_dict({'tcp': 'camera:554'}).probe == TcpProbe('camera', 554)
+        assert Healthcheck.from_dict({'http': '8080/ready'}).probe == \
+            HttpProbe('http://localhost:8080/ready')
+        assert Healthcheck.from_dict({'test': ['CMD', 'true']}).probe == ExecProbe(['true'], False)
+        assert Healthcheck.from_dict({'test': 'exit 0'}).probe == ExecProbe('exit 0', True)
+        assert Healthcheck.from_dict({'test': ['NONE']}) is None
+        assert Healthcheck.from_dict(None) is None
+
+    def test_durations_are_converted_from_nanoseconds(self):
+        healthcheck = Healthcheck.from_dict({'tcp': 80, 'interval': 500000000, 'retries': 5})
+        assert healthcheck.interval == 0.5
+        assert healthcheck.timeout == 1
+        assert healthcheck.retries == 5
+
+    def test_tcp_probe(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            port = server.getsockname()[1]
+            assert Healthcheck.from_dict({'tcp': '127.0.0.1:{}'.format(port)}).check()
+        finally:
+            server.close()
+        assert not Healthcheck.from_dict({'tcp': '127.0.0.1:{}'.format(port)}).check()
+
+    def test_exec_probe(self):
+        assert Healthcheck.from_dict({'test': ['CMD', 'true']}).check()
+        assert not Healthcheck.from_dict({'test': ['CMD-SHELL', 'exit 1']}).check()
+
+
+class ProbeRunnerTest(unittest.TestCase):
+    def test_unhealthy_after_retries_past_start_period(self):
+        runner = ProbeRunner(Healthcheck(None, 1, 1, 2, 10))
+        runner.started_at = 0
+        runner.update(False, 5)
+        runner.update(False, 6)
+        assert runner.status == 'starting'
+        runner.update(False, 11)
+        assert runner.status == 'starting'
+        runner.update(False, 12)
+        assert runner.status == 'unhealthy'
+        runner.update(True, 13)
+        assert runner.status == 'healthy'
+
+
+class HealthMonitorTest(unittest.TestCase):
+    def test_ready_check(self):
+        monitor = HealthMonitor()
+        service = Process('camera', command='camera', healthcheck={'tcp': 554})
+        assert monitor.ready_check(service) is False
+
+        monitor.runners['camera'] = runner = ProbeRunner(None)
+        runner.status = 'healthy'
+        assert monitor.ready_check(service) is True
+        runner.status = 'unhealthy'
+        with self.assertRaises(HealthCheckFailed):
+            monitor.ready_check(service)
+        with self.assertRaises(NoHealthCheckConfigured):
+            monitor.ready_check(Process('uploader', command='uploader'))
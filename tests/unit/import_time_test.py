@@ -0,0 +1,40 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import subprocess
+import sys
+import unittest
+
+# Only the commands that need them may import these
+HEAVY_MODULES = ('gi', 'websockets', 'requests', 'paho', 'pathspec', 'distutils', 'setuptools')
+
+# Import time of angelo.cli.main, in seconds. Generous, to catch a heavy
+# dependency creeping back in rather than to measure the CLI.
+IMPORT_TIME_BUDGET = 3
+
+
+def import_cli():
+    # Timed in the interpreter rather than with -X importtime, which
+    # Python 3.6 ignores
+    result = subprocess.run(
+        [sys.executable, '-c', (
+            'import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import angelo.cli.main\n'
+            'import_time = time.perf_counter() - start\n'
+            'print(json.dumps({"modules": sorted(sys.modules), "import_time": import_time}))\n'
+        )],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.decode('utf-8'))
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_cli_does_not_import_heavy_dependencies(self):
+        modules = import_cli()['modules']
+        loaded = [m for m in modules if m.split('.')[0] in HEAVY_MODULES]
+        assert loaded == []
+
+    def test_cli_import_time_budget(self):
+        assert import_cli()['import_time'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,60 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+from angelo.config.environment import Environment
+from angelo.config.errors import ConfigurationError
+from angelo.config.interpolation import compile_interpolation
+from angelo.config.interpolation import interpolate_environment_variables
+from angelo.const import ANGELOFILE_V1_0 as V1
+
+
+def interpolate(config, **variables):
+    return interpolate_environment_variables(V1, config, 'service', Environment(variables))
+
+
+class InterpolationTest(unittest.TestCase):
+    def test_substitutions(self):
+        config = {'camera': {
+            'command': 'camera --device $DEVICE --fps ${FPS:-30} --name ${NAME-cam} $$HOME',
+            'environment': {'STORE': '${STORE?store is required}', 'MODE': 'fast'},
+            'scale': '${SCALE}',
+            'cpus': '0.5',
+            'read_only': 'yes',
+        }}
+        service = interpolate(config, DEVICE='/dev/video0', NAME='', STORE='/data', SCALE='2')
+        assert service == {'camera': {
+            'command': 'camera --device /dev/video0 --fps 30 --name  $HOME',
+            'environment': {'STORE': '/data', 'MODE': 'fast'},
+            'scale': 2,
+            'cpus': 0.5,
+            'read_only': True,
+        }}
+
+    def test_errors(self):
+        with self.assertRaises(ConfigurationError) as context:
+            interpolate({'camera': {'command': 'camera ${'}})
+        assert 'Invalid interpolation format for "command"' in context.exception.msg
+
+        config = {'camera': {'environment': ['STORE=${STORE:?store is required}']}}
+        with self.assertRaises(ConfigurationError) as context:
+            interpolate(config)
+        assert 'Missing mandatory value for "environment" option in service "camera": ' \
+            'store is required' in context.exception.msg
+
+        with self.assertRaises(ConfigurationError) as context:
+            interpolate({'camera': {'scale': '${SCALE}'}}, SCALE='two')
+        assert 'service.camera.scale' in context.exception.msg
+
+    def test_plan_is_compiled_once_per_content(self):
+        config = {'camera': {'command': 'camera $DEVICE', 'ports': ['80']}}
+        plan = compile_interpolation(config, 'service')
+        assert compile_interpolation(dict(config), 'service') is plan
+        assert len(plan.slots) == 1
+
+        first = interpolate(config, DEVICE='0')
+        first['camera']['ports'].append('81')
+        second = interpolate(config, DEVICE='1')
+        assert second == {'camera': {'command': 'camera 1', 'ports': ['80']}}
@@ -0,0 +1,39 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import sys
+import unittest
+
+import mock
+
+from angelo.launcher import module_command
+from angelo.launcher import run_internal_command
+
+
+class LauncherTest(unittest.TestCase):
+    def test_modules_are_run_with_the_interpreter(self):
+        with mock.patch.object(sys, 'executable', '/usr/bin/python3'):
+            assert module_command('angelo.agent') == ['/usr/bin/python3', '-m', 'angelo.agent']
+
+    def test_frozen_binary_runs_itself_with_an_internal_command(self):
+        with mock.patch.object(sys, 'executable', '/usr/local/bin/angelo'), \
+                mock.patch.object(sys, 'frozen', True, create=True):
+            assert module_command('angelo.agent') == ['/usr/local/bin/angelo', '__agent']
+            assert module_command('supervisor.supervisord') == \
+                ['/usr/local/bin/angelo', '__supervisord']
+
+    def test_internal_commands_run_the_main_of_their_module(self):
+        with mock.patch('angelo.launcher.importlib.import_module') as import_module:
+            import_module.return_value.main.return_value = None
+            with self.assertRaises(SystemExit) as context:
+                run_internal_command(['__supervisord', '-c', 'supervisord.conf'])
+        import_module.assert_called_once_with('supervisor.supervisord')
+        import_module.return_value.main.assert_called_once_with(['-c', 'supervisord.conf'])
+        assert context.exception.code is None
+
+    def test_other_commands_are_left_to_the_cli(self):
+        with mock.patch('angelo.launcher.importlib.import_module') as import_module:
+            run_internal_command(['up', '-d'])
+            run_internal_command([])
+        assert not import_module.called
@@ -0,0 +1,88 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from angelo.limits import parse_args
+from angelo.limits import parse_cpuset
+from angelo.limits import ResourceLimits
+from angelo.limits import set_cgroup_limits
+from angelo.process import Process
+from angelo.supervisor import Supervisor
+from angelo.utils import parse_bytes
+
+
+class ResourceLimitsTest(unittest.TestCase):
+    def test_launcher_arguments_round_trip(self):
+        limits = ResourceLimits.from_dict({
+            'cpus': 1.5,
+            'cpuset': '0-1',
+            'mem_limit': 256 * 1024 ** 2,
+            'nice': 5,
+            'ionice': {'class': 'best-effort', 'level': 6},
+            'ulimits': {'nofile': {'soft': 1024, 'hard': 2048}, 'core': 0},
+        })
+        assert parse_args(limits.args('camera') + ['--', 'camera', '--fps', '30']) == \
+            (limits, 'camera', ['camera', '--fps', '30'])
+
+    def test_services_without_limits_have_none(self):
+        assert ResourceLimits.from_dict({'command': 'camera'}) is None
+
+    def test_parsers(self):
+        assert parse_cpuset('0-2,5') == set([0, 1, 2, 5])
+        assert parse_bytes('512m') == 512 * 1024 ** 2
+        assert parse_bytes('1.5gb') == int(1.5 * 1024 ** 3)
+        assert parse_bytes(100) == 100
+        assert parse_bytes('lots') is None
+
+    def test_limited_command_goes_through_the_launcher(self):
+        supervisor = Supervisor([
+            Process('camera', command='camera --fps 30', nice=10),
+            Process('uploader', command='uploader'),
+        ])
+        config = supervisor.get_config_from_services()
+        assert 'command={} -m angelo.limits --nice 10 -- camera --fps 30\n'.format(
+            sys.executable) in config
+        assert 'command=uploader\n' in config
+
+        with mock.patch.object(sys, 'executable', '/usr/local/bin/angelo'), \
+                mock.patch.object(sys, 'frozen', True, create=True):
+            config = supervisor.get_config_from_services()
+        assert 'command=/usr/local/bin/angelo __limits --nice 10 -- camera --fps 30\n' in config
+
+    def test_scaled_instances_are_pinned_to_distinct_cpus(self):
+        supervisor = Supervisor([
+            Process('worker', command='worker', scale=3, pin_cpus=True, cpuset='2-3'),
+        ])
+        config = supervisor.get_config_from_services()
+        assert 'numprocs=3\n' in config
+        assert 'process_name=%(program_name)s_%(process_num)d\n' in config
+        assert 'environment=ANGELO_INSTANCE="%(process_num)d",ANGELO_INSTANCES="3"\n' in config
+        assert "--cpuset 2-3 --pin-cpus '%(process_num)d' -- worker" in config
+
+        limits, _, _ = parse_args(['--cpuset', '2-3', '--pin-cpus', '3', '--', 'worker'])
+        with mock.patch('os.sched_setaffinity') as sched_setaffinity:
+            limits.apply('worker_3')
+        sched_setaffinity.assert_called_once_with(0, [3])
+
+    def test_cgroup_limits(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name in ('cgroup.controllers', 'cgroup.subtree_control'):
+                open(os.path.join(root, name), 'w').close()
+            set_cgroup_limits('camera', 0.5, 1024, root=root)
+            with open(os.path.join(root, 'angelo', 'camera', 'cpu.max')) as f:
+                assert f.read() == '50000 100000'
+            with open(os.path.join(root, 'angelo', 'camera', 'memory.max')) as f:
+                assert f.read() == '1024'
+            with open(os.path.join(root, 'angelo', 'cgroup.subtree_control')) as f:
+                assert f.read() == '+cpu +memory'
+        finally:
+            shutil.rmtree(root)
@@ -0,0 +1,28 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+from six import StringIO
+
+from angelo.cli.log_printer import build_log_presenters
+from angelo.cli.log_printer import LogPrinter
+from angelo.logstore import LogRecord
+
+
+class LogPrinterTest(unittest.TestCase):
+    def test_history_then_every_stream(self):
+        output = StringIO()
+        LogPrinter(
+            ['camera', 'uploader'],
+            build_log_presenters(['camera', 'uploader'], True),
+            {'camera': iter(['frame 1\nfra', 'me 2\n']), 'uploader': iter(['sent\n'])},
+            output=output,
+            history=[('uploader', LogRecord(1, 'started')), ('camera', LogRecord(2, 'started'))],
+        ).run()
+        lines = output.getvalue().splitlines()
+        assert lines[:2] == ['uploader    | started', 'camera      | started']
+        assert sorted(lines[2:]) == \
+            ['camera      | frame 1', 'camera      | frame 2', 'uploader    | sent']
+        assert lines.index('camera      | frame 1') < lines.index('camera      | frame 2')
@@ -0,0 +1,85 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from angelo.logstore import listen
+from angelo.logstore import LogOptions
+from angelo.logstore import LogRecord
+from angelo.logstore import LogStore
+from angelo.process import Process
+from angelo.supervisor import Supervisor
+
+
+class LogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.options = LogOptions(self.path, 4096, 3)
+        self.store = LogStore(self.options)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def fill(self, count):
+        for i in range(count):
+            self.store.append('camera', 1000 + i, 'line {}\n'.format(i).encode('utf-8') * 10)
+        self.store.close()
+        return LogStore(self.options).get('camera')
+
+    def test_partial_lines_wait_for_their_end(self):
+        self.store.append('camera', 10, b'fra')
+        self.store.append('camera', 11, b'me 1\nframe 2\n')
+        assert self.store.get('camera').read() == [
+            LogRecord(11, 'frame 1'), LogRecord(11, 'frame 2')]
+
+    def test_rotation_keeps_max_segments(self):
+        service_log = self.fill(200)
+        assert len(service_log.segments()) == 3
+        records = service_log.read()
+        assert records[-1] == LogRecord(1199, 'line 199')
+        assert records[0].timestamp > 1000
+
+    def test_since_and_tail(self):
+        service_log = self.fill(200)
+        assert service_log.read(since=1195) == \
+            [LogRecord(1195 + i // 10, 'line {}'.format(195 + i // 10)) for i in range(50)]
+        assert service_log.read(tail=25) == service_log.read()[-25:]
+        assert service_log.read(since=1199, tail=20) == \
+            [LogRecord(1199, 'line 199')] * 10
+        assert service_log.read(since=2000) == []
+
+    def test_timestamps_never_go_back(self):
+        self.store.append('camera', 10, b'a\n')
+        self.store.append('camera', 5, b'b\n')
+        assert [r.timestamp for r in self.store.get('camera').read()] == [10, 10]
+
+    def test_event_listener(self):
+        payload = b'processname:camera groupname:camera pid:1 channel:stdout\nhello\n'
+        stdin = io.BytesIO(
+            'ver:3.0 server:supervisor serial:1 pool:angelo_logs poolserial:1 '
+            'eventname:PROCESS_LOG_STDOUT len:{}\n'.format(len(payload)).encode('ascii')
+            + payload)
+        stdout = io.BytesIO()
+        listen(self.store, stdin, stdout)
+        assert stdout.getvalue() == b'READY\nRESULT 2\nOKREADY\n'
+        assert [r.line for r in self.store.get('camera').read()] == ['hello']
+
+    def test_services_log_to_the_listener(self):
+        supervisor = Supervisor([Process('camera', command='camera')], self.options)
+        config = supervisor.get_config_from_services()
+        assert 'stdout_events_enabled=true\n' in config
+        assert '[eventlistener:angelo_logs]\n' in config
+        assert '-m angelo.logstore --path {} '.format(self.path) in config
+
+        with mock.patch.object(sys, 'executable', '/usr/local/bin/angelo'), \
+                mock.patch.object(sys, 'frozen', True, create=True):
+            config = supervisor.get_config_from_services()
+        assert 'command=/usr/local/bin/angelo __logstore --path {} '.format(self.path) in config
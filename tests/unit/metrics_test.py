@@ -0,0 +1,277 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from angelo.metrics import CLOCK_TICKS
+from angelo.metrics import DeadbandFilter
+from angelo.metrics import HostMetricsCollector
+from angelo.metrics import MetricsOptions
+from angelo.metrics import MetricsReporter
+from angelo.metrics import parse_deadband
+from angelo.metrics import PAGE_SIZE
+from angelo.metrics import ProcessAccounting
+from angelo.metrics import ProcFile
+from angelo.metrics import ServiceMetricsCollector
+
+NET_DEV_HEADER = (
+    "Inter-|   Receive                                                |  Transmit\n"
+    " face |bytes    packets errs drop fifo frame compressed multicast|"
+    "bytes    packets errs drop fifo colls carrier compressed\n"
+)
+
+
+class HostMetricsCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.proc_root = os.path.join(self.root, 'proc')
+        self.sys_root = os.path.join(self.root, 'sys')
+        self.write_proc(
+            cpu='cpu  100 0 100 800 0 0 0 0 0 0',
+            diskstats='179 0 mmcblk0 10 0 100 0 5 0 200 0 0 0 0\n'
+                      '7 0 loop0 1 0 8 0 0 0 0 0 0 0 0',
+            net='eth0: 1000 10 0 0 0 0 0 0 2000 20 0 0 0 0 0 0\n'
+                '  lo: 50 1 0 0 0 0 0 0 50 1 0 0 0 0 0 0',
+        )
+        self.write(os.path.join(self.proc_root, 'meminfo'),
+                   'MemTotal:        1000 kB\nMemFree:          100 kB\n'
+                   'MemAvailable:     250 kB\nSwapTotal:          0 kB\n')
+        self.write(os.path.join(self.proc_root, 'loadavg'), '0.50 0.25 0.10 1/100 4242\n')
+        zone = os.path.join(self.sys_root, 'class', 'thermal', 'thermal_zone0')
+        self.write(os.path.join(zone, 'type'), 'cpu-thermal\n')
+        self.write(os.path.join(zone, 'temp'), '48312\n')
+        self.collector = HostMetricsCollector(
+            proc_root=self.proc_root, sys_root=self.sys_root, mounts=[self.root])
+
+    def tearDown(self):
+        self.collector.close()
+        shutil.rmtree(self.root)
+
+    def write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def write_proc(self, cpu, diskstats, net):
+        self.write(os.path.join(self.proc_root, 'stat'), cpu + '\nintr 1 2 3\n')
+        self.write(os.path.join(self.proc_root, 'diskstats'), diskstats + '\n')
+        self.write(os.path.join(self.proc_root, 'net', 'dev'), NET_DEV_HEADER + net + '\n')
+
+    def test_first_sample_has_gauges_but_no_rates(self):
+        values = self.collector.collect(now=0)
+        assert values['mem.total_bytes'] == 1000 * 1024
+        assert values['mem.used_percent'] == 75.0
+        assert 'swap.used_percent' not in values
+        assert values['load.1m'] == 0.5
+        assert values['thermal.cpu-thermal'] == 48.312
+        assert 0 <= values['fs.{}.used_percent'.format(self.root.strip('/').replace('/', '_'))] <= 100
+        assert 'cpu.percent' not in values
+        assert 'net.eth0.rx_bps' not in values
+
+    def test_rates_are_computed_from_deltas(self):
+        self.collector.collect(now=0)
+        self.write_proc(
+            cpu='cpu  150 0 150 900 0 0 0 0 0 0',
+            diskstats='179 0 mmcblk0 20 0 300 0 5 0 200 0 0 0 0\n'
+                      '7 0 loop0 1 0 8 0 0 0 0 0 0 0 0',
+            net='eth0: 3000 10 0 0 0 0 0 0 2500 20 0 0 0 0 0 0',
+        )
+        values = self.collector.collect(now=2)
+        assert values['cpu.percent'] == 50.0
+        assert values['disk.mmcblk0.read_bps'] == 200 * 512 / 2
+        assert values['disk.mmcblk0.write_bps'] == 0
+        assert 'disk.loop0.read_bps' not in values
+        assert values['net.eth0.rx_bps'] == 1000
+        assert values['net.eth0.tx_bps'] == 250
+        assert 'net.lo.rx_bps' not in values
+
+    def test_wrapped_counters_are_skipped(self):
+        self.collector.collect(now=0)
+        self.write_proc(
+            cpu='cpu  150 0 150 900 0 0 0 0 0 0',
+            diskstats='179 0 mmcblk0 20 0 300 0 5 0 200 0 0 0 0',
+            net='eth0: 10 10 0 0 0 0 0 0 2500 20 0 0 0 0 0 0',
+        )
+        values = self.collector.collect(now=1)
+        assert 'net.eth0.rx_bps' not in values
+        assert values['net.eth0.tx_bps'] == 500
+
+    def test_missing_files_do_not_break_collection(self):
+        os.remove(os.path.join(self.proc_root, 'diskstats'))
+        values = self.collector.collect(now=0)
+        assert 'load.1m' in values
+
+
+class ProcFileTest(unittest.TestCase):
+    def test_read_reuses_descriptor_and_grows_buffer(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'x' * 100)
+        os.close(fd)
+        proc_file = ProcFile(path, bufsize=16)
+        try:
+            assert proc_file.read() == 'x' * 100
+            descriptor = proc_file.fd
+            assert proc_file.bufsize >= 100
+            assert proc_file.read() == 'x' * 100
+            assert proc_file.fd == descriptor
+        finally:
+            proc_file.close()
+            os.remove(path)
+
+
+class MetricsReporterTest(unittest.TestCase):
+    def test_samples_are_published_in_one_batch(self):
+        collector = mock.Mock()
+        collector.collect.side_effect = [{'load.1m': 0.123}, {'load.1m': 0.5}]
+        publish = mock.Mock()
+        reporter = MetricsReporter([collector], publish)
+        reporter.sample()
+        reporter.sample()
+        reporter.flush()
+        reporter.flush()
+
+        publish.assert_called_once()
+        samples = publish.call_args[0][0]['samples']
+        assert [s['metrics'] for s in samples] == [{'load.1m': 0.12}, {'load.1m': 0.5}]
+
+    def test_batch_is_kept_when_publish_fails(self):
+        collector = mock.Mock()
+        collector.collect.return_value = {'load.1m': 1}
+        publish = mock.Mock(side_effect=[IOError('offline'), None])
+        reporter = MetricsReporter([collector], publish, max_batch=2)
+        for _ in range(3):
+            reporter.sample()
+        reporter.flush()
+        reporter.flush()
+
+        assert publish.call_count == 2
+        assert len(publish.call_args[0][0]['samples']) == 2
+
+    def test_options_from_dict(self):
+        options = MetricsOptions.from_dict({'interval': '500ms', 'publish_interval': 30})
+        assert options.enabled
+        assert options.interval == 0.5
+        assert options.publish_interval == 30
+        assert options.mounts == ['/']
+
+
+class DeadbandFilterTest(unittest.TestCase):
+    def test_values_are_reported_when_they_leave_the_deadband(self):
+        deadband = DeadbandFilter(*parse_deadband({
+            'max_silence': '1m',
+            'series': {'thermal.*': {'absolute': 0.5}, 'fs.*': {'percent': 10}},
+        }))
+        first = {'thermal.cpu': 40.0, 'fs.root.used_percent': 50.0, 'load.1m': 1.0}
+        assert deadband.filter(0, first) == (first, {})
+        assert deadband.filter(1, first) == ({}, {})
+        assert deadband.filter(2, {'thermal.cpu': 40.4, 'fs.root.used_percent': 54.0,
+                                   'load.1m': 1.01}) == ({'load.1m': 1.01}, {})
+        assert deadband.filter(3, {'thermal.cpu': 40.6, 'fs.root.used_percent': 56.0,
+                                   'load.1m': 1.01}) == \
+            ({'thermal.cpu': 40.6, 'fs.root.used_percent': 56.0}, {})
+        assert deadband.filter(62, {'thermal.cpu': 40.6, 'fs.root.used_percent': 56.0,
+                                    'load.1m': 1.01}) == ({'load.1m': 1.01}, {})
+
+    def test_counters_are_delta_encoded_between_keyframes(self):
+        deadband = DeadbandFilter(*parse_deadband({'delta': True, 'max_silence': 10}))
+        assert deadband.filter(0, {'frames': 100}) == ({'frames': 100}, {})
+        assert deadband.filter(1, {'frames': 130}) == ({}, {'frames': 30})
+        assert deadband.filter(2, {'frames': 130}) == ({}, {})
+        assert deadband.filter(10, {'frames': 135}) == ({'frames': 135}, {})
+
+    def test_reporter_skips_unchanged_samples(self):
+        collector = mock.Mock()
+        collector.collect.side_effect = [{'load.1m': 1}, {'load.1m': 1}, {'load.1m': 2}]
+        publish = mock.Mock()
+        store = mock.Mock()
+        reporter = MetricsReporter([collector], publish, store=store,
+                                   deadband=DeadbandFilter(*parse_deadband({})))
+        for _ in range(3):
+            reporter.sample()
+        reporter.flush()
+
+        assert store.append_sample.call_count == 3
+        samples = publish.call_args[0][0]['samples']
+        assert [s['metrics'] for s in samples] == [{'load.1m': 1}, {'load.1m': 2}]
+
+    def test_deadband_can_be_disabled(self):
+        assert MetricsOptions.from_dict({'deadband': False}).deadband is None
+        assert MetricsOptions.from_dict({}).deadband is not None
+
+
+class ProcessAccountingTest(unittest.TestCase):
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+        self.accounting = ProcessAccounting(self.proc_root)
+
+    def tearDown(self):
+        self.accounting.close()
+        shutil.rmtree(self.proc_root)
+
+    def write_process(self, pid, ppid, ticks, rss_pages, read_bytes, children=(), starttime=1000):
+        base = os.path.join(self.proc_root, str(pid))
+        task = os.path.join(base, 'task', str(pid))
+        for path in (task, os.path.join(base, 'fd')):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        fields = ['S', str(ppid)] + ['0'] * 9 + [str(ticks), '0'] + ['0'] * 4 + \
+            ['2', '0', str(starttime), '0', str(rss_pages)] + ['0'] * 20
+        with open(os.path.join(base, 'stat'), 'w') as f:
+            f.write('{} (some proc) {}\n'.format(pid, ' '.join(fields)))
+        with open(os.path.join(base, 'io'), 'w') as f:
+            f.write('rchar: 1\nwchar: 1\nread_bytes: {}\nwrite_bytes: 0\n'.format(read_bytes))
+        with open(os.path.join(task, 'children'), 'w') as f:
+            f.write(' '.join(str(c) for c in children))
+        open(os.path.join(base, 'fd', '0'), 'w').close()
+
+    def test_usage_covers_the_whole_process_tree(self):
+        self.write_process(10, 1, ticks=0, rss_pages=10, read_bytes=0, children=[11])
+        self.write_process(11, 10, ticks=0, rss_pages=5, read_bytes=0)
+        first = self.accounting.sample({'camera': 10}, now=0)['camera']
+        assert first.processes == 2
+        assert first.rss_bytes == 15 * PAGE_SIZE
+        assert first.threads == 4
+        assert first.fds == 2
+        assert first.cpu_percent is None
+
+        self.write_process(10, 1, ticks=CLOCK_TICKS, rss_pages=10, read_bytes=1000, children=[11])
+        self.write_process(11, 10, ticks=CLOCK_TICKS, rss_pages=5, read_bytes=1000)
+        second = self.accounting.sample({'camera': 10}, now=2)['camera']
+        assert second.cpu_percent == 100.0
+        assert second.read_bps == 1000.0
+        assert second.write_bps == 0
+
+    def test_reused_pid_does_not_produce_a_rate(self):
+        self.write_process(10, 1, ticks=500, rss_pages=1, read_bytes=0)
+        self.accounting.sample({'camera': 10}, now=0)
+        self.accounting.close()
+        self.write_process(10, 1, ticks=5, rss_pages=1, read_bytes=0, starttime=2000)
+        usage = self.accounting.sample({'camera': 10}, now=1)['camera']
+        assert usage.processes == 1
+        assert usage.cpu_percent is None
+
+    def test_exited_service_is_empty(self):
+        usage = self.accounting.sample({'camera': 4242}, now=0)['camera']
+        assert usage.processes == 0
+
+    def test_scaled_services_are_summed_over_their_instances(self):
+        self.write_process(10, 1, ticks=0, rss_pages=10, read_bytes=0)
+        self.write_process(20, 1, ticks=0, rss_pages=5, read_bytes=0)
+        self.write_process(30, 1, ticks=0, rss_pages=1, read_bytes=0)
+        pids = {'worker_0': ('worker', 10), 'worker_1': ('worker', 20), 'camera': ('camera', 30)}
+        collector = ServiceMetricsCollector(lambda: pids, self.proc_root)
+        self.addCleanup(collector.close)
+        values = collector.collect(now=0)
+        assert values['service.worker_0.rss_bytes'] == 10 * PAGE_SIZE
+        assert values['service.worker_1.rss_bytes'] == 5 * PAGE_SIZE
+        assert values['service.worker.rss_bytes'] == 15 * PAGE_SIZE
+        assert values['service.worker.processes'] == 2
+        assert values['service.camera.rss_bytes'] == PAGE_SIZE
+        assert 'service.worker.cpu_percent' not in values
@@ -0,0 +1,44 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+import mock
+
+from angelo.mqtt import MqttClient
+
+
+class MqttClientTest(unittest.TestCase):
+    def setUp(self):
+        self.mqtt_client = MqttClient('mqtt.pid', 'angelo.conf', mock.Mock())
+
+    def test_client_is_initialized_once(self):
+        with mock.patch.object(MqttClient, 'initialize_client') as initialize_client:
+            self.mqtt_client.ensure_client()
+            initialize_client.assert_called_once_with()
+
+            self.mqtt_client.client = mock.Mock()
+            self.mqtt_client.ensure_client()
+            initialize_client.assert_called_once_with()
+
+    def test_metrics_wait_for_the_connection_to_be_published(self):
+        reporter = mock.Mock()
+        self.mqtt_client.flush_metrics(reporter)
+        assert not reporter.flush.called
+
+        self.mqtt_client.client = mock.Mock()
+        self.mqtt_client.client.is_connected.return_value = True
+        self.mqtt_client.close_metrics(reporter)
+        reporter.flush.assert_called_once_with()
+        reporter.close.assert_called_once_with()
+
+    def test_events_are_dropped_while_not_connected(self):
+        with mock.patch.object(MqttClient, 'publish_event') as publish_event:
+            self.mqtt_client.publish_event_if_connected({'service': 'camera'}, 'service_crashloop')
+            assert not publish_event.called
+
+            self.mqtt_client.client = mock.Mock()
+            self.mqtt_client.client.is_connected.return_value = True
+            self.mqtt_client.publish_event_if_connected({'service': 'camera'}, 'service_crashloop')
+            publish_event.assert_called_once_with({'service': 'camera'}, 'service_crashloop')
@@ -0,0 +1,83 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import signal
+import subprocess
+import sys
+import time
+import unittest
+
+import mock
+
+from angelo.pidctl import pid_exists
+from angelo.pidctl import terminate
+from angelo.pidctl import wait_pid
+
+IGNORE_SIGTERM = (
+    'import signal, sys, time\n'
+    'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+    'sys.stdout.write("ready\\n")\n'
+    'sys.stdout.flush()\n'
+    'time.sleep(30)\n'
+)
+
+
+class PidctlTest(unittest.TestCase):
+    def spawn(self, *args):
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.addCleanup(process.stdout.close)
+        return process
+
+    def test_terminate_child(self):
+        process = self.spawn('sleep', '30')
+        start = time.time()
+        result = terminate(process.pid, grace_period=10)
+        assert time.time() - start < 5
+        assert result.returncode == -signal.SIGTERM
+        assert not result.killed
+        assert not pid_exists(process.pid)
+
+    def test_terminate_escalates_to_sigkill(self):
+        process = self.spawn(sys.executable, '-c', IGNORE_SIGTERM)
+        process.stdout.readline()
+        result = terminate(process.pid, grace_period=0.2)
+        assert result.returncode == -signal.SIGKILL
+        assert result.killed
+
+    def orphan(self):
+        # The shell exits at once, leaving sleep to init
+        shell = self.spawn('sh', '-c', 'sleep 30 >/dev/null & echo $!')
+        pid = int(shell.stdout.readline())
+        shell.wait()
+        return pid
+
+    def test_terminate_process_that_is_not_a_child(self):
+        pid = self.orphan()
+        start = time.time()
+        result = terminate(pid, grace_period=10)
+        assert time.time() - start < 5
+        assert result.returncode is None
+        assert not result.killed
+        assert not pid_exists(pid)
+
+    def test_terminate_process_that_is_not_a_child_without_pidfd(self):
+        pid = self.orphan()
+        start = time.time()
+        with mock.patch('angelo.pidctl.open_pidfd', return_value=None):
+            result = terminate(pid, grace_period=10)
+        assert time.time() - start < 5
+        assert result == (pid, None, False)
+
+    def test_wait_without_pidfd(self):
+        process = self.spawn('sleep', '30')
+        with mock.patch('angelo.pidctl.open_pidfd', return_value=None):
+            assert wait_pid(process.pid, timeout=0.05) == (False, None)
+            process.send_signal(signal.SIGINT)
+            assert wait_pid(process.pid, timeout=10) == (True, -signal.SIGINT)
+
+    def test_wait_for_a_process_that_is_gone(self):
+        process = self.spawn('true')
+        process.wait()
+        assert wait_pid(process.pid, timeout=1) == (True, None)
+        assert terminate(process.pid).returncode is None
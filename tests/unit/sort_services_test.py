@@ -0,0 +1,52 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+from angelo.config.errors import DependencyError
+from angelo.config.sort_services import sort_service_dicts
+
+
+def names(services):
+    return [service['name'] for service in services]
+
+
+class SortServiceDictsTest(unittest.TestCase):
+    def test_services_come_after_their_dependencies(self):
+        services = [
+            {'name': 'web', 'links': ['db:database'], 'depends_on': ['cache']},
+            {'name': 'db'},
+            {'name': 'cache', 'pid': 'service:db'},
+            {'name': 'camera'},
+        ]
+        assert names(sort_service_dicts(services)) == ['db', 'cache', 'web', 'camera']
+
+    def test_long_chain(self):
+        services = [
+            {'name': 'service{}'.format(i), 'depends_on': ['service{}'.format(i + 1)]}
+            for i in range(5000)
+        ]
+        assert names(sort_service_dicts(services)) == names(reversed(services))
+
+    def test_cycle_names_its_path(self):
+        services = [
+            {'name': 'camera', 'depends_on': ['detector']},
+            {'name': 'detector', 'links': ['tracker']},
+            {'name': 'tracker', 'depends_on': ['camera']},
+            {'name': 'uploader', 'depends_on': ['camera']},
+        ]
+        with self.assertRaises(DependencyError) as context:
+            sort_service_dicts(services)
+        assert context.exception.msg == (
+            'Circular dependency:\n'
+            '  tracker\n'
+            '  depends on camera\n'
+            '  depends on detector\n'
+            '  depends on tracker'
+        )
+
+    def test_service_depending_on_itself(self):
+        with self.assertRaises(DependencyError) as context:
+            sort_service_dicts([{'name': 'camera', 'depends_on': ['camera']}])
+        assert context.exception.msg == 'A service can not depend on itself: camera'
@@ -0,0 +1,116 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import configparser
+import socket
+import unittest
+
+import mock
+from supervisor.xmlrpc import Faults
+
+from angelo.errors import OperationFailedError
+from angelo.process import Process
+from angelo.supervisor import Supervisor
+
+
+class SupervisorRpcTest(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Supervisor([])
+        self.rpc = mock.Mock()
+        self.supervisor._local.rpc = self.rpc
+
+    def test_multicall_is_a_single_round_trip(self):
+        self.rpc.system.multicall.return_value = [True, True]
+        self.supervisor.start_processes(['camera', 'uploader'], wait=False)
+        self.rpc.system.multicall.assert_called_once_with([
+            {'methodName': 'supervisor.startProcess', 'params': ['camera', False]},
+            {'methodName': 'supervisor.startProcess', 'params': ['uploader', False]},
+        ])
+
+    def test_multicall_reports_every_failure(self):
+        self.rpc.system.multicall.return_value = [
+            {'faultCode': Faults.BAD_NAME, 'faultString': 'BAD_NAME: nope'},
+            {'faultCode': Faults.ALREADY_STARTED, 'faultString': 'ALREADY_STARTED: camera'},
+            {'faultCode': Faults.SPAWN_ERROR, 'faultString': 'SPAWN_ERROR: broken'},
+        ]
+        with self.assertRaises(OperationFailedError) as context:
+            self.supervisor.start_processes(['nope', 'camera', 'broken'], wait=False)
+        assert context.exception.msg == 'nope: BAD_NAME: nope\nbroken: SPAWN_ERROR: broken'
+
+    def test_reload_replaces_only_changed_groups(self):
+        self.rpc.supervisor.reloadConfig.return_value = [[['new'], ['changed'], ['old']]]
+        self.rpc.system.multicall.return_value = [True, True]
+        self.rpc.supervisor.getAllProcessInfo.return_value = [
+            {'name': 'kept', 'group': 'kept', 'statename': 'RUNNING'},
+        ]
+        with mock.patch.object(Supervisor, 'read_config_hash', return_value='old'), \
+                mock.patch.object(Supervisor, 'write_config') as write_config:
+            assert self.supervisor.reload_config() == (['new'], ['changed'], ['old'])
+        write_config.assert_called_once_with()
+        calls = [[(c['methodName'], c['params'][0]) for c in call[0][0]]
+                 for call in self.rpc.system.multicall.call_args_list]
+        assert calls == [
+            [('supervisor.stopProcessGroup', 'changed'), ('supervisor.stopProcessGroup', 'old')],
+            [('supervisor.removeProcessGroup', 'changed'), ('supervisor.removeProcessGroup', 'old')],
+            [('supervisor.addProcessGroup', 'changed'), ('supervisor.addProcessGroup', 'new')],
+        ]
+
+    def test_reload_without_changes_does_nothing(self):
+        with mock.patch.object(Supervisor, 'read_config_hash',
+                               return_value=self.supervisor.config_hash()):
+            assert self.supervisor.reload_config() == ([], [], [])
+        assert not self.rpc.supervisor.reloadConfig.called
+
+    def test_stale_connection_is_reopened_once(self):
+        fresh = mock.Mock()
+        fresh.supervisor.getAllProcessInfo.return_value = []
+        self.rpc.supervisor.getAllProcessInfo.side_effect = socket.error('broken pipe')
+        with mock.patch.object(Supervisor, 'get_merged_config'), \
+                mock.patch('angelo.supervisor.RawConfigParser'), \
+                mock.patch('angelo.supervisor.SupervisorTransport'), \
+                mock.patch('angelo.supervisor.xmlrpclib.ServerProxy', return_value=fresh):
+            assert self.supervisor.get_all_process_info() == []
+
+    def test_follow_log_reads_from_offset(self):
+        self.rpc.supervisor.tailProcessStdoutLog.side_effect = [
+            ['', 10, True], ['', 16, True], ['', 4, True]]
+        self.rpc.supervisor.readProcessStdoutLog.side_effect = ['hello\n', 'new\n']
+        stream = self.supervisor.follow_log('camera', 10, interval=0)
+        assert next(stream) == 'hello\n'
+        # The log was rotated
+        assert next(stream) == 'new\n'
+        assert self.rpc.supervisor.readProcessStdoutLog.call_args_list == [
+            mock.call('camera', 10, 6), mock.call('camera', 0, 4)]
+
+
+class MergedConfigTest(unittest.TestCase):
+    def test_config_is_rendered_again_only_when_services_change(self):
+        service = Process('camera', command='camera --fps 30')
+        supervisor = Supervisor([service])
+        with mock.patch.object(Supervisor, 'render_config',
+                               side_effect=lambda: service.options['command']) as render:
+            first_hash = supervisor.config_hash()
+            assert supervisor.get_merged_config() == 'camera --fps 30'
+            supervisor.get_merged_config()
+            assert render.call_count == 1
+
+            service.options['command'] = 'camera --fps 60'
+            assert supervisor.config_hash() != first_hash
+            assert supervisor.get_merged_config() == 'camera --fps 60'
+            assert render.call_count == 2
+
+    def test_rendered_config_has_programs_and_socket(self):
+        supervisor = Supervisor([Process('camera', command='camera')])
+        config = supervisor.get_merged_config()
+        assert '[program:camera]' in config
+        assert 'file = {}'.format(supervisor.socket_file) in config
+
+    def test_pidfile_and_logfile_options_land_in_supervisord_section(self):
+        supervisor = Supervisor([])
+        cfg = configparser.RawConfigParser()
+        cfg.read_string(supervisor.get_config_from_options(
+            pidfile='/tmp/angelo.pid', logfile='/tmp/angelo.log'))
+        assert cfg.get('supervisord', 'pidfile') == '/tmp/angelo.pid'
+        assert cfg.get('supervisord', 'logfile') == '/tmp/angelo.log'
+        assert cfg.options('unix_http_server') == ['file']
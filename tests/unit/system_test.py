@@ -38,4 +38,47 @@ class SystemTest(unittest.TestCase):
         assert system.get_service('command').name == 'command'
         assert system.get_service('command').options['command'] == 'command run'
         assert system.get_service('conquer').name == 'conquer'
-        assert system.get_service('conquer').options['command'] == 'conquer all'
\ No newline at end of file
+        assert system.get_service('conquer').options['command'] == 'conquer all'
+
+    def test_services_start_after_their_dependencies_and_stop_before(self):
+        config = Config(
+            version=V1,
+            services=[
+                {'name': 'camera', 'command': 'camera'},
+                {'name': 'detector', 'command': 'detector', 'depends_on': {'camera': {}}},
+                {'name': 'uploader', 'command': 'uploader', 'depends_on': {'detector': {}}},
+            ],
+            secrets=None,
+            configs=None,
+        )
+        system = System.from_config(name='angelotest', config_data=config)
+        system.supervisor = mock.Mock()
+
+        system.start_services()
+        started = [c[0][0][0] for c in system.supervisor.start_processes.call_args_list]
+        assert started == ['camera', 'detector', 'uploader']
+
+        system.stop_services()
+        stopped = [c[0][0][0] for c in system.supervisor.stop_processes.call_args_list]
+        assert stopped == ['uploader', 'detector', 'camera']
+
+    def test_ps_aggregates_the_instances_of_scaled_services(self):
+        config = Config(
+            version=V1,
+            services=[{'name': 'worker', 'command': 'worker', 'scale': 2}],
+            secrets=None,
+            configs=None,
+        )
+        system = System.from_config(name='angelotest', config_data=config)
+        system.supervisor = mock.Mock()
+        system.supervisor.get_all_process_info.return_value = [
+            {'name': 'worker_0', 'group': 'worker', 'statename': 'RUNNING', 'pid': 10,
+             'description': 'pid 10'},
+            {'name': 'worker_1', 'group': 'worker', 'statename': 'BACKOFF', 'pid': 0,
+             'description': 'Exited too quickly'},
+        ]
+        [info] = system.ps()
+        assert info['name'] == 'worker'
+        assert info['statename'] == '1 BACKOFF, 1 RUNNING'
+        assert info['pids'] == [10]
+        assert system.instance_names() == ['worker_0', 'worker_1']
\ No newline at end of file
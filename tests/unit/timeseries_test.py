@@ -0,0 +1,93 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from angelo.timeseries import NoSuchSeries
+from angelo.timeseries import StoreOptions
+from angelo.timeseries import TimeSeriesStore
+
+
+class TimeSeriesStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.options = StoreOptions.from_dict({
+            'path': self.path,
+            'raw_points': 120,
+            'minute_points': 10,
+            'hour_points': 2,
+            'max_series': 2,
+        })
+        self.store = TimeSeriesStore(self.options)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def test_files_are_preallocated_and_never_grow(self):
+        with mock.patch('angelo.timeseries.log') as log:
+            self.store.append('cpu.percent', 1, 1.0)
+        assert not log.warning.called
+        filename = os.path.join(self.path, 'cpu.percent.ts')
+        assert os.path.getsize(filename) == self.options.series_size
+        for t in range(2, 2000):
+            self.store.append('cpu.percent', t, float(t))
+        assert os.path.getsize(filename) == self.options.series_size
+
+    def test_raw_ring_keeps_the_newest_points(self):
+        for t in range(1, 301):
+            self.store.append('load.1m', t, float(t))
+        points = self.store.query('load.1m', resolution='raw')
+        assert len(points) == 120
+        assert points[0].timestamp == 181
+        assert points[-1].value == 300
+
+        since = self.store.query('load.1m', since=250.5, resolution='raw')
+        assert [p.timestamp for p in since] == list(range(251, 301))
+
+    def test_rollups_are_computed_as_samples_arrive(self):
+        for t in range(0, 150):
+            self.store.append('mem.used_percent', t, float(t))
+        minutes = self.store.query('mem.used_percent', resolution='1m')
+        assert [p.timestamp for p in minutes] == [0, 60, 120]
+        assert minutes[0].value == 29.5
+        assert (minutes[0].min, minutes[0].max, minutes[0].count) == (0, 59, 60)
+        # the last bucket is still open
+        assert minutes[-1].count == 30
+
+    def test_query_picks_the_finest_resolution_covering_since(self):
+        for t in range(0, 600):
+            self.store.append('cpu.percent', t, 1.0)
+        assert len(self.store.query('cpu.percent', since=590)) == 10
+        assert self.store.query('cpu.percent', since=0)[0].count == 60
+
+    def test_out_of_order_points_are_dropped(self):
+        assert self.store.append('cpu.percent', 10, 1.0)
+        assert not self.store.append('cpu.percent', 5, 1.0)
+
+    def test_series_are_limited(self):
+        self.store.append('a', 1, 1.0)
+        self.store.append('b', 1, 1.0)
+        assert not self.store.append('c', 1, 1.0)
+        assert self.store.names() == ['a', 'b']
+
+    def test_points_survive_reopening_readonly(self):
+        for t in range(1, 11):
+            self.store.append('cpu.percent', t, float(t))
+        self.store.close()
+
+        reader = TimeSeriesStore(self.options, readonly=True)
+        assert len(reader.query('cpu.percent')) == 10
+        with self.assertRaises(NoSuchSeries):
+            reader.query('nope')
+        reader.close()
+
+        self.store = TimeSeriesStore(self.options)
+        assert not self.store.append('cpu.percent', 10, 1.0)
+        assert self.store.append('cpu.percent', 11, 1.0)
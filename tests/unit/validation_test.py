@@ -0,0 +1,56 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+import mock
+
+from angelo.config.config import ConfigFile
+from angelo.config.errors import ConfigurationError
+from angelo.config.validation import get_validator
+from angelo.config.validation import load_jsonschema
+from angelo.config.validation import validate_against_config_schema
+
+
+def config_file(**config):
+    config.setdefault('version', '1.0')
+    config.setdefault('services', {'camera': {'command': 'camera'}})
+    return ConfigFile('angelo.yml', config)
+
+
+class ValidationTest(unittest.TestCase):
+    def test_invalid_config_is_rejected(self):
+        with self.assertRaises(ConfigurationError) as context:
+            validate_against_config_schema(config_file(
+                services={'camera': {'command': 'camera', 'scale': 0}}))
+        assert 'services.camera.scale' in context.exception.msg
+
+        with self.assertRaises(ConfigurationError) as context:
+            validate_against_config_schema(config_file(cameras={}))
+        assert 'Invalid top-level property "cameras"' in context.exception.msg
+
+    def test_top_level_sections(self):
+        validate_against_config_schema(config_file(
+            env={'CAM_INDEX': 0, 'SHOW_GUI': False, 'VIDEO_SRC': None},
+            logs={'max_segments': 4},
+            crashloop={'restarts': 3},
+            metrics={},
+        ))
+
+    def test_schema_and_validators_are_loaded_once(self):
+        schema = load_jsonschema(config_file())
+        with mock.patch('angelo.config.validation.open') as open_:
+            assert load_jsonschema(config_file()) is schema
+        assert not open_.called
+        assert get_validator(schema) is get_validator(schema)
+        assert get_validator(schema, 'definitions', 'env') is not get_validator(schema)
+
+    def test_valid_content_is_validated_once(self):
+        validate_against_config_schema(config_file(env={'FPS': 30}))
+        with mock.patch('angelo.config.validation.get_validator') as get_validator:
+            validate_against_config_schema(config_file(env={'FPS': 30}))
+            assert not get_validator.called
+            get_validator.return_value.iter_errors.return_value = []
+            validate_against_config_schema(config_file(env={'FPS': 60}))
+            assert get_validator.called
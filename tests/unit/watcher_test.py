@@ -0,0 +1,69 @@
+# encoding: utf-8
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from angelo.watcher import ConfigWatcher
+from angelo.watcher import Poller
+from angelo.watcher import WatchOptions
+
+
+class ConfigWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.config_file = os.path.join(self.path, 'angelo.yml')
+        self.write('version: "1.0"\n')
+        self.on_change = mock.Mock()
+
+    def write(self, content, path=None):
+        with open(path or self.config_file, 'w') as f:
+            f.write(content)
+
+    def watcher(self):
+        watcher = ConfigWatcher([self.config_file], self.on_change, debounce=0.05)
+        self.addCleanup(watcher.source.close)
+        return watcher
+
+    def test_burst_of_writes_is_applied_once(self):
+        watcher = self.watcher()
+        self.write('version: "1.0"\nservices: {}\n')
+        self.write('version: "1.0"\nservices:\n  camera: {}\n')
+        assert watcher.check(timeout=1)
+        self.on_change.assert_called_once_with()
+        assert not watcher.check(timeout=0.05)
+
+    def test_replaced_file_is_seen(self):
+        watcher = self.watcher()
+        new_file = os.path.join(self.path, 'angelo.yml.new')
+        self.write('version: "1.0"\nservices: {}\n', new_file)
+        assert not watcher.check(timeout=0.05)
+        os.rename(new_file, self.config_file)
+        assert watcher.check(timeout=1)
+        assert self.on_change.call_count == 1
+
+    def test_unchanged_content_is_not_applied(self):
+        watcher = self.watcher()
+        self.write('version: "1.0"\n')
+        self.write('version: "1.0"\n', os.path.join(self.path, 'other.yml'))
+        assert not watcher.check(timeout=0.2)
+        assert not self.on_change.called
+
+    def test_polling_without_inotify(self):
+        with mock.patch('angelo.watcher.Inotify', side_effect=OSError('no inotify')):
+            watcher = self.watcher()
+        assert isinstance(watcher.source, Poller)
+        os.utime(self.config_file, (0, 0))
+        self.write('version: "1.0"\nservices: {}\n')
+        assert watcher.check(timeout=0.05)
+        self.on_change.assert_called_once_with()
+
+    def test_options(self):
+        assert WatchOptions.from_dict(None) == (True, 0.2)
+        assert WatchOptions.from_dict({'enabled': False, 'debounce': '1s'}) == (False, 1)